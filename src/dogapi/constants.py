@@ -5,6 +5,19 @@ class MetricType(object):
     Histogram = "histogram"
 
 
+class OverflowPolicy(object):
+    DROP = 'drop'
+    FOLD = 'fold'
+    LRU = 'lru'
+    ALL = (DROP, FOLD, LRU)
+
+
+class Compression(object):
+    GZIP = 'gzip'
+    DEFLATE = 'deflate'
+    ALL = (GZIP, DEFLATE)
+
+
 class MonitorType(object):
     SERVICE_CHECK = 'service check'
     METRIC_ALERT = 'metric alert'
@@ -22,5 +22,14 @@ class DogHttpApi(BaseDatadog, HttpMetricApi, EventApi, DashApi, InfrastructureAp
 
     The default timeout is 2 seconds, but that can be changed by setting the
     client's `timeout` attribute.
+
+    Request bodies are sent uncompressed unless the client's `compression`
+    is set to 'gzip' or 'deflate', in which case bodies of at least
+    `compression_threshold` bytes (1024 by default) are compressed.
+
+    Connections are kept alive and reused across calls: up to `pool_size`
+    idle connections per host (4 by default) are kept for up to
+    `pool_idle_timeout` seconds (30 by default). Set `pool_size` to 0 to
+    open a connection per request.
     """
 
@@ -1,12 +1,15 @@
 __all__ = [
     'BaseDatadog',
+    'ConnectionPool',
 ]
 
 import os
 import logging
 import re
 import socket
+import threading
 import time
+import zlib
 from contextlib import contextmanager
 from pprint import pformat
 
@@ -30,11 +33,86 @@ else:
     from urllib import urlencode
 
 __all__ = [
-    'BaseDatadog'
+    'BaseDatadog',
+    'ConnectionPool',
 ]
 
+# Errors that a connection closed by the server while idle in the pool
+# raises on the next request.
+stale_connection_exceptions = (socket.error, http_client.BadStatusLine)
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to `max_size` idle keep-alive connections per connection class,
+    host and timeout, for up to `idle_timeout` seconds each, so consecutive
+    requests skip the TCP and TLS handshakes. It's safe to share between
+    threads, and connections opened before a fork are dropped in the child.
+    """
+
+    def __init__(self, max_size=4, idle_timeout=30):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._pid = os.getpid()
+
+    def acquire(self, conn_cls, host, timeout):
+        """ Return a (connection, reused) pair, reusing the most recently
+        released connection that hasn't been idle for too long. """
+        key = (conn_cls, host, timeout)
+        expired = []
+        with self._lock:
+            self._check_pid()
+            idle = self._idle.get(key)
+            if idle:
+                conn, released = idle.pop()
+                if time.time() - released < self.idle_timeout:
+                    return conn, True
+                # The others were released even earlier.
+                expired = [conn] + [c for c, _ in idle]
+                del idle[:]
+        for conn in expired:
+            conn.close()
+        return self.connect(conn_cls, host, timeout), False
+
+    def connect(self, conn_cls, host, timeout):
+        """ Return a new connection. """
+        try:
+            return conn_cls(host, timeout=timeout)
+        except TypeError:
+            # timeout= parameter is only supported 2.6+
+            return conn_cls(host)
+
+    def release(self, conn, conn_cls, host, timeout):
+        """ Keep a connection whose response was read for the next request,
+        or close it if the pool is full. """
+        with self._lock:
+            self._check_pid()
+            idle = self._idle.setdefault((conn_cls, host, timeout), [])
+            if len(idle) < self.max_size:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def close(self):
+        """ Close the idle connections. """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
+
+    def _check_pid(self):
+        # Called with the lock held. The parent's connections can't be
+        # shared, and closing them here could end its TLS sessions.
+        if self._pid != os.getpid():
+            self._idle = {}
+            self._pid = os.getpid()
+
+
 class BaseDatadog(object):
-    def __init__(self, api_key=None, application_key=None, api_version='v1', api_host=None, timeout=2, max_timeouts=3, backoff_period=300, swallow=True, use_ec2_instance_id=False, json_responses=False):
+    def __init__(self, api_key=None, application_key=None, api_version='v1', api_host=None, timeout=2, max_timeouts=3, backoff_period=300, swallow=True, use_ec2_instance_id=False, json_responses=False, compression=None, compression_threshold=1024, pool_size=4, pool_idle_timeout=30):
 
         self.http_conn_cls = http_client.HTTPSConnection
         self._api_host = None
@@ -56,36 +134,52 @@ class BaseDatadog(object):
         self.use_ec2_instance_id = use_ec2_instance_id
         self.json_responses = json_responses
 
-    def http_request(self, method, path, body=None, response_formatter=None, error_formatter=None, **params):
+        # Request bodies of at least compression_threshold bytes are
+        # compressed with gzip or deflate, if compression is set.
+        if compression is not None and compression not in Compression.ALL:
+            raise ValueError('Invalid compression %r, expected one of: %s'
+                % (compression, ', '.join(Compression.ALL)))
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+
+        # Connections are kept alive between requests, whichever API they're for.
+        self.connection_pool = ConnectionPool(pool_size, pool_idle_timeout)
+
+    def http_request(self, method, path, body=None, response_formatter=None, error_formatter=None, headers=None, **params):
+        """ Send a request to the API. A body given along with its *headers*,
+        as returned by :meth:`encode_body`, is sent as is. """
         try:
             # Check if it's ok to submit
             if not self._should_submit():
                 raise HttpBackoff("Too many timeouts. Won't try again for {1} seconds.".format(*self._backoff_status()))
 
-            # Construct the url
-            if self.api_key:
-                params['api_key'] = self.api_key
-            if self.application_key:
-                params['application_key'] = self.application_key
-            url = "/api/%s/%s?%s" % (self.api_version, path.lstrip('/'), urlencode(params))
-            try:
-                conn = self.http_conn_cls(self.api_host, timeout=self.timeout)
-            except TypeError:
-                # timeout= parameter is only supported 2.6+
-                conn = self.http_conn_cls(self.api_host)
+            url = self._url(path, params)
 
-            # Construct the body, if necessary
-            headers = {}
-            if isinstance(body, dict):
-                body = json.dumps(body)
-                headers['Content-Type'] = 'application/json'
+            # Construct the body, if necessary, before taking a connection
+            # that would have to be given back if this raised.
+            if headers is None:
+                body, headers = self.encode_body(body)
 
+            pool = self.connection_pool
+            conn_key = (self.http_conn_cls, self.api_host, self.timeout)
+            conn, reused = pool.acquire(*conn_key)
+            reusable = False
             try:
                 start_time = time.time()
 
                 # Make the request
                 try:
-                    conn.request(method, url, body, headers)
+                    try:
+                        response = self._send(conn, method, url, body, headers)
+                    except timeout_exceptions:
+                        raise
+                    except stale_connection_exceptions:
+                        if not reused:
+                            raise
+                        # The server closed the idle connection, try a new one.
+                        conn.close()
+                        conn = pool.connect(*conn_key)
+                        response = self._send(conn, method, url, body, headers)
                 except timeout_exceptions:
                     # Keep a count of the timeouts to know when to back off
                     self._timeout_counter += 1
@@ -99,10 +193,10 @@ class BaseDatadog(object):
                 self._timeout_counter = 0
 
                 # Parse the response as json
-                response = conn.getresponse()
                 duration = round((time.time() - start_time) * 1000., 4)
                 log.info("%s %s %s (%sms)" % (response.status, method, url, duration))
                 response_str = response.read()
+                reusable = not getattr(response, 'will_close', True)
                 if response_str:
                     try:
                         if is_p3k():
@@ -123,7 +217,10 @@ class BaseDatadog(object):
                 else:
                     return response_formatter(response_obj)
             finally:
-                conn.close()
+                if reusable:
+                    pool.release(conn, *conn_key)
+                else:
+                    conn.close()
         except ClientError as e:
             if self.swallow:
                 log.error(str(e))
@@ -182,8 +279,44 @@ class BaseDatadog(object):
         return locals()
     api_host = property(**api_host())
 
+    def encode_body(self, body):
+        """ Return a request body, serialized and compressed as needed, and
+        the headers that describe it. """
+        headers = {}
+        if isinstance(body, dict):
+            body = json.dumps(body)
+        if body is not None:
+            # Bodies may also come already serialized.
+            headers['Content-Type'] = 'application/json'
+            if self.compression and len(body) >= self.compression_threshold:
+                body = self._compress(body)
+                headers['Content-Encoding'] = self.compression
+        return body, headers
+
     # Private functions
 
+    def _url(self, path, params):
+        # Construct the url
+        if self.api_key:
+            params['api_key'] = self.api_key
+        if self.application_key:
+            params['application_key'] = self.application_key
+        return "/api/%s/%s?%s" % (self.api_version, path.lstrip('/'), urlencode(params))
+
+    def _send(self, conn, method, url, body, headers):
+        conn.request(method, url, body, headers)
+        return conn.getresponse()
+
+    def _compress(self, body):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        if self.compression == Compression.GZIP:
+            # A gzip header and trailer around the deflate stream.
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                16 + zlib.MAX_WBITS)
+            return compressor.compress(body) + compressor.flush()
+        return zlib.compress(body)
+
     def _should_submit(self):
         """ Returns True if we're in a state where we should make a request
         (backoff expired, no backoff in effect), false otherwise.
@@ -1 +1,2 @@
 from dogapi.stats.dog_stats_api import DogStatsApi
+from dogapi.stats.server import StatsdServer, ShardedStatsdServer
@@ -0,0 +1,169 @@
+"""
+Posting to the API from an asyncio event loop, over connections the loop
+itself drives, so that flushing from coroutines takes neither a thread nor a
+blocking call. It's written with protocol callbacks rather than coroutines so
+the package still imports on Python 2, and is only imported on Python 3.
+
+Each request goes over a connection of its own, which the server closes once
+it has answered.
+"""
+
+import asyncio
+import logging
+import ssl
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from dogapi.exceptions import ApiError, ClientError, HttpBackoff, HttpTimeout
+from dogapi.http.base import http_client
+
+
+log = logging.getLogger('dd.dogapi')
+
+
+class _Exchange(asyncio.Protocol):
+    """ Writes a request and collects the response until the connection is
+    closed, then resolves *future* with the raw response. """
+
+    def __init__(self, request, future):
+        self.request = request
+        self.future = future
+        self.transport = None
+        self.response = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.write(self.request)
+
+    def data_received(self, data):
+        self.response += data
+
+    def connection_lost(self, exc):
+        if self.future.done():
+            return
+        if exc is None:
+            self.future.set_result(bytes(self.response))
+        else:
+            self.future.set_exception(exc)
+
+    def abort(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+        if self.transport is not None:
+            self.transport.abort()
+
+
+def post(loop, dog, path, body, headers):
+    """
+    POST a body and the headers returned by
+    :meth:`~dogapi.http.base.BaseDatadog.encode_body` to the API of *dog*, a
+    :class:`~dogapi.DogHttpApi`, from the *loop*. Returns a future of the
+    decoded response, which fails with the exceptions
+    :meth:`~dogapi.http.base.BaseDatadog.http_request` raises when it doesn't
+    swallow them. The request is given up after `dog.timeout` seconds.
+    """
+    result = loop.create_future()
+    if not dog._should_submit():
+        result.set_exception(HttpBackoff("Too many timeouts. Won't try again for {1} seconds."
+            .format(*dog._backoff_status())))
+        return result
+    url = dog._url(path, {})
+    tls = issubclass(dog.http_conn_cls, http_client.HTTPSConnection)
+    host, port = _split_host(dog.api_host, 443 if tls else 80)
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    lines = ['POST %s HTTP/1.1' % url, 'Host: %s' % dog.api_host, 'Connection: close',
+             'Content-Length: %d' % len(body)]
+    lines += ['%s: %s' % header for header in sorted(headers.items())]
+    request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+    start_time = time.time()
+    response = loop.create_future()
+    exchange = _Exchange(request, response)
+    connect = loop.create_task(loop.create_connection(lambda: exchange, host, port,
+        ssl=ssl.create_default_context() if tls else None))
+
+    def connected(connect):
+        if not connect.cancelled() and connect.exception() is not None:
+            exchange.abort(connect.exception())
+
+    def time_out():
+        # Keep a count of the timeouts to know when to back off
+        dog._timeout_counter += 1
+        connect.cancel()
+        exchange.abort(HttpTimeout('POST %s timed out after %d seconds.' % (url, dog.timeout)))
+
+    def answered(response):
+        timer.cancel()
+        try:
+            try:
+                status, response_str = _parse_response(response.result())
+            except (OSError, IOError) as e:
+                raise ClientError("Could not request POST %s%s: %s" % (dog.api_host, url, e))
+            dog._timeout_counter = 0
+            duration = round((time.time() - start_time) * 1000., 4)
+            log.info("%s POST %s (%sms)" % (status, url, duration))
+            result.set_result(_decode(response_str, dog.json_responses))
+        except Exception as e:
+            result.set_exception(e)
+
+    timer = loop.call_later(dog.timeout, time_out)
+    connect.add_done_callback(connected)
+    response.add_done_callback(answered)
+    return result
+
+
+def _split_host(api_host, default_port):
+    host, sep, port = api_host.rpartition(':')
+    if sep and port.isdigit():
+        return host, int(port)
+    return api_host, default_port
+
+
+def _parse_response(data):
+    # Return the status and body of a raw HTTP response.
+    head, sep, body = data.partition(b'\r\n\r\n')
+    if not sep:
+        raise ClientError('Incomplete HTTP response')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(None, 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = _dechunk(body)
+    elif 'content-length' in headers:
+        body = body[:int(headers['content-length'])]
+    return status, body
+
+
+def _dechunk(data):
+    chunks = []
+    while True:
+        size_line, _, data = data.partition(b'\r\n')
+        size = int(size_line.split(b';')[0], 16)
+        if not size:
+            return b''.join(chunks)
+        chunks.append(data[:size])
+        data = data[size + 2:]
+
+
+def _decode(response_str, json_responses):
+    # Parse the response as json, as http_request does.
+    if response_str:
+        try:
+            response_obj = json.loads(response_str.decode('utf-8'))
+        except ValueError:
+            raise ValueError('Invalid JSON response: {0}'.format(response_str))
+        if response_obj and 'errors' in response_obj:
+            raise ApiError(response_obj)
+    else:
+        response_obj = None
+    if response_obj is None and json_responses:
+        response_obj = {}
+    return response_obj
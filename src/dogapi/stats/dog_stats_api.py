@@ -5,23 +5,41 @@ and allows flushing metrics in process, in a thread or in a greenlet, depending
 on your application's needs.
 """
 
+import atexit
+import errno
 import logging
+import os
 import socket
+import threading
+import weakref
 from functools import wraps
 from contextlib import contextmanager
-from time import time
+from time import sleep, time
 
 from dogapi.common import get_ec2_instance_id
-from dogapi.constants import MetricType
-from dogapi.stats.metrics import MetricsAggregator, Counter, Gauge, Histogram
-from dogapi.stats.statsd  import StatsdAggregator
+from dogapi.constants import MetricType, OverflowPolicy
+from dogapi.stats.metrics import (MetricsAggregator, ShardedMetricsAggregator,
+    Counter, Gauge, Histogram, SketchHistogram, NullBoundMetric)
+from dogapi.stats.statsd  import StatsdAggregator, AggregatingStatsdAggregator
 from dogapi.stats.reporters import HttpReporter
+from dogapi.stats.spool import Spool
 
 
 # Loggers
 log = logging.getLogger('dd.dogapi')
 
 
+# The started clients, which are reset in forked children.
+_clients = []
+
+
+# The histogram implementations that can be chosen at start.
+HISTOGRAM_ENGINES = {
+    'reservoir': Histogram,
+    'sketch': SketchHistogram,
+}
+
+
 class DogStatsApi(object):
 
     def __init__(self):
@@ -38,10 +56,29 @@ class DogStatsApi(object):
                     use_ec2_instance_ids=False,
                     flush_in_thread=True,
                     flush_in_greenlet=False,
+                    flush_in_asyncio=False,
                     disabled=False,
                     statsd=False,
                     statsd_host='localhost',
-                    statsd_port=8125):
+                    statsd_port=8125,
+                    statsd_socket_path=None,
+                    statsd_max_buffer_size=None,
+                    statsd_max_buffer_delay=1,
+                    statsd_sender_queue_size=None,
+                    statsd_aggregate=False,
+                    statsd_aggregate_histograms=False,
+                    sharded=False,
+                    shared=False,
+                    histogram_engine='reservoir',
+                    max_contexts=None,
+                    max_contexts_per_metric=None,
+                    overflow_policy=OverflowPolicy.DROP,
+                    emit_telemetry=False,
+                    flush_jitter=None,
+                    drain_on_exit=True,
+                    drain_timeout=5,
+                    spool_path=None,
+                    spool_max_size=64 * 1024 * 1024):
         """
         Configure the DogStatsApi instance and optionally, begin auto-flusing metrics.
 
@@ -49,51 +86,279 @@ class DogStatsApi(object):
         :param flush_interval: The number of seconds to wait between flushes.
         :param flush_in_thread: True if you'd like to spawn a thread to flush metrics. It will run every `flush_interval` seconds.
         :param flush_in_greenlet: Set to true if you'd like to flush in a gevent greenlet.
+        :param flush_in_asyncio: Set to true to schedule flushes on the running asyncio event loop,
+                                 in which case `start` must be called from that loop, e.g. at the
+                                 top of the coroutine given to `asyncio.run`. Roll-ups run on the
+                                 loop, and the series are posted over connections the loop
+                                 drives, without a thread or a blocking call.
+        :param statsd_socket_path: In statsd mode, send to the agent over this Unix domain socket
+                                   rather than over UDP to `statsd_host`:`statsd_port`.
+        :param statsd_max_buffer_size: In statsd mode, pack points into datagrams of up to this
+                                       many bytes instead of sending one datagram per point.
+        :param statsd_max_buffer_delay: The longest, in seconds, a point may wait in the statsd
+                                        buffer before it is sent.
+        :param statsd_sender_queue_size: In statsd mode, format and send points from a background
+                                         thread fed by a queue of this size. Points recorded while
+                                         the queue is full are dropped.
+        :param statsd_aggregate: In statsd mode, sum counters and keep the last value of gauges in
+                                 process and send one point per context every `roll_up_interval`
+                                 seconds instead of one point per call.
+        :param statsd_aggregate_histograms: With `statsd_aggregate`, compute histogram roll-ups in
+                                            process too and send them as gauges, except for the
+                                            count, which is sent as a counter.
+        :param sharded: Set to true to give each thread its own aggregation shard. Recommended
+                        for processes with many threads recording metrics concurrently.
+        :param shared: Set to true in the parent of a pre-fork server to aggregate the metrics of
+                       every process forked afterwards in shared memory, and only flush from the
+                       parent (see :class:`~dogapi.stats.shared.SharedMetricsAggregator`). The
+                       slots for counters and gauges are sized by `max_contexts`. Unix only.
+        :param histogram_engine: How histograms compute percentiles in process. 'reservoir' keeps
+                                 a random sample of 1000 points, 'sketch' uses a mergeable quantile
+                                 sketch with bounded memory and a 1% relative error.
+        :param max_contexts: The maximum number of contexts (unique name, host and tags) held
+                             per roll-up interval. None means unlimited.
+        :param max_contexts_per_metric: The maximum number of contexts of a single metric name
+                                        held per roll-up interval. None means unlimited.
+        :param overflow_policy: What to do with points past those caps: drop them, fold them into
+                                an 'overflow' tagged context, or fold the least recently used
+                                context to make room. See :class:`~dogapi.constants.OverflowPolicy`.
+        :param emit_telemetry: Set to true to record the client's own telemetry (see
+                               :meth:`get_telemetry`) as `dogapi.client.*` metrics on every flush.
+        :param flush_jitter: Flushes happen on `roll_up_interval` boundaries, delayed by a random
+                             per-process offset of up to this many seconds so that processes
+                             started together don't hit the intake at once. Defaults to
+                             `flush_interval`; set to 0 to flush right on the boundaries.
+        :param drain_on_exit: Set to false to not send the metrics still pending when the
+                              interpreter exits. See :meth:`stop`.
+        :param drain_timeout: The number of seconds to wait for pending metrics to be sent
+                              when exiting.
+        :param spool_path: A directory where series that couldn't be posted are kept, up to
+                           `spool_max_size` bytes, until they can be. See
+                           :class:`~dogapi.stats.spool.Spool`. Forked children spool in a
+                           subdirectory of their own, capped at `spool_max_size` too, which
+                           the next process to start or fork takes over once they exit.
         """
+        if histogram_engine not in HISTOGRAM_ENGINES:
+            raise ValueError("Unknown histogram engine %r, expected one of: %s"
+                % (histogram_engine, ', '.join(sorted(HISTOGRAM_ENGINES))))
+        if overflow_policy not in OverflowPolicy.ALL:
+            raise ValueError("Unknown overflow policy %r, expected one of: %s"
+                % (overflow_policy, ', '.join(OverflowPolicy.ALL)))
+        loop = None
+        if flush_in_asyncio and not (disabled or statsd or flush_in_greenlet):
+            loop = _running_loop()
         self.flush_interval = flush_interval
         self.roll_up_interval = roll_up_interval
+        if flush_jitter is None:
+            flush_jitter = flush_interval
+        self.flush_jitter = flush_jitter
         self.device = device
-        self._disabled = disabled
+        self._histogram_class = HISTOGRAM_ENGINES[histogram_engine]
 
         self.host = host or socket.gethostname()
         if use_ec2_instance_ids:
             self.host = get_ec2_instance_id()
 
         self._is_auto_flushing = False
+        self._flush_thread = None
+        self._flush_handle = None
+        self._flush_greenlet = None
+        self._drain_on_exit = drain_on_exit and not disabled
+        self.drain_timeout = drain_timeout
+        if self._drain_on_exit and not getattr(self, '_exit_hook_registered', False):
+            # A weak reference, so the hook doesn't keep stopped instances alive.
+            atexit.register(_drain_at_exit, weakref.ref(self))
+            self._exit_hook_registered = True
+        self._is_flush_in_progress = False
+        self.flush_count = 0
+        self.last_flush_duration = 0
+        # How long the last and the slowest flushes held up the aggregator.
+        self.last_detach_duration = 0
+        self.max_detach_duration = 0
+        self._emit_telemetry = emit_telemetry
+        self._last_telemetry = {}
+        self._is_statsd = statsd
+        self._is_shared = shared and not statsd
+        limits = {
+            'max_contexts': max_contexts,
+            'max_contexts_per_metric': max_contexts_per_metric,
+            'overflow_policy': overflow_policy,
+        }
         if statsd:
             # If we're configured to send to a statsd instance, use an aggregator
-            # which forwards packets over UDP.
-            log.info("Initializing dog api to use statsd: %s, %s" % (statsd_host, statsd_port))
-            self._needs_flush = False
-            self._aggregator = StatsdAggregator(statsd_host, statsd_port)
+            # which forwards packets over UDP or a Unix socket.
+            if statsd_socket_path:
+                log.info("Initializing dog api to use statsd: %s" % statsd_socket_path)
+            else:
+                log.info("Initializing dog api to use statsd: %s, %s" % (statsd_host, statsd_port))
+            if statsd_aggregate:
+                self._needs_flush = True
+                flush_thread_interval = self.flush_interval
+            else:
+                # Buffered points need flushing if no new point comes along to
+                # push them out. A sender thread takes care of that by itself.
+                self._needs_flush = statsd_max_buffer_size is not None
+                flush_thread_interval = None
+                if self._needs_flush and statsd_sender_queue_size is None:
+                    flush_thread_interval = statsd_max_buffer_delay
         else:
-            # Otherwise create an aggreagtor that while aggregator metrics
-            # in process.
             self._needs_flush = True
-            self._aggregator = MetricsAggregator(self.roll_up_interval)
 
+        # Forked children build their own reporter, so this is kept around.
+        def new_aggregator():
+            if statsd:
+                aggregator = StatsdAggregator(statsd_host, statsd_port,
+                    max_buffer_size=statsd_max_buffer_size,
+                    max_buffer_delay=statsd_max_buffer_delay,
+                    socket_path=statsd_socket_path,
+                    sender_queue_size=statsd_sender_queue_size)
+                if statsd_aggregate:
+                    # Aggregate in process and forward the roll-ups.
+                    aggregator = AggregatingStatsdAggregator(aggregator,
+                        self.roll_up_interval, statsd_aggregate_histograms, **limits)
+                return aggregator
+            # Otherwise create an aggreagtor that while aggregator metrics
+            # in process.
+            if shared:
+                from dogapi.stats.shared import SharedMetricsAggregator
+                if max_contexts is None:
+                    return SharedMetricsAggregator(self.roll_up_interval)
+                return SharedMetricsAggregator(self.roll_up_interval, max_contexts=max_contexts)
+            if sharded:
+                return ShardedMetricsAggregator(self.roll_up_interval, **limits)
+            return MetricsAggregator(self.roll_up_interval, **limits)
+
+        def new_reporter():
+            spool = None
+            if spool_path is not None:
+                # Processes can't share a spool, so forked children get their
+                # own, and take over those of the children that have exited.
+                path = spool_path
+                if self._pid != self._start_pid:
+                    path = os.path.join(spool_path, str(self._pid))
+                spool = Spool(path, max_size=spool_max_size)
+                _adopt_spools(spool, spool_path)
+            return HttpReporter(api_key=api_key, api_host=api_host, spool=spool)
+
+        self._new_reporter = new_reporter
+        self._aggregator = new_aggregator()
+        # Only collect, and reset in forked children, once there's an
+        # aggregator to record into.
+        self._disabled = disabled
+        self._start_pid = self._pid = os.getpid()
+        if not getattr(self, '_fork_hook_registered', False):
+            _clients.append(weakref.ref(self, _clients.remove))
+            self._fork_hook_registered = True
+        if statsd:
+            if flush_thread_interval and not self._disabled and flush_in_thread:
+                self._start_flush_thread(flush_thread_interval)
+        else:
             # The reporter is responsible for sending metrics off to their final destination.
             # It's abstracted to support easy unit testing and in the near future, forwarding
             # to the datadog agent.
-            self.reporter = HttpReporter(api_key=api_key, api_host=api_host)
+            self.reporter = new_reporter()
 
-            self._is_flush_in_progress = False
-            self.flush_count = 0
             if self._disabled:
                 log.info("dogapi is disabled. No metrics will flush.")
             else:
                 if flush_in_greenlet:
                     self._start_flush_greenlet()
+                elif flush_in_asyncio:
+                    self._start_flush_asyncio(loop)
                 elif flush_in_thread:
                     self._start_flush_thread()
 
-    def stop(self):
-        if not self._is_auto_flushing:
-            return True
-        if self._flush_thread:
-            self._flush_thread.end()
+    def after_fork(self):
+        """
+        Reset the client in a forked child: drop the points copied from the
+        parent, which the parent flushes, and restart the flush thread, which
+        doesn't survive the fork. The aggregator is reset in place, so handles
+        returned by :meth:`bind` in the parent keep working. Flush greenlets and asyncio schedules live on
+        in the child's copy of the hub or loop. With a `shared` aggregator, the
+        child keeps recording into it and doesn't flush at all.
+
+        This is done automatically on Python 3.7+. On older versions, call it
+        from the server's post-fork hook (e.g. gunicorn's `post_fork` or
+        uwsgi's `postfork`). Calling it again in the same process is harmless.
+        """
+        if getattr(self, '_pid', None) in (None, os.getpid()):
+            return
+        self._pid = os.getpid()
+        self._is_flush_in_progress = False
+        if self._is_shared:
+            # Keep recording into the shared aggregator and leave flushing
+            # it to the parent.
+            if self._flush_handle:
+                self._flush_handle.cancel()
+            if self._flush_greenlet:
+                self._flush_greenlet.kill(block=False)
             self._is_auto_flushing = False
+            self._flush_thread = None
+            self._drain_on_exit = False
+            return
+        self._last_telemetry = {}
+        self._aggregator.reset()
+        if isinstance(getattr(self, 'reporter', None), HttpReporter):
+            self.reporter = self._new_reporter()
+        if self._is_auto_flushing and self._flush_thread is not None:
+            interval = self._flush_thread.interval
+            self._is_auto_flushing = False
+            self._flush_thread = None
+            self._start_flush_thread(interval)
+
+    def stop(self, flush=False, timeout=5):
+        """
+        Stop flushing automatically. If *flush* is true, then send all the
+        metrics recorded so far, including those of the roll-up intervals still
+        open, along with whatever the statsd buffer and sender queue hold.
+        Sending is given up after *timeout* seconds.
+
+        Stopping with *flush* is done when the interpreter exits, unless
+        `drain_on_exit` was set to false in :meth:`start`.
+
+        Returns false if pending metrics could not all be sent in time.
+        """
+        deadline = time() + timeout
+        self._drain_on_exit = False
+        if self._is_auto_flushing:
+            if self._flush_thread:
+                self._flush_thread.end()
+                if flush and self._flush_thread is not threading.current_thread():
+                    self._flush_thread.join(timeout)
+            if self._flush_handle:
+                self._flush_handle.cancel()
+            if self._flush_greenlet:
+                self._flush_greenlet.kill(block=False)
+            self._is_auto_flushing = False
+        if flush and not self._disabled:
+            return self._drain(deadline)
+        return True
+
+    def _drain(self, deadline):
+        # Drain in another thread so a slow intake can't hold up the caller
+        # past the deadline.
+        def drain():
+            while self._is_flush_in_progress and time() < deadline:
+                sleep(0.01)
+            if self._is_statsd:
+                self._aggregator.drain(max(deadline - time(), 0))
+            else:
+                self.flush(force=True)
+        thread = threading.Thread(target=drain)
+        thread.daemon = True
+        try:
+            thread.start()
+        except RuntimeError:
+            # Some Python versions (3.12) can't start threads at interpreter
+            # shutdown, so drain from the exit hook itself, bounded by the
+            # transport's own timeouts instead.
+            drain()
             return True
+        thread.join(max(deadline - time(), 0))
+        if thread.is_alive():
+            log.warning("Gave up sending pending metrics after the drain timeout.")
+            return False
+        return True
 
 
     def gauge(self, metric_name, value, timestamp=None, tags=None, sample_rate=1, host=None):
@@ -115,7 +380,9 @@ class DogStatsApi(object):
         """
         Increment the counter by the given *value*. Optionally, specify a list of
         *tags* to associate with the metric. This is useful for counting things
-        such as incrementing a counter each time a page is requested.
+        such as incrementing a counter each time a page is requested. On hot
+        paths, set *sample_rate* to only record that fraction of calls; the
+        flushed count is scaled back up to compensate.
 
         >>> dog_stats_api.increment('home.page.hits')
         >>> dog_stats_api.increment('bytes.processed', file.size())
@@ -134,9 +401,76 @@ class DogStatsApi(object):
         >>> dog_stats_api.histogram('uploaded_file.size', uploaded_file.size())
         """
         if not self._disabled:
-            self._aggregator.add_point(metric_name, tags, timestamp or time(), value, Histogram,
+            self._aggregator.add_point(metric_name, tags, timestamp or time(), value, self._histogram_class,
                 sample_rate=sample_rate, host=host)
 
+    def bind(self, metric_name, metric_type, tags=None, host=None, sample_rate=1):
+        """
+        Return a handle on the metric with the given name, *tags* and *host*.
+        The handle skips the per-call work of looking the metric up, which makes
+        it the cheapest way to record the same metric from a hot loop. Its
+        *record(value)* method records a point and *increment(value=1)* is
+        an alias that reads better for counters. Points are kept with
+        probability *sample_rate*.
+
+        >>> hits = dog_stats_api.bind('home.page.hits', MetricType.Counter)
+        >>> hits.increment()
+        >>> latency = dog_stats_api.bind('db.query.time', MetricType.Histogram, tags=['db:users'])
+        >>> latency.record(duration)
+        """
+        if self._disabled:
+            return NullBoundMetric(metric_name, tags, None, host, sample_rate)
+        metric_class = {
+            MetricType.Gauge: Gauge,
+            MetricType.Counter: Counter,
+            MetricType.Histogram: self._histogram_class,
+        }[metric_type]
+        return self._aggregator.bind(metric_name, tags, metric_class, host, sample_rate)
+
+    def counter(self, metric_name, tags=None, host=None, sample_rate=1):
+        """
+        Return a handle on a counter. See :meth:`bind`.
+
+        >>> requests = dog_stats_api.counter('requests', tags=['handler:home'])
+        >>> requests.increment()
+        """
+        return self.bind(metric_name, MetricType.Counter, tags=tags, host=host,
+            sample_rate=sample_rate)
+
+    def event(self, title, text, alert_type=None, aggregation_key=None, source_type_name=None,
+              date_happened=None, priority=None, tags=None, host=None):
+        """
+        Send an event through the local agent. This never waits on the Datadog
+        API, but is only available in statsd mode; otherwise, post events with
+        :meth:`dogapi.http.DogHttpApi.event`.
+
+        >>> dog_stats_api.event('Deploy finished', 'Version 1.2 is live', alert_type='success')
+        """
+        if self._disabled:
+            return
+        if not self._is_statsd:
+            log.warning("Events can only be sent in statsd mode.")
+            return
+        self._aggregator.event(title, text, alert_type=alert_type,
+            aggregation_key=aggregation_key, source_type_name=source_type_name,
+            date_happened=date_happened, priority=priority, tags=tags, host=host)
+
+    def service_check(self, check, status, host=None, timestamp=None, message=None, tags=None):
+        """
+        Send a service check run through the local agent. *status* is one of
+        :class:`~dogapi.constants.CheckStatus`. Only available in statsd mode;
+        otherwise, use :meth:`dogapi.http.DogHttpApi.service_check`.
+
+        >>> dog_stats_api.service_check('app.can_connect', CheckStatus.OK, tags=['db:main'])
+        """
+        if self._disabled:
+            return
+        if not self._is_statsd:
+            log.warning("Service checks can only be sent in statsd mode.")
+            return
+        self._aggregator.service_check(check, host, status,
+            timestamp=timestamp, message=message, tags=tags)
+
     @contextmanager
     def timer(self, metric_name, sample_rate=1, tags=None, host=None):
         """
@@ -193,11 +527,19 @@ class DogStatsApi(object):
             return wrapped
         return wrapper
 
-    def flush(self, timestamp=None):
+    def flush(self, timestamp=None, force=False):
         """
         Flush and post all metrics to the server. Note that this is a blocking
         call, so it is likely not suitable for user facing processes. In those
         cases, it's probably best to flush in a thread or greenlet.
+
+        Only the roll-up intervals completed by *timestamp* (by default, now)
+        are flushed, unless *force* is true, in which case the open ones are
+        too.
+
+        Only detaching the completed intervals from the aggregator happens in
+        step with recording; roll-ups, serialization and posting work on the
+        detached buffers while new points keep landing in the open interval.
         """
         try:
             if not self._needs_flush:
@@ -210,7 +552,69 @@ class DogStatsApi(object):
                 return False
 
             self._is_flush_in_progress = True
-            metrics = self._get_aggregate_metrics(timestamp or time())
+            flush_start = time()
+            if self._is_statsd:
+                try:
+                    self._aggregator.flush(timestamp or flush_start, force)
+                finally:
+                    self._finish_flush(flush_start)
+                return True
+            if not force:
+                timestamp = timestamp or flush_start
+            self._flush_detached(self._detach(None if force else timestamp), flush_start)
+        except:
+            try:
+                log.exception("Error flushing metrics")
+            except:
+                pass
+        finally:
+            self._is_flush_in_progress = False
+
+    def get_telemetry(self):
+        """
+        Return a dictionary of counters describing the client's own overhead
+        and losses: points recorded, contexts and intervals in the last flush,
+        series, bytes and packets sent, HTTP and socket errors, points dropped
+        by context caps or a full statsd queue, and how long the last flush took.
+        Counts are cumulative since :meth:`start` and, when telemetry is
+        emitted, include the telemetry points themselves.
+
+        >>> dog_stats_api.get_telemetry()['http_errors']
+        0
+        """
+        telemetry = {
+            'flush_count': self.flush_count,
+            'flush_duration': self.last_flush_duration,
+            'detach_duration': self.last_detach_duration,
+        }
+        telemetry.update(self._aggregator.telemetry())
+        reporter = getattr(self, 'reporter', None)
+        if hasattr(reporter, 'telemetry'):
+            telemetry.update(reporter.telemetry())
+        return telemetry
+
+    def _record_telemetry(self):
+        """ Record the telemetry as metrics, which go out with the next flush. """
+        telemetry = self.get_telemetry()
+        last = self._last_telemetry
+        self._last_telemetry = telemetry
+        now = time()
+        for name in ('flush_duration', 'detach_duration', 'contexts'):
+            if name in telemetry:
+                self._aggregator.add_point('dogapi.client.%s' % name, None, now,
+                    telemetry[name], Gauge)
+        for name, value in telemetry.items():
+            if name in ('flush_count', 'flush_duration', 'detach_duration', 'contexts',
+                        'intervals'):
+                continue
+            delta = value - last.get(name, 0)
+            if delta:
+                self._aggregator.add_point('dogapi.client.%s' % name, None, now, delta, Counter)
+
+    def _flush_detached(self, detached, flush_start):
+        """ Roll up and post intervals detached from the aggregator. """
+        try:
+            metrics = self._rollup(detached)
             count = len(metrics)
             if count:
                 self.flush_count += 1
@@ -218,36 +622,69 @@ class DogStatsApi(object):
                 self.reporter.flush(metrics)
             else:
                 log.debug("No metrics to flush. Continuing.")
-        except:
-            try:
-                log.exception("Error flushing metrics")
-            except:
-                pass
         finally:
-            self._is_flush_in_progress = False
+            self._finish_flush(flush_start)
+
+    def _finish_flush(self, flush_start):
+        self.last_flush_duration = time() - flush_start
+        if self._emit_telemetry:
+            self._record_telemetry()
 
     def _get_aggregate_metrics(self, flush_time=None):
+        return self._rollup(self._detach(flush_time))
+
+    def _detach(self, flush_time):
+        # Detach the completed intervals first. This is the only step that
+        # touches state shared with the recording threads, so time it.
+        detach_start = time()
+        detached = self._aggregator.detach(flush_time)
+        self.last_detach_duration = time() - detach_start
+        self.max_detach_duration = max(self.max_detach_duration, self.last_detach_duration)
+        log.debug("Detached intervals in %.6fs" % self.last_detach_duration)
+        return detached
+
+    def _rollup(self, detached):
         # Get rolled up metrics
-        rolled_up_metrics = self._aggregator.flush(flush_time)
+        rolled_up_metrics = self._aggregator.rollup(detached)
 
         # FIXME: emit a dictionary from the aggregator
+        # Points of the same context from different intervals share a
+        # single series.
         metrics = []
+        series = {}
         for timestamp, value, name, tags, host in rolled_up_metrics:
             if host is None:
                 host = self.host
-            metric = {
-                'metric' : name,
-                'points' : [[timestamp, value]],
-                'type':    MetricType.Gauge,
-                'host':    host,
-                'device':  self.device,
-                'tags'  :  tags
-            }
-            metrics.append(metric)
+            key = (name, host, tuple(sorted(tags)) if tags else None)
+            metric = series.get(key)
+            if metric is None:
+                metric = series[key] = {
+                    'metric' : name,
+                    'points' : [],
+                    'type':    MetricType.Gauge,
+                    'host':    host,
+                    'device':  self.device,
+                    'tags'  :  tags
+                }
+                metrics.append(metric)
+            metric['points'].append([timestamp, value])
+        for metric in metrics:
+            if len(metric['points']) > 1:
+                metric['points'].sort()
         return metrics
 
-    def _start_flush_thread(self):
-        """ Start a thread to flush metrics. """
+    def _flush_schedule(self, interval):
+        """ Return the :class:`~dogapi.stats.periodic_timer.Schedule` of flushes every
+        *interval* seconds. Flushes of roll-ups are aligned to the roll-up intervals. """
+        from dogapi.stats.periodic_timer import Schedule
+        if interval != self.flush_interval:
+            # Flushes of the statsd buffer, which need no alignment.
+            return Schedule(interval)
+        return Schedule(interval, self.roll_up_interval, self.flush_jitter)
+
+    def _start_flush_thread(self, interval=None):
+        """ Start a thread to flush metrics, every `flush_interval` seconds
+        unless another *interval* is given. """
         from dogapi.stats.periodic_timer import PeriodicTimer
         if self._is_auto_flushing:
             log.info("Autoflushing already started.")
@@ -265,8 +702,10 @@ class DogStatsApi(object):
                 except:
                     pass
 
-        log.info("Starting flush thread with interval %s." % self.flush_interval)
-        self._flush_thread = PeriodicTimer(self.flush_interval, flush)
+        interval = interval or self.flush_interval
+        log.info("Starting flush thread with interval %s." % interval)
+        self._flush_thread = PeriodicTimer(interval, flush)
+        self._flush_thread.schedule = self._flush_schedule(interval)
         self._flush_thread.start()
 
     def _start_flush_greenlet(self):
@@ -276,13 +715,14 @@ class DogStatsApi(object):
         self._is_auto_flushing = True
 
         import gevent
+        schedule = self._flush_schedule(self.flush_interval)
         # A small helper for flushing.
         def flush():
             while True:
                 try:
+                    gevent.sleep(schedule.wait_time())
                     log.debug("Flushing metrics in greenlet")
                     self.flush()
-                    gevent.sleep(self.flush_interval)
                 except:
                     try:
                         log.exception("Error flushing in greenlet")
@@ -290,6 +730,125 @@ class DogStatsApi(object):
                         pass
 
         log.info("Starting flush greenlet with interval %s." % self.flush_interval)
-        gevent.spawn(flush)
+        self._flush_greenlet = gevent.spawn(flush)
+
+    def _start_flush_asyncio(self, loop):
+        """
+        Schedule flushes on the given asyncio event loop. Points recorded
+        from coroutines are recorded on the loop's thread, so the completed
+        intervals are detached and rolled up there, without racing any writer.
+        A reporter with a `flush_in_loop` method, such as the
+        :class:`~dogapi.stats.reporters.HttpReporter`, posts them over
+        connections the loop drives, so the loop never blocks on the network;
+        other reporters are run in the loop's default executor.
+        """
+        if self._is_auto_flushing:
+            log.info("Autoflushing already started.")
+            return
+        self._is_auto_flushing = True
+
+        schedule = self._flush_schedule(self.flush_interval)
+
+        def done(future, flush_start):
+            try:
+                if future.exception() is not None:
+                    log.error("Error posting metrics from asyncio: %r" % future.exception())
+            except:
+                pass
+            finally:
+                self._is_flush_in_progress = False
+                self._finish_flush(flush_start)
+
+        def flush():
+            self._flush_handle = loop.call_later(schedule.wait_time(), flush)
+            if self._is_flush_in_progress:
+                log.debug("A flush is already in progress. Skipping this one.")
+                return
+            try:
+                log.debug("Flushing metrics in asyncio")
+                flush_start = time()
+                metrics = self._rollup(self._detach(flush_start))
+                if not metrics:
+                    log.debug("No metrics to flush. Continuing.")
+                    self._finish_flush(flush_start)
+                    return
+                self.flush_count += 1
+                log.debug("Flush #%s sending %s metrics" % (self.flush_count, len(metrics)))
+                self._is_flush_in_progress = True
+                flush_in_loop = getattr(self.reporter, 'flush_in_loop', None)
+                if flush_in_loop is not None:
+                    future = flush_in_loop(metrics, loop)
+                else:
+                    future = loop.run_in_executor(None, self.reporter.flush, metrics)
+                future.add_done_callback(lambda future: done(future, flush_start))
+            except:
+                self._is_flush_in_progress = False
+                try:
+                    log.exception("Error flushing in asyncio")
+                except:
+                    pass
+
+        log.info("Scheduling asyncio flushes with interval %s." % self.flush_interval)
+        self._flush_handle = loop.call_later(schedule.wait_time(), flush)
+
+
+def _running_loop():
+    import asyncio
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError:
+        # Before Python 3.7.
+        loop = asyncio.get_event_loop()
+        if loop.is_running():
+            return loop
+    except RuntimeError:
+        pass
+    raise RuntimeError("Flushing in asyncio needs start() to be called from the "
+                       "running event loop")
+
+
+def _adopt_spools(spool, spool_path):
+    """ Move the spools that exited children left in *spool_path* into *spool*. """
+    if not hasattr(os, 'fork'):
+        # Only forked children spool in subdirectories.
+        return
+    try:
+        names = os.listdir(spool_path)
+    except OSError:
+        return
+    for name in names:
+        # Named after the pid of the child, then of each process that began
+        # adopting it.
+        owner = name.split('.')[-1]
+        path = os.path.join(spool_path, name)
+        if owner.isdigit() and os.path.isdir(path) and path != spool.path and \
+                not _is_alive(int(owner)):
+            try:
+                spool.adopt(path)
+            except Exception:
+                log.exception("Couldn't adopt spool %s" % path)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _drain_at_exit(ref):
+    dog = ref()
+    if dog is not None and dog._drain_on_exit:
+        dog.stop(flush=True, timeout=dog.drain_timeout)
+
+
+def _after_fork_in_child():
+    for ref in list(_clients):
+        dog = ref()
+        if dog is not None:
+            dog.after_fork()
 
 
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -5,8 +5,24 @@ Metric roll-up classes.
 
 from collections import defaultdict
 import random
+import threading
 import time
 
+from dogapi.constants import OverflowPolicy
+from dogapi.stats.sketch import DDSketch
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6. Only the LRU overflow policy needs it.
+    OrderedDict = None
+
+
+# The tags of the context that points are folded into once a metric has too
+# many contexts.
+OVERFLOW_TAGS = ['overflow']
+_OVERFLOW_KEY_TAGS = tuple(OVERFLOW_TAGS)
+
 
 class Metric(object):
     """
@@ -14,14 +30,19 @@ class Metric(object):
     and performs roll-ups within those intervals.
     """
 
-    def add_point(self, value):
-        """ Add a point to the given metric. """
+    def add_point(self, value, sample_rate=1):
+        """ Add a point to the given metric. *sample_rate* is the probability
+        with which the point was kept, so it stands for 1 / sample_rate points. """
         raise NotImplementedError()
 
     def flush(self, timestamp):
         """ Flush all metrics up to the given timestamp. """
         raise NotImplementedError()
 
+    def merge(self, other):
+        """ Fold the points of another metric of the same context into this one. """
+        raise NotImplementedError()
+
 
 class Gauge(Metric):
     """ A gauge metric. """
@@ -33,13 +54,21 @@ class Gauge(Metric):
         self.tags = tags
         self.host = host
         self.value = None
+        # When the value was last set, so merging keeps the most recent one.
+        self.updated = 0
 
-    def add_point(self, value):
+    def add_point(self, value, sample_rate=1):
         self.value = value
+        self.updated = time.time()
 
     def flush(self, timestamp):
         return [(timestamp, self.value, self.name, self.tags, self.host)]
 
+    def merge(self, other):
+        if other.value is not None and other.updated >= self.updated:
+            self.value = other.value
+            self.updated = other.updated
+
 class Counter(Metric):
     """ A counter metric. """
 
@@ -51,12 +80,39 @@ class Counter(Metric):
         self.host = host
         self.count = 0
 
-    def add_point(self, value):
-        self.count += value
+    def add_point(self, value, sample_rate=1):
+        if sample_rate == 1:
+            self.count += value
+        else:
+            self.count += value / float(sample_rate)
 
     def flush(self, timestamp):
         return [(timestamp, self.count, self.name, self.tags, self.host)]
 
+    def merge(self, other):
+        self.count += other.count
+
+
+class Set(Metric):
+    """ A set metric, which counts the unique values it's given. """
+
+    stats_tag = 's'
+
+    def __init__(self, name, tags, host):
+        self.name = name
+        self.tags = tags
+        self.host = host
+        self.values = set()
+
+    def add_point(self, value, sample_rate=1):
+        self.values.add(value)
+
+    def flush(self, timestamp):
+        return [(timestamp, len(self.values), self.name, self.tags, self.host)]
+
+    def merge(self, other):
+        self.values |= other.values
+
 
 class Histogram(Metric):
     """ A histogram metric. """
@@ -71,11 +127,13 @@ class Histogram(Metric):
         self.min = float("inf")
         self.sum = 0
         self.count = 0
+        # An estimate of the points dropped by sampling.
+        self.sampled_out = 0
         self.sample_size = 1000
         self.samples = []
         self.percentiles = [0.75, 0.85, 0.95, 0.99]
 
-    def add_point(self, value):
+    def add_point(self, value, sample_rate=1):
         self.max = self.max if self.max > value else value
         self.min = self.min if self.min < value else value
         self.sum += value
@@ -84,6 +142,8 @@ class Histogram(Metric):
         else:
             self.samples[random.randrange(0, self.sample_size)] = value
         self.count += 1
+        if sample_rate != 1:
+            self.sampled_out += 1.0 / sample_rate - 1
 
     def flush(self, timestamp):
         if not self.count:
@@ -91,45 +151,565 @@ class Histogram(Metric):
         metrics = [
             (timestamp, self.min,       '%s.min'   % self.name, self.tags, self.host),
             (timestamp, self.max,       '%s.max'   % self.name, self.tags, self.host),
-            (timestamp, self.count,     '%s.count' % self.name, self.tags, self.host),
+            (timestamp, self.count + self.sampled_out, '%s.count' % self.name, self.tags, self.host),
             (timestamp, self.average(), '%s.avg'   % self.name, self.tags, self.host)
         ]
-        length = len(self.samples)
-        self.samples.sort()
-        for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
+        for p, val in zip(self.percentiles, self.quantiles(self.percentiles)):
             name = '%s.%spercentile' % (self.name, int(p * 100))
             metrics.append((timestamp, val, name, self.tags, self.host))
         return metrics
 
+    def quantiles(self, qs):
+        """ Return the estimated values at each of the given quantiles. """
+        length = len(self.samples)
+        self.samples.sort()
+        return [self.samples[int(round(q * length - 1))] for q in qs]
+
+    def merge(self, other):
+        if not other.count:
+            return
+        self.max = self.max if self.max > other.max else other.max
+        self.min = self.min if self.min < other.min else other.min
+        self.sum += other.sum
+        self.sampled_out += other.sampled_out
+        samples = self.samples + other.samples
+        if len(samples) > self.sample_size:
+            # Keep each side's share of the reservoir proportional to the
+            # number of points it has seen.
+            total = self.count + other.count
+            mine = int(round(self.sample_size * float(self.count) / total))
+            mine = min(mine, len(self.samples))
+            theirs = min(self.sample_size - mine, len(other.samples))
+            samples = (random.sample(self.samples, mine) +
+                       random.sample(other.samples, theirs))
+        self.samples = samples
+        self.count += other.count
+
     def average(self):
         return float(self.sum) / self.count
 
 
+class SketchHistogram(Histogram):
+    """
+    A histogram metric backed by a :class:`~dogapi.stats.sketch.DDSketch`
+    rather than a reservoir of samples. It uses bounded memory, records points
+    in constant time and every percentile it reports is within
+    `relative_accuracy` of the true value.
+    """
+
+    relative_accuracy = 0.01
+    max_bins = 2048
+
+    def __init__(self, name, tags, host):
+        Histogram.__init__(self, name, tags, host)
+        self.samples = None
+        self.sketch = DDSketch(self.relative_accuracy, self.max_bins)
+
+    def add_point(self, value, sample_rate=1):
+        self.max = self.max if self.max > value else value
+        self.min = self.min if self.min < value else value
+        self.sum += value
+        self.sketch.add(value)
+        self.count += 1
+        if sample_rate != 1:
+            self.sampled_out += 1.0 / sample_rate - 1
+
+    def merge(self, other):
+        if not other.count:
+            return
+        self.max = self.max if self.max > other.max else other.max
+        self.min = self.min if self.min < other.min else other.min
+        self.sum += other.sum
+        self.sampled_out += other.sampled_out
+        self.sketch.merge(other.sketch)
+        self.count += other.count
+
+    def quantiles(self, qs):
+        # Clamp to the exact extremes, which the sketch can only approximate.
+        return [min(max(self.sketch.quantile(q), self.min), self.max) for q in qs]
+
+
 class MetricsAggregator(object):
     """
     A small class to handle the roll-ups of multiple metrics at once.
+
+    The number of contexts (unique name, host and tags) held for a roll-up
+    interval can be capped globally with *max_contexts* and for each metric
+    name with *max_contexts_per_metric*. Once a cap is reached, the
+    *overflow_policy* decides what happens to points of new contexts:
+
+    * ``OverflowPolicy.DROP`` discards them.
+    * ``OverflowPolicy.FOLD`` records them into a single context per metric
+      and host, tagged ``overflow``.
+    * ``OverflowPolicy.LRU`` folds the least recently used context into the
+      ``overflow`` context to make room for the new one.
     """
 
-    def __init__(self, roll_up_interval=10):
-        self._metrics = defaultdict(lambda: {})
+    def __init__(self, roll_up_interval=10, max_contexts=None, max_contexts_per_metric=None,
+                 overflow_policy=OverflowPolicy.DROP):
+        if overflow_policy not in OverflowPolicy.ALL:
+            raise ValueError("Unknown overflow policy %r, expected one of: %s"
+                % (overflow_policy, ', '.join(OverflowPolicy.ALL)))
+        self._lru = overflow_policy == OverflowPolicy.LRU
+        if self._lru and OrderedDict is None:
+            raise ValueError("The LRU overflow policy requires Python 2.7+")
+        self._metrics = defaultdict(OrderedDict if self._lru else dict)
         self._roll_up_interval = roll_up_interval
+        self._max_contexts = max_contexts
+        self._max_contexts_per_metric = max_contexts_per_metric
+        self._overflow_policy = overflow_policy
+        # The number of contexts of each metric name, by interval.
+        self._metric_counts = defaultdict(lambda: defaultdict(int))
+        self.dropped_points = 0
+        self.folded_points = 0
+        self.evicted_contexts = 0
+        self.points_recorded = 0
+        # Bumped every time contexts are taken out of the aggregator, so bound
+        # metrics can tell their cached context may be gone.
+        self.generation = 0
+        # The number of contexts and intervals in the last roll-up.
+        self.last_rollup_contexts = 0
+        self.last_rollup_intervals = 0
 
     def add_point(self, metric, tags, timestamp, value, metric_class, sample_rate=1, host=None):
-        # The sample rate is currently ignored for in process stuff
+        if sample_rate != 1 and random.random() >= sample_rate:
+            return
+        self.add_sampled_point(metric, tags, timestamp, value, metric_class, sample_rate, host)
+
+    def add_sampled_point(self, metric, tags, timestamp, value, metric_class, sample_rate=1,
+                          host=None):
+        """ Record a point that was kept with probability *sample_rate*, such
+        as one received from a statsd client, without sampling it again. """
+        self.points_recorded += 1
         interval = timestamp - timestamp % self._roll_up_interval
         key = (metric, host, tuple(sorted(tags)) if tags else tags)
-        if key not in self._metrics[interval]:
-            self._metrics[interval][key] = metric_class(metric, tags, host)
-        self._metrics[interval][key].add_point(value)
+        contexts = self._metrics[interval]
+        context = contexts.get(key)
+        if context is None:
+            context = self._new_context(interval, key, metric, tags, metric_class, host)
+            if context is None:
+                return
+        elif self._lru:
+            contexts[key] = contexts.pop(key)
+        context.add_point(value, sample_rate)
+
+    def bind(self, metric, tags, metric_class, host=None, sample_rate=1):
+        """ Return a :class:`BoundMetric` recording into the given context. """
+        return CachedBoundMetric(self, metric, tags, metric_class, host, sample_rate)
+
+    def get_context(self, interval, key, metric, tags, metric_class, host=None):
+        """ Return the metric object of a context within an interval, creating
+        it if needed. Returns None if the point should be dropped. """
+        contexts = self._metrics[interval]
+        context = contexts.get(key)
+        if context is None:
+            context = self._new_context(interval, key, metric, tags, metric_class, host)
+        elif self._lru:
+            contexts[key] = contexts.pop(key)
+        return context
+
+    def touch(self, interval, key):
+        """ Mark a context as the most recently used, for contexts recorded
+        into without :meth:`get_context`, such as those of bound metrics. """
+        contexts = self._metrics.get(interval)
+        if contexts is not None and key in contexts:
+            contexts[key] = contexts.pop(key)
+
+    def overflow_counts(self):
+        """ Return how many points and contexts the context caps have affected. """
+        return {
+            'dropped_points': self.dropped_points,
+            'folded_points': self.folded_points,
+            'evicted_contexts': self.evicted_contexts,
+        }
+
+    def telemetry(self):
+        """ Return counters describing the aggregator's own work. """
+        telemetry = self.overflow_counts()
+        telemetry['points_recorded'] = self.points_recorded
+        telemetry['contexts'] = self.last_rollup_contexts
+        telemetry['intervals'] = self.last_rollup_intervals
+        return telemetry
+
+    def _new_context(self, interval, key, metric, tags, metric_class, host):
+        contexts = self._metrics[interval]
+        per_metric = self._max_contexts_per_metric
+        if per_metric is not None:
+            metric_counts = self._metric_counts[interval]
+            metric_full = metric_counts[metric] >= per_metric
+        else:
+            metric_full = False
+        full = metric_full or (self._max_contexts is not None and
+                               len(contexts) >= self._max_contexts)
+        if full:
+            if self._overflow_policy == OverflowPolicy.DROP:
+                self.dropped_points += 1
+                return None
+            elif self._overflow_policy == OverflowPolicy.FOLD:
+                self.folded_points += 1
+                return self._overflow_context(contexts, metric, metric_class, host)
+            else:
+                self._evict(interval, metric if metric_full else None)
+        context = contexts[key] = metric_class(metric, tags, host)
+        if per_metric is not None:
+            metric_counts[metric] += 1
+        return context
+
+    def _overflow_context(self, contexts, metric, metric_class, host):
+        # Overflow contexts aren't counted against the caps, there is at most
+        # one per metric and host.
+        key = (metric, host, _OVERFLOW_KEY_TAGS)
+        context = contexts.get(key)
+        if context is None:
+            context = contexts[key] = metric_class(metric, list(OVERFLOW_TAGS), host)
+        return context
+
+    def _evict(self, interval, metric=None):
+        """ Fold the least recently used context of the interval (of the given
+        metric, if any) into its overflow context. """
+        contexts = self._metrics[interval]
+        for key in contexts:
+            if key[2] == _OVERFLOW_KEY_TAGS:
+                continue
+            if metric is None or key[0] == metric:
+                break
+        else:
+            return
+        context = contexts.pop(key)
+        # Bound metrics may still hold the evicted context.
+        self.generation += 1
+        if self._max_contexts_per_metric is not None:
+            self._metric_counts[interval][key[0]] -= 1
+        self.evicted_contexts += 1
+        overflow = self._overflow_context(contexts, key[0], type(context), key[1])
+        if type(overflow) is type(context):
+            overflow.merge(context)
+
+    def reset(self):
+        """ Drop everything recorded so far, such as the points a forked child
+        copied from its parent. Bound metrics stay bound. """
+        self._metrics.clear()
+        self._metric_counts.clear()
+        self.dropped_points = 0
+        self.folded_points = 0
+        self.evicted_contexts = 0
+        self.points_recorded = 0
+        self.last_rollup_contexts = 0
+        self.last_rollup_intervals = 0
+        self.generation += 1
 
     def flush(self, timestamp):
         """ Flush all metrics up to the given timestamp. """
+        return self.rollup(self.detach(timestamp))
+
+    def detach(self, timestamp):
+        """
+        Remove the intervals older than the one containing the given timestamp
+        (or, if it's None, all of them) and return them as a list of
+        (interval, contexts) pairs. Each interval is popped as a whole, so this
+        is cheap and recording carries on into the open interval while the
+        detached ones are rolled up.
+        """
+        if timestamp is None:
+            past_intervals = list(self._metrics)
+        else:
+            interval = timestamp - timestamp % self._roll_up_interval
+            past_intervals = [i for i in list(self._metrics) if i < interval]
+        self.generation += 1
+        for i in past_intervals:
+            self._metric_counts.pop(i, None)
+        return [(i, self._metrics.pop(i)) for i in past_intervals]
+
+    def rollup(self, detached):
+        """ Roll up intervals returned by :meth:`detach` into metric tuples. """
+        metrics = []
+        for i, contexts in detached:
+            for m in list(contexts.values()):
+                metrics += m.flush(i)
+        self.last_rollup_contexts = sum(len(contexts) for _, contexts in detached)
+        self.last_rollup_intervals = len(detached)
+        return metrics
+
+
+class MetricsShard(MetricsAggregator):
+    """
+    The slice of a :class:`ShardedMetricsAggregator` owned by a single thread.
+    Its lock is only ever contended by the flushing thread.
+    """
+
+    def __init__(self, roll_up_interval=10, **limits):
+        MetricsAggregator.__init__(self, roll_up_interval, **limits)
+        self.lock = threading.Lock()
+        self.thread = threading.current_thread()
+
+    def reset(self):
+        MetricsAggregator.reset(self)
+        # Another thread may have held the lock when the process forked.
+        self.lock = threading.Lock()
+
+
+class ShardedMetricsAggregator(object):
+    """
+    An aggregator for heavily threaded processes. Every thread records into
+    its own :class:`MetricsShard`, so recording a point never touches state
+    shared with other application threads. Flushing merges the shards interval
+    by interval.
+
+    Context caps (see :class:`MetricsAggregator`) apply to each shard.
+    """
+
+    def __init__(self, roll_up_interval=10, **limits):
+        self._roll_up_interval = roll_up_interval
+        self._limits = limits
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        # Telemetry counts of the shards that have been pruned.
+        self._pruned_counts = MetricsAggregator(roll_up_interval).telemetry()
+        self.last_rollup_contexts = 0
+        self.last_rollup_intervals = 0
+
+    def add_point(self, metric, tags, timestamp, value, metric_class, sample_rate=1, host=None):
+        if sample_rate != 1 and random.random() >= sample_rate:
+            return
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._new_shard()
         interval = timestamp - timestamp % self._roll_up_interval
-        past_intervals = [i for i in self._metrics if i < interval]
+        key = (metric, host, tuple(sorted(tags)) if tags else tags)
+        with shard.lock:
+            shard.points_recorded += 1
+            context = shard.get_context(interval, key, metric, tags, metric_class, host)
+            if context is not None:
+                context.add_point(value, sample_rate)
+
+    def bind(self, metric, tags, metric_class, host=None, sample_rate=1):
+        """ Return a :class:`BoundMetric` recording into the calling thread's
+        shard. """
+        return ShardedBoundMetric(self, metric, tags, metric_class, host, sample_rate)
+
+    def get_shard(self):
+        """ Return the calling thread's shard. """
+        try:
+            return self._local.shard
+        except AttributeError:
+            return self._new_shard()
+
+    def reset(self):
+        """ Drop everything recorded so far, such as the points a forked child
+        copied from its parent. The shards of the threads that didn't survive
+        the fork are forgotten on the next :meth:`detach`. """
+        self._shards_lock = threading.Lock()
+        for shard in self._shards:
+            shard.reset()
+        self._pruned_counts = MetricsAggregator(self._roll_up_interval).telemetry()
+        self.last_rollup_contexts = 0
+        self.last_rollup_intervals = 0
+
+    def flush(self, timestamp):
+        """ Flush all metrics up to the given timestamp. """
+        return self.rollup(self.detach(timestamp))
+
+    def detach(self, timestamp):
+        """
+        Pop the completed intervals (or, if the timestamp is None, all the
+        intervals) of every shard. Each shard's lock is only
+        held while its intervals are popped; merging happens in :meth:`rollup`.
+        """
+        with self._shards_lock:
+            shards = list(self._shards)
+        detached = []
+        for shard in shards:
+            with shard.lock:
+                detached += shard.detach(timestamp)
+        self._prune_shards(shards)
+        return detached
+
+    def rollup(self, detached):
+        """ Merge the shards' intervals returned by :meth:`detach` and roll
+        them up into metric tuples. """
+        merged = defaultdict(dict)
+        for i, contexts in detached:
+            interval_contexts = merged[i]
+            for key, m in contexts.items():
+                # Threads may record the same name as different types, which
+                # can't be merged.
+                key = key + (type(m),)
+                existing = interval_contexts.get(key)
+                if existing is None:
+                    interval_contexts[key] = m
+                else:
+                    existing.merge(m)
+
         metrics = []
-        for i in past_intervals:
-            for m in list(self._metrics.pop(i).values()):
+        for i, contexts in merged.items():
+            for m in contexts.values():
                 metrics += m.flush(i)
+        self.last_rollup_contexts = sum(len(contexts) for contexts in merged.values())
+        self.last_rollup_intervals = len(merged)
         return metrics
 
+    def overflow_counts(self):
+        """ Return how many points and contexts the context caps have affected. """
+        telemetry = self.telemetry()
+        return dict((name, telemetry[name])
+            for name in ('dropped_points', 'folded_points', 'evicted_contexts'))
+
+    def telemetry(self):
+        """ Return counters describing the aggregator's own work, summed over
+        all shards. """
+        with self._shards_lock:
+            shards = list(self._shards)
+        counts = dict(self._pruned_counts)
+        for shard in shards:
+            for name, count in self._shard_counts(shard).items():
+                counts[name] += count
+        counts['contexts'] = self.last_rollup_contexts
+        counts['intervals'] = self.last_rollup_intervals
+        return counts
+
+    def _shard_counts(self, shard):
+        counts = shard.overflow_counts()
+        counts['points_recorded'] = shard.points_recorded
+        return counts
+
+    def _new_shard(self):
+        shard = MetricsShard(self._roll_up_interval, **self._limits)
+        with self._shards_lock:
+            self._shards.append(shard)
+        self._local.shard = shard
+        return shard
+
+    def _prune_shards(self, shards):
+        """ Forget the shards of threads that have exited once they're empty. """
+        dead = [s for s in shards if not s.thread.is_alive() and not s._metrics]
+        if dead:
+            with self._shards_lock:
+                self._shards = [s for s in self._shards if s not in dead]
+                for shard in dead:
+                    for name, count in self._shard_counts(shard).items():
+                        self._pruned_counts[name] += count
+
+
+
+class BoundMetric(object):
+    """
+    A handle on a single metric context (name, tags and host), returned by
+    :meth:`DogStatsApi.bind`. The base class simply forwards every point to
+    its aggregator.
+    """
+
+    def __init__(self, aggregator, metric, tags, metric_class, host=None, sample_rate=1):
+        self._aggregator = aggregator
+        self.metric = metric
+        self.tags = tags
+        self.metric_class = metric_class
+        self.host = host
+        self.sample_rate = sample_rate
+
+    def record(self, value, timestamp=None):
+        """ Record a point with the given *value*. """
+        self._aggregator.add_point(self.metric, self.tags, timestamp or time.time(),
+            value, self.metric_class, sample_rate=self.sample_rate, host=self.host)
+
+    def increment(self, value=1, timestamp=None):
+        """ Record a point with the given *value*, 1 by default. """
+        self.record(value, timestamp)
+
+
+class NullBoundMetric(BoundMetric):
+    """ A bound metric that drops everything, used when collection is disabled. """
+
+    def __init__(self, metric=None, tags=None, metric_class=None, host=None, sample_rate=1):
+        BoundMetric.__init__(self, None, metric, tags, metric_class, host, sample_rate)
+
+    def record(self, value, timestamp=None):
+        pass
+
+
+class CachedBoundMetric(BoundMetric):
+    """
+    A bound metric that keeps a reference to the metric object of the current
+    roll-up interval, so recording a point only has to check the timestamp
+    is still within that interval and the aggregator's generation hasn't
+    changed since, meaning the context wasn't flushed or evicted.
+    """
+
+    def __init__(self, aggregator, metric, tags, metric_class, host=None, sample_rate=1):
+        BoundMetric.__init__(self, aggregator, metric, tags, metric_class, host, sample_rate)
+        self._roll_up_interval = aggregator._roll_up_interval
+        self._key = (metric, host, tuple(sorted(tags)) if tags else tags)
+        self._start = self._end = 0
+        self._generation = -1
+        self._context = None
+
+    def record(self, value, timestamp=None):
+        sample_rate = self.sample_rate
+        if sample_rate != 1 and random.random() >= sample_rate:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        aggregator = self._aggregator
+        aggregator.points_recorded += 1
+        if not (self._start <= timestamp < self._end and
+                self._generation == aggregator.generation):
+            if not self._resolve(timestamp):
+                return
+        elif aggregator._lru:
+            aggregator.touch(self._start, self._key)
+        self._context.add_point(value, sample_rate)
+
+    def _resolve(self, timestamp):
+        start = timestamp - timestamp % self._roll_up_interval
+        generation = self._aggregator.generation
+        self._context = self._aggregator.get_context(start, self._key,
+            self.metric, self.tags, self.metric_class, self.host)
+        if self._context is None:
+            # Dropped by a context cap; try again on the next point.
+            self._start = self._end = 0
+            return False
+        self._start = start
+        self._end = start + self._roll_up_interval
+        self._generation = generation
+        return True
+
+
+class ShardedBoundMetric(CachedBoundMetric):
+    """
+    A bound metric for a :class:`ShardedMetricsAggregator`. Each thread caches
+    the context of its own shard and records under that shard's lock.
+    """
+
+    def __init__(self, aggregator, metric, tags, metric_class, host=None, sample_rate=1):
+        CachedBoundMetric.__init__(self, aggregator, metric, tags, metric_class, host, sample_rate)
+        self._local = threading.local()
+
+    def record(self, value, timestamp=None):
+        sample_rate = self.sample_rate
+        if sample_rate != 1 and random.random() >= sample_rate:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        local = self._local
+        try:
+            shard = local.shard
+        except AttributeError:
+            shard = local.shard = self._aggregator.get_shard()
+            local.start = local.end = local.generation = 0
+        with shard.lock:
+            shard.points_recorded += 1
+            if not (local.start <= timestamp < local.end and
+                    local.generation == shard.generation):
+                start = timestamp - timestamp % self._roll_up_interval
+                local.context = shard.get_context(start, self._key,
+                    self.metric, self.tags, self.metric_class, self.host)
+                if local.context is None:
+                    local.start = local.end = 0
+                    return
+                local.start = start
+                local.end = start + self._roll_up_interval
+                local.generation = shard.generation
+            elif shard._lru:
+                shard.touch(local.start, self._key)
+            local.context.add_point(value, sample_rate)
@@ -3,15 +3,66 @@ A small class to run a task periodically in a thread.
 """
 
 
+from random import uniform
 from threading import Thread, Event
+from time import time
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python < 3.3
+    monotonic = time
+
+
+class Schedule(object):
+    """
+    The run times of a task that runs every `interval` seconds on the
+    multiples of `align` seconds of the wall clock (by default, `interval`),
+    shifted by a random offset of up to `jitter` seconds drawn once per
+    process, so that processes started together don't all run at once.
+
+    Run times are tracked on a monotonic clock and each one follows from the
+    previous one, so the time the task takes doesn't add up into drift and
+    wall clock adjustments don't shift the schedule. When the task overruns
+    past one or more run times, the missed runs are collapsed into one that
+    happens right away, and counted in `missed_runs`.
+    """
+
+    def __init__(self, interval, align=None, jitter=0):
+        assert interval > 0
+        self.interval = interval
+        self.align = align or interval
+        self.offset = uniform(0, min(jitter, self.align)) if jitter else 0
+        self.missed_runs = 0
+        self._deadline = None
+
+    def wait_time(self):
+        """ Return the number of seconds to wait until the next run. """
+        now = monotonic()
+        if self._deadline is None:
+            wait = self.align - (time() - self.offset) % self.align
+            self._deadline = now + wait
+        else:
+            self._deadline += self.interval
+            if self._deadline < now:
+                missed = int((now - self._deadline) // self.interval)
+                self.missed_runs += missed
+                self._deadline += missed * self.interval
+        return max(self._deadline - now, 0)
 
 
 class PeriodicTimer(Thread):
+    """
+    Calls `function` every `interval` seconds, as laid out by its `schedule`,
+    which can be replaced by any :class:`Schedule` before the thread starts.
+    """
+
     def __init__(self, interval, function, *args, **kwargs):
         Thread.__init__(self)
         self.daemon = True
         assert interval > 0
         self.interval = interval
+        self.schedule = Schedule(interval)
         assert function
         self.function = function
         self.args = args
@@ -38,7 +89,9 @@ class PeriodicTimer(Thread):
 
     def run(self):
         while True:
-            if not self._is_alive() or self.finished.isSet():
+            if not self._is_alive() or self.finished.is_set():
+                break
+            self.finished.wait(self.schedule.wait_time())
+            if self.finished.is_set():
                 break
-            self.finished.wait(self.interval)
             self.function(*self.args, **self.kwargs)
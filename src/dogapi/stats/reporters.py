@@ -2,8 +2,25 @@
 Reporter classes.
 """
 
+import logging
+import threading
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
 
 from dogapi import DogHttpApi
+from dogapi.exceptions import ApiError, HttpBackoff
+
+
+log = logging.getLogger('dd.dogapi')
 
 
 class Reporter(object):
@@ -11,14 +28,286 @@ class Reporter(object):
     def flush(self, metrics):
         raise NotImplementedError()
 
+    def telemetry(self):
+        """ Return counters describing the reporter's own work. """
+        return {}
+
 
 class HttpReporter(Reporter):
+    """
+    Posts series to the Datadog API. Series are split into request bodies of
+    at most `max_chunk_size` bytes, which are uploaded concurrently by up to
+    `upload_workers` threads. A chunk that fails is retried up to
+    `max_retries` times, `retry_delay` seconds apart, before its series are
+    counted as lost in `http_errors`. Chunks the API rejects aren't retried.
+    From an asyncio event loop, :meth:`flush_in_loop` does the same without
+    any thread.
+
+    Given a :class:`~dogapi.stats.spool.Spool`, chunks that couldn't reach
+    the API are spooled instead of lost, and replayed oldest first after a
+    flush that got through.
+
+    Set `compression` to one of :class:`~dogapi.constants.Compression` to
+    compress bodies of at least `compression_threshold` bytes.
+    """
 
-    def __init__(self, api_key=None, api_host=None):
-        self.dog = DogHttpApi(api_key=api_key, api_host=api_host)
+    def __init__(self, api_key=None, api_host=None, max_chunk_size=512 * 1024, upload_workers=4,
+                 max_retries=2, retry_delay=0.5, compression=None, compression_threshold=1024,
+                 spool=None):
+        # Errors are raised rather than swallowed so that failing to reach
+        # the API can be told from the API rejecting a payload.
+        self.dog = DogHttpApi(api_key=api_key, api_host=api_host, compression=compression,
+            compression_threshold=compression_threshold, swallow=False)
+        self.spool = spool
+        self.max_chunk_size = max_chunk_size
+        self.upload_workers = upload_workers
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.series_sent = 0
+        self.bytes_sent = 0
+        self.http_errors = 0
+        self.http_retries = 0
+        self._lock = threading.Lock()
 
     def flush(self, metrics):
-        self.dog.metrics(metrics)
+        """ Post the series and return the responses to each chunk. If a
+        chunk failed with an exception and there's no spool to keep it, the
+        first one is raised once all the chunks have been tried. """
+        chunks = list(self._chunks(metrics))
+        responses = [None] * len(chunks)
+        exceptions = []
+        if len(chunks) == 1:
+            self._upload(chunks, 0, responses, exceptions)
+        else:
+            todo = Queue()
+            for i in range(len(chunks)):
+                todo.put(i)
+            def work():
+                while True:
+                    try:
+                        i = todo.get_nowait()
+                    except Empty:
+                        return
+                    self._upload(chunks, i, responses, exceptions)
+            workers = [threading.Thread(target=work)
+                       for _ in range(min(self.upload_workers, len(chunks)))]
+            for worker in workers:
+                worker.daemon = True
+                worker.start()
+            for worker in workers:
+                worker.join()
+        if exceptions:
+            if self.spool is None:
+                raise exceptions[0]
+        elif self.spool is not None:
+            self.spool.replay(self._replay)
+        return responses
+
+    def flush_in_loop(self, metrics, loop):
+        """
+        Post the series like :meth:`flush` does, from the thread running the
+        asyncio *loop*. Chunks go over connections driven by the loop (see
+        :mod:`dogapi.stats.aio`), so the loop never waits on the network and
+        no thread is involved. Returns a future of the responses.
+        """
+        from dogapi.stats.aio import post
+        chunks = list(self._chunks(metrics))
+        responses = [None] * len(chunks)
+        exceptions = []
+        todo = list(range(len(chunks)))
+        todo.reverse()
+        result = loop.create_future()
+        uploads = [min(self.upload_workers, len(chunks))]
+
+        def finish(exception=None):
+            if result.done():
+                return
+            if exception is None:
+                result.set_result(responses)
+            else:
+                result.set_exception(exception)
+
+        def guard(callback):
+            # Fail the flush rather than leave it pending if a callback raises.
+            def guarded(*args):
+                try:
+                    callback(*args)
+                except Exception as e:
+                    finish(e)
+            return guarded
+
+        def upload_next():
+            if todo:
+                i = todo.pop()
+                body_sent, headers = self.dog.encode_body(chunks[i][1])
+                upload(i, body_sent, headers, 0)
+                return
+            uploads[0] -= 1
+            if uploads[0]:
+                return
+            if exceptions:
+                if self.spool is None:
+                    finish(exceptions[0])
+                    return
+            elif self.spool is not None:
+                replay_next()
+                return
+            finish()
+
+        def upload(i, body_sent, headers, attempt):
+            post(loop, self.dog, '/series', body_sent, headers).add_done_callback(
+                guard(lambda future: uploaded(i, body_sent, headers, attempt, future)))
+
+        def uploaded(i, body_sent, headers, attempt, future):
+            try:
+                response = future.result()
+            except ApiError as e:
+                response = _api_errors(e)
+            except HttpBackoff as e:
+                # Retrying would only be turned down too.
+                response = e
+            except Exception as e:
+                response = e
+                if attempt < self.max_retries:
+                    with self._lock:
+                        self.http_retries += 1
+                    loop.call_later(self.retry_delay * (attempt + 1), guard(upload), i,
+                        body_sent, headers, attempt + 1)
+                    return
+            self._finish_upload(chunks, i, body_sent, response, responses, exceptions)
+            upload_next()
+
+        def replay_next():
+            # Replay the spool oldest first, until a payload can't be sent.
+            payload = self.spool.peek()
+            if payload is None:
+                finish()
+                return
+            body, headers = self.dog.encode_body(payload.decode('utf-8'))
+            post(loop, self.dog, '/series', body, headers).add_done_callback(
+                guard(lambda future: replayed(payload, body, future)))
+
+        def replayed(payload, body, future):
+            try:
+                response = future.result()
+            except ApiError as e:
+                response = _api_errors(e)
+            except Exception:
+                finish()
+                return
+            self._count_replay(body, response)
+            self.spool.remove(payload)
+            replay_next()
+
+        for _ in range(uploads[0]):
+            upload_next()
+        return result
+
+    def telemetry(self):
+        telemetry = {
+            'series_sent': self.series_sent,
+            'bytes_sent': self.bytes_sent,
+            'http_errors': self.http_errors,
+            'http_retries': self.http_retries,
+        }
+        if self.spool is not None:
+            telemetry.update(self.spool.telemetry())
+        return telemetry
+
+    def _chunks(self, metrics):
+        """ Yield (series count, body) pairs of at most `max_chunk_size` bytes,
+        unless a single series is larger. """
+        # Serialize here rather than in DogHttpApi.metrics to know the size
+        # of what we send.
+        head, tail = '{"series": [', ']}'
+        parts = []
+        size = len(head) + len(tail)
+        for metric in metrics:
+            part = json.dumps(metric)
+            # Account for the separator.
+            part_size = len(part) + 2
+            if parts and size + part_size > self.max_chunk_size:
+                yield len(parts), head + ', '.join(parts) + tail
+                parts = []
+                size = len(head) + len(tail)
+            parts.append(part)
+            size += part_size
+        yield len(parts), head + ', '.join(parts) + tail
+
+    def _upload(self, chunks, i, responses, exceptions):
+        body_sent, headers = self.dog.encode_body(chunks[i][1])
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                with self._lock:
+                    self.http_retries += 1
+                time.sleep(self.retry_delay * attempt)
+            try:
+                response = self._post(body_sent, headers)
+            except HttpBackoff as e:
+                # Retrying would only be turned down too.
+                response = e
+                break
+            except Exception as e:
+                response = e
+                continue
+            break
+        self._finish_upload(chunks, i, body_sent, response, responses, exceptions)
+
+    def _finish_upload(self, chunks, i, body_sent, response, responses, exceptions):
+        # Count a chunk once it's been posted or given up on, spooling it in
+        # the latter case.
+        count, body = chunks[i]
+        failed = isinstance(response, Exception)
+        with self._lock:
+            if failed or _is_error(response):
+                self.http_errors += 1
+            else:
+                self.series_sent += count
+                # What went on the wire, which may be compressed.
+                self.bytes_sent += len(body_sent)
+        if not failed:
+            responses[i] = response
+            return
+        exceptions.append(response)
+        if self.spool is not None:
+            log.warning("Spooling %s series: %s" % (count, response))
+            self.spool.append(body)
+            responses[i] = {'errors': [str(response)]}
+
+    def _post(self, body, headers):
+        try:
+            return self.dog.http_request('POST', '/series', body, headers=headers)
+        except ApiError as e:
+            return _api_errors(e)
+
+    def _replay(self, body):
+        # Send a spooled body, dropping it if the API rejects it.
+        body, headers = self.dog.encode_body(body.decode('utf-8'))
+        try:
+            response = self._post(body, headers)
+        except Exception:
+            return False
+        self._count_replay(body, response)
+        return True
+
+    def _count_replay(self, body, response):
+        with self._lock:
+            if _is_error(response):
+                self.http_errors += 1
+            else:
+                self.bytes_sent += len(body)
+
+
+def _is_error(response):
+    return isinstance(response, dict) and 'errors' in response
+
+
+def _api_errors(e):
+    # The response of an ApiError, whose errors are logged.
+    for error in e.args[0]['errors']:
+        log.error(str(error))
+    return e.args[0]
+
 
 class GraphiteReporter(Reporter):
 
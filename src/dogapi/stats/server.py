@@ -0,0 +1,408 @@
+"""
+A lightweight DogStatsD compatible server, for hosts that can't run the
+agent. It receives statsd and DogStatsD datagrams over UDP, aggregates them
+in process and posts the roll-ups to Datadog like
+:class:`~dogapi.stats.DogStatsApi` does.
+
+>>> server = StatsdServer(port=8125, api_key='my_api_key')
+>>> server.serve_forever()
+"""
+
+from collections import defaultdict
+import logging
+import multiprocessing
+import select
+import signal
+import socket
+import threading
+from time import time
+
+from dogapi.stats.dog_stats_api import DogStatsApi
+from dogapi.stats.metrics import Counter, Gauge, MetricsAggregator, Set
+
+
+log = logging.getLogger('dd.dogapi')
+
+
+class StatsdServer(object):
+    """
+    Receives datagrams on *bind_host*:*port* and records their points into the
+    aggregator of a :class:`~dogapi.stats.DogStatsApi`, started with the other
+    keyword arguments, which flushes them. Only the in-process aggregation
+    modes are supported: `statsd`, `sharded` and `shared` can't be set.
+
+    Every datagram waiting on the socket, up to *batch_size*, is read at once
+    and stamped with the same time. Parsing the type, sample rate and tags of
+    a line is cached by metric name and suffix, so a known context only costs
+    converting its value. Events and service checks aren't supported and are
+    only counted, like lines that can't be parsed.
+
+    Set *reuse_port* to let other sockets bind the same port, see
+    :class:`ShardedStatsdServer`.
+
+    Batches are recorded while holding the server's `lock`, which detaching
+    intervals from the aggregator waits on, so a batch stamped just before
+    an interval ends never lands in an interval that was already detached.
+    """
+
+    # The number of (name, suffix) pairs whose parsed context is cached.
+    max_context_cache_size = 16384
+
+    # Whether to flush the pending metrics once done serving.
+    flush_on_shutdown = True
+
+    def __init__(self, bind_host='localhost', port=8125, max_packet_size=65536, batch_size=64,
+                 receive_buffer_size=4 * 1024 * 1024, reuse_port=False, **start_kwargs):
+        _check_modes(start_kwargs)
+        self.dog = DogStatsApi()
+        self.dog.start(**start_kwargs)
+        self.lock = threading.Lock()
+        self.dog._aggregator = _LockedAggregator(self.dog._aggregator, self.lock)
+        self.max_packet_size = max_packet_size
+        self.batch_size = batch_size
+        self.socket = _bind(bind_host, port, receive_buffer_size, reuse_port)
+        self.address = self.socket.getsockname()
+        self._types = {
+            b'c': Counter,
+            b'g': Gauge,
+            b'h': self.dog._histogram_class,
+            b'ms': self.dog._histogram_class,
+            b'd': self.dog._histogram_class,
+            b's': Set,
+        }
+        self._contexts = {}
+        self._running = False
+        self.packets_received = 0
+        self.parse_errors = 0
+        self.unsupported_lines = 0
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Receive and aggregate datagrams until :meth:`shutdown` is called,
+        checking for it every *poll_interval* seconds. The socket is then
+        closed and the pending metrics flushed.
+        """
+        sock = self.socket
+        sock.setblocking(False)
+        size = self.max_packet_size
+        self._running = True
+        try:
+            while self._running:
+                if not select.select([sock], [], [], poll_interval)[0]:
+                    continue
+                # Drain what's already waiting without blocking.
+                packets = []
+                try:
+                    while len(packets) < self.batch_size:
+                        packets.append(sock.recv(size))
+                except socket.error:
+                    pass
+                with self.lock:
+                    timestamp = time()
+                    for packet in packets:
+                        self.handle_packet(packet, timestamp)
+        finally:
+            sock.close()
+            self.dog.stop(flush=self.flush_on_shutdown)
+
+    def shutdown(self):
+        """ Make :meth:`serve_forever` return. """
+        self._running = False
+
+    def handle_packet(self, packet, timestamp):
+        """ Parse a datagram and record its points at the given timestamp. """
+        self.packets_received += 1
+        add_point = self.dog._aggregator.add_sampled_point
+        contexts = self._contexts
+        for line in packet.split(b'\n'):
+            name, _, rest = line.partition(b':')
+            value, _, suffix = rest.partition(b'|')
+            context = contexts.get((name, suffix))
+            try:
+                if context is None:
+                    context = self._parse_context(line, name, suffix)
+                    if context is None:
+                        continue
+                metric, metric_class, sample_rate, tags = context
+                if b':' in value:
+                    # Several values packed in one line.
+                    values = value.split(b':')
+                else:
+                    values = (value,)
+                for value in values:
+                    if metric_class is not Set:
+                        value = float(value)
+                    add_point(metric, tags, timestamp, value, metric_class, sample_rate)
+            except ValueError:
+                self.parse_errors += 1
+                log.debug("Couldn't parse statsd line %r" % line)
+
+    def telemetry(self):
+        """ Return the client's telemetry along with the server's counters. """
+        telemetry = self.dog.get_telemetry()
+        telemetry['packets_received'] = self.packets_received
+        telemetry['parse_errors'] = self.parse_errors
+        telemetry['unsupported_lines'] = self.unsupported_lines
+        return telemetry
+
+    def _parse_context(self, line, name, suffix):
+        # Return the (metric, class, sample rate, tags) of a line and cache
+        # them, or None for lines to skip.
+        if not line:
+            return None
+        if name.startswith(b'_e{') or name.startswith(b'_sc|'):
+            self.unsupported_lines += 1
+            return None
+        fields = suffix.split(b'|')
+        metric_class = self._types.get(fields[0])
+        if not name or metric_class is None:
+            raise ValueError('Unknown metric type')
+        sample_rate = 1
+        tags = None
+        for field in fields[1:]:
+            if field.startswith(b'@'):
+                sample_rate = float(field[1:])
+                if not 0 < sample_rate <= 1:
+                    raise ValueError('Invalid sample rate')
+            elif field.startswith(b'#'):
+                tags = field[1:].decode('utf-8').split(',')
+        context = (name.decode('utf-8'), metric_class, sample_rate, tags)
+        if len(self._contexts) >= self.max_context_cache_size:
+            self._contexts.clear()
+        self._contexts[(name, suffix)] = context
+        return context
+
+
+class ShardedStatsdServer(object):
+    """
+    Spreads receiving across *workers* processes (by default, one per CPU),
+    each running a :class:`StatsdServer` with its own aggregator, bound to the
+    same port with SO_REUSEPORT so the kernel balances senders between them.
+
+    At every flush, the parent's :class:`~dogapi.stats.DogStatsApi` (started
+    with the other keyword arguments) has each worker detach its completed
+    intervals and send them over a pipe, merges them context by context and
+    posts the roll-ups. A worker that doesn't answer within *reply_timeout*
+    seconds has its intervals merged into the next flush.
+    """
+
+    def __init__(self, bind_host='localhost', port=8125, workers=None, reply_timeout=5,
+                 max_packet_size=65536, batch_size=64, receive_buffer_size=4 * 1024 * 1024,
+                 **start_kwargs):
+        _check_modes(start_kwargs)
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError("The sharded statsd server needs SO_REUSEPORT")
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        worker_kwargs = dict(start_kwargs, flush_in_thread=False, drain_on_exit=False)
+        server_kwargs = {
+            'max_packet_size': max_packet_size,
+            'batch_size': batch_size,
+            'receive_buffer_size': receive_buffer_size,
+        }
+        self.address = (bind_host, port)
+        self.processes = []
+        connections = []
+        try:
+            # Fork the workers before starting the parent's flush thread. The
+            # first one binds the port, which may be picked by the system, and
+            # the others join it.
+            for _ in range(workers):
+                connection, worker_connection = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=_run_worker, args=(worker_connection,
+                    self.address, server_kwargs, worker_kwargs))
+                process.daemon = True
+                process.start()
+                worker_connection.close()
+                self.processes.append(process)
+                connections.append(connection)
+                status, result = connection.recv()
+                if status != 'ready':
+                    raise socket.error(result)
+                self.address = result
+        except:
+            for process in self.processes:
+                process.terminate()
+            raise
+        self.dog = DogStatsApi()
+        self.dog.start(**start_kwargs)
+        self.dog._aggregator = _WorkerPoolAggregator(self.dog.roll_up_interval, connections,
+            reply_timeout)
+        self._stopped = threading.Event()
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Wait until :meth:`shutdown` is called, checking for it every
+        *poll_interval* seconds, then stop the workers and flush everything
+        they received.
+        """
+        try:
+            while not self._stopped.is_set():
+                self._stopped.wait(poll_interval)
+        finally:
+            # The flush thread is the only other user of the workers' pipes,
+            # so it's done before they're stopped.
+            flush_thread = self.dog._flush_thread
+            self.dog.stop()
+            if flush_thread is not None:
+                flush_thread.join()
+            self.dog._aggregator.stop_workers()
+            for process in self.processes:
+                process.join(self.dog._aggregator.reply_timeout)
+            # Send what the workers handed over, open intervals included.
+            self.dog.stop(flush=True)
+
+    def shutdown(self):
+        """ Make :meth:`serve_forever` return. """
+        self._stopped.set()
+
+    def telemetry(self):
+        """ Return the client's telemetry along with the workers' counters,
+        as of their last flush. """
+        return self.dog.get_telemetry()
+
+
+class _LockedAggregator(object):
+    """ Wraps a :class:`StatsdServer`'s aggregator so that detaching waits
+    for the batch being recorded. """
+
+    def __init__(self, aggregator, lock):
+        self._aggregator = aggregator
+        self._lock = lock
+
+    def detach(self, timestamp):
+        with self._lock:
+            return self._aggregator.detach(timestamp)
+
+    def __getattr__(self, name):
+        return getattr(self._aggregator, name)
+
+
+class _WorkerPoolAggregator(MetricsAggregator):
+    """
+    Records the parent's own points, such as its telemetry, and merges in the
+    intervals detached by the workers of a :class:`ShardedStatsdServer`.
+    """
+
+    # The workers' counters summed into the telemetry.
+    worker_counters = ('points_recorded', 'dropped_points', 'folded_points', 'evicted_contexts',
+                       'packets_received', 'parse_errors', 'unsupported_lines')
+
+    def __init__(self, roll_up_interval, connections, reply_timeout):
+        MetricsAggregator.__init__(self, roll_up_interval)
+        self.connections = connections
+        self.reply_timeout = reply_timeout
+        self._replies = []
+        self._worker_telemetry = {}
+
+    def detach(self, timestamp):
+        detached = [MetricsAggregator.detach(self, timestamp)]
+        self._request(('detach', timestamp))
+        detached += self._replies
+        self._replies = []
+        merged = defaultdict(dict)
+        for intervals in detached:
+            for interval, contexts in intervals:
+                merged_contexts = merged[interval]
+                for key, context in contexts.items():
+                    # Workers may have received the same name as different
+                    # types, which can't be merged.
+                    key = key + (type(context),)
+                    existing = merged_contexts.get(key)
+                    if existing is None:
+                        merged_contexts[key] = context
+                    else:
+                        existing.merge(context)
+        return sorted(merged.items())
+
+    def stop_workers(self):
+        """ Have the workers stop and send everything they hold, which the
+        next :meth:`detach` merges. """
+        self._request(('stop', None))
+        self.connections = []
+
+    def telemetry(self):
+        telemetry = MetricsAggregator.telemetry(self)
+        for name in self.worker_counters:
+            telemetry[name] = telemetry.get(name, 0) + sum(
+                t.get(name, 0) for t in self._worker_telemetry.values())
+        return telemetry
+
+    def _request(self, message):
+        live = []
+        for connection in self.connections:
+            # Pick up the replies that came too late for the last request.
+            self._receive(connection, 0)
+            try:
+                connection.send(message)
+            except (IOError, OSError, EOFError):
+                log.warning("Lost a statsd worker")
+                continue
+            live.append(connection)
+        for connection in live:
+            if not self._receive(connection, self.reply_timeout):
+                log.warning("A statsd worker didn't send its metrics in time")
+
+    def _receive(self, connection, timeout):
+        received = False
+        try:
+            while connection.poll(timeout):
+                detached, telemetry = connection.recv()
+                self._replies.append(detached)
+                self._worker_telemetry[id(connection)] = telemetry
+                received = True
+                timeout = 0
+        except (IOError, OSError, EOFError):
+            pass
+        return received
+
+
+def _run_worker(connection, address, server_kwargs, start_kwargs):
+    # Interrupts are for the parent, which stops the workers in order.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        server = StatsdServer(address[0], address[1], reuse_port=True, **dict(server_kwargs,
+            **start_kwargs))
+    except Exception as e:
+        connection.send(('error', str(e)))
+        return
+    server.flush_on_shutdown = False
+    connection.send(('ready', server.address))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    aggregator = server.dog._aggregator
+    while True:
+        try:
+            command, timestamp = connection.recv()
+        except (EOFError, IOError):
+            command, timestamp = 'stop', None
+        if command == 'stop':
+            server.shutdown()
+            thread.join()
+        telemetry = server.telemetry()
+        try:
+            connection.send((aggregator.detach(timestamp), telemetry))
+        except (IOError, OSError):
+            return
+        if command == 'stop':
+            return
+
+
+def _check_modes(start_kwargs):
+    for mode in ('statsd', 'sharded', 'shared'):
+        if start_kwargs.get(mode):
+            raise ValueError("The statsd server doesn't support the %s mode" % mode)
+
+
+def _bind(bind_host, port, receive_buffer_size, reuse_port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if receive_buffer_size:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+        except socket.error:
+            log.warning("Couldn't set the receive buffer size to %s" % receive_buffer_size)
+    sock.bind((bind_host, port))
+    return sock
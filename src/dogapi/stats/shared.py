@@ -0,0 +1,346 @@
+"""
+Aggregation in a memory mapped region shared by the processes forked from
+the one that creates it, so that a pre-fork server sends one set of series
+per host rather than one per worker.
+
+Only Unix platforms share anonymous memory maps and file locks across forks,
+so this is only available there.
+"""
+
+from collections import defaultdict
+import fcntl
+import json
+import math
+import mmap
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+from hashlib import md5
+
+from dogapi.stats.metrics import BoundMetric, Counter, Gauge, MetricsAggregator, SketchHistogram
+from dogapi.stats.sketch import DDSketch
+
+
+_EMPTY = 0
+_USED = 1
+
+_GAUGE = 1
+_COUNTER = 2
+_HISTOGRAM = 3
+_KINDS = {Gauge: _GAUGE, Counter: _COUNTER}
+
+# State, kind, key length, key hash and interval.
+_HEAD = struct.Struct('<BBHQd')
+# The value, and for gauges when it was last set.
+_SCALAR = struct.Struct('<dd')
+_VALUE = struct.Struct('<d')
+# Count, points sampled out, sum, min, max and values counted as zero.
+_HISTOGRAM_HEAD = struct.Struct('<6d')
+_BIN = struct.Struct('<I')
+# Points recorded and dropped, for each stripe of each table.
+_STRIPE_COUNTS = struct.Struct('<QQ')
+
+
+class _StripeLocks(object):
+    """
+    A lock per stripe that holds across processes: an fcntl lock on a byte of
+    a file shared with the forked processes, which the kernel releases if its
+    holder dies, so a worker killed while recording can't hang the others.
+    fcntl locks belong to a whole process, so threads first take a lock of
+    their process's own.
+    """
+
+    def __init__(self, lock_file, first_byte, stripes):
+        self._fd = lock_file.fileno()
+        self._first_byte = first_byte
+        self._stripes = stripes
+        # Thread locks, by process, so a child never uses those copied from
+        # its parent, which threads that didn't survive the fork may hold.
+        self._thread_locks = {}
+
+    def acquire(self, stripe):
+        """ Lock a stripe and return what :meth:`release` needs to unlock it. """
+        pid = os.getpid()
+        thread_locks = self._thread_locks.get(pid)
+        if thread_locks is None:
+            thread_locks = self._thread_locks.setdefault(pid,
+                [threading.Lock() for _ in range(self._stripes)])
+        thread_lock = thread_locks[stripe]
+        thread_lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, self._first_byte + stripe)
+        except:
+            thread_lock.release()
+            raise
+        return thread_lock
+
+    def release(self, stripe, thread_lock):
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._first_byte + stripe)
+        finally:
+            thread_lock.release()
+
+
+class _Table(object):
+    """ A region of fixed size slots, split in stripes with a lock each. """
+
+    def __init__(self, offset, slot_size, slots, stripes, locks):
+        self.offset = offset
+        self.slot_size = slot_size
+        self.stripe_slots = max(1, int(math.ceil(float(slots) / stripes)))
+        self.locks = locks
+        self.size = slot_size * self.stripe_slots * stripes
+
+    def slot(self, stripe, i):
+        return self.offset + (stripe * self.stripe_slots + i) * self.slot_size
+
+
+class SharedMetricsAggregator(MetricsAggregator):
+    """
+    A :class:`~dogapi.stats.metrics.MetricsAggregator` whose points land in
+    shared memory, so that whichever process detaches the completed intervals
+    rolls them up for every process forked after it was created.
+
+    Counters and gauges are kept in `max_contexts` fixed size slots and
+    histograms in `max_histogram_contexts` slots that each hold a sketch with
+    fixed bins: percentiles are within `relative_accuracy` of the true value
+    for absolute values between `min_value` and `max_value`. The slots are
+    keyed by context and roll-up interval in hash tables split in `stripes`
+    stripes, each behind its own lock, so processes rarely wait on each other.
+
+    Points whose stripe is full, or whose context takes more than
+    `max_key_size` bytes, are dropped. Context caps beyond `max_contexts`
+    don't apply.
+    """
+
+    def __init__(self, roll_up_interval=10, max_contexts=8192, max_histogram_contexts=1024,
+                 stripes=16, max_key_size=256, relative_accuracy=0.02, min_value=1e-6,
+                 max_value=1e12):
+        MetricsAggregator.__init__(self, roll_up_interval)
+        self._stripes = stripes
+        self._max_key_size = max_key_size
+        self._relative_accuracy = relative_accuracy
+        self._min_value = min_value
+        multiplier = DDSketch(relative_accuracy)._multiplier
+        self._multiplier = multiplier
+        self._min_key = int(math.ceil(math.log(min_value) * multiplier))
+        self._bins = int(math.ceil(math.log(max_value) * multiplier)) - self._min_key + 1
+        self._bins_struct = struct.Struct('<%dI' % self._bins)
+
+        counts_size = 2 * stripes * _STRIPE_COUNTS.size
+        self._lock_file = tempfile.TemporaryFile()
+        self._scalars = _Table(counts_size, _slot_size(_SCALAR.size + max_key_size),
+            max_contexts, stripes, _StripeLocks(self._lock_file, 0, stripes))
+        self._histograms = _Table(self._scalars.offset + self._scalars.size,
+            _slot_size(_HISTOGRAM_HEAD.size + 2 * self._bins_struct.size + max_key_size),
+            max_histogram_contexts, stripes, _StripeLocks(self._lock_file, stripes, stripes))
+        self._map = mmap.mmap(-1, self._histograms.offset + self._histograms.size)
+        # This process's slots of each (interval, context, kind).
+        self._slots = {}
+
+    def add_point(self, metric, tags, timestamp, value, metric_class, sample_rate=1, host=None):
+        if sample_rate != 1 and random.random() >= sample_rate:
+            return
+        interval = timestamp - timestamp % self._roll_up_interval
+        kind = _KINDS.get(metric_class, _HISTOGRAM)
+        cache_key = (interval, metric, host, tuple(sorted(tags)) if tags else None, kind)
+        table = self._histograms if kind == _HISTOGRAM else self._scalars
+        m = self._map
+        cached = self._slots.get(cache_key)
+        if cached is None:
+            key = _encode_key(metric, host, cache_key[3])
+            key_hash = struct.unpack('<Q', md5(key).digest()[:8])[0]
+            stripe = key_hash % self._stripes
+            slot = None
+        else:
+            slot, stripe, key_hash = cached
+        lock = table.locks.acquire(stripe)
+        try:
+            if slot is not None:
+                state, _, _, slot_hash, slot_interval = _HEAD.unpack_from(m, slot)
+                if state != _USED or slot_hash != key_hash or slot_interval != interval:
+                    # Detached since; find it again.
+                    key = _encode_key(metric, host, cache_key[3])
+                    slot = None
+            if slot is None:
+                slot = self._find_slot(table, stripe, key, key_hash, interval, kind)
+                if slot is None:
+                    self._count(table, stripe, 0, 1)
+                    return
+                if len(self._slots) > 4 * (self._scalars.stripe_slots +
+                                           self._histograms.stripe_slots) * self._stripes:
+                    self._slots.clear()
+                self._slots[cache_key] = (slot, stripe, key_hash)
+            self._count(table, stripe, 1, 0)
+            offset = slot + _HEAD.size
+            if kind == _GAUGE:
+                _SCALAR.pack_into(m, offset, value, time.time())
+            elif kind == _COUNTER:
+                if sample_rate != 1:
+                    value = value / float(sample_rate)
+                _VALUE.pack_into(m, offset, _VALUE.unpack_from(m, offset)[0] + value)
+            else:
+                self._add_to_histogram(slot, value, sample_rate)
+        finally:
+            table.locks.release(stripe, lock)
+
+    def bind(self, metric, tags, metric_class, host=None, sample_rate=1):
+        return BoundMetric(self, metric, tags, metric_class, host, sample_rate)
+
+    def overflow_counts(self):
+        counts = MetricsAggregator.overflow_counts(self)
+        counts['dropped_points'] = self._total_counts()[1]
+        return counts
+
+    def telemetry(self):
+        self.points_recorded = self._total_counts()[0]
+        return MetricsAggregator.telemetry(self)
+
+    def detach(self, timestamp):
+        """
+        Take the intervals older than the one containing the given timestamp
+        (or, if it's None, all of them) out of shared memory and return them as
+        a list of (interval, contexts) pairs, like
+        :meth:`MetricsAggregator.detach` does.
+        """
+        if timestamp is not None:
+            timestamp -= timestamp % self._roll_up_interval
+        detached = defaultdict(dict)
+        m = self._map
+        for table in (self._scalars, self._histograms):
+            for stripe in range(self._stripes):
+                lock = table.locks.acquire(stripe)
+                try:
+                    for i in range(table.stripe_slots):
+                        slot = table.slot(stripe, i)
+                        state, kind, key_size, _, interval = _HEAD.unpack_from(m, slot)
+                        if state != _USED or (timestamp is not None and interval >= timestamp):
+                            continue
+                        context = self._read_slot(table, slot, kind, key_size)
+                        m[slot:slot + 1] = b'\0'
+                        # Slots of different kinds may share a name, but
+                        # can't be merged.
+                        key = (context.name, context.host,
+                               tuple(context.tags) if context.tags else None, kind)
+                        contexts = detached[interval]
+                        if key in contexts:
+                            # The same context can land in two slots when the
+                            # slot found first was freed in between.
+                            contexts[key].merge(context)
+                        else:
+                            contexts[key] = context
+                finally:
+                    table.locks.release(stripe, lock)
+        return sorted(detached.items())
+
+    def _find_slot(self, table, stripe, key, key_hash, interval, kind):
+        # Linear probing within the stripe, claiming the first free slot if
+        # the context has none yet.
+        if len(key) > self._max_key_size:
+            return None
+        m = self._map
+        key_offset = table.slot_size - self._max_key_size
+        start = (key_hash // self._stripes) % table.stripe_slots
+        for i in range(table.stripe_slots):
+            slot = table.slot(stripe, (start + i) % table.stripe_slots)
+            state, slot_kind, key_size, slot_hash, slot_interval = _HEAD.unpack_from(m, slot)
+            if state == _EMPTY:
+                self._claim(slot, key, key_hash, interval, kind, key_offset)
+                return slot
+            if (slot_hash == key_hash and slot_interval == interval and slot_kind == kind and
+                    m[slot + key_offset:slot + key_offset + key_size] == key):
+                return slot
+        return None
+
+    def _claim(self, slot, key, key_hash, interval, kind, key_offset):
+        m = self._map
+        m[slot + key_offset:slot + key_offset + len(key)] = key
+        offset = slot + _HEAD.size
+        if kind == _HISTOGRAM:
+            _HISTOGRAM_HEAD.pack_into(m, offset, 0, 0, 0, float('inf'), float('-inf'), 0)
+            offset += _HISTOGRAM_HEAD.size
+            size = 2 * self._bins_struct.size
+            m[offset:offset + size] = b'\0' * size
+        else:
+            _SCALAR.pack_into(m, offset, 0, 0)
+        # Mark the slot used last, once it's consistent.
+        _HEAD.pack_into(m, slot, _USED, kind, len(key), key_hash, interval)
+
+    def _add_to_histogram(self, slot, value, sample_rate):
+        m = self._map
+        offset = slot + _HEAD.size
+        count, sampled_out, total, low, high, zeros = _HISTOGRAM_HEAD.unpack_from(m, offset)
+        count += 1
+        if sample_rate != 1:
+            sampled_out += 1.0 / sample_rate - 1
+        bins = offset + _HISTOGRAM_HEAD.size
+        if value > self._min_value:
+            index = int(math.ceil(math.log(value) * self._multiplier))
+        elif value < -self._min_value:
+            index = int(math.ceil(math.log(-value) * self._multiplier))
+            bins += self._bins_struct.size
+        else:
+            index = None
+            zeros += 1
+        _HISTOGRAM_HEAD.pack_into(m, offset, count, sampled_out, total + value,
+            low if low < value else value, high if high > value else value, zeros)
+        if index is not None:
+            index = min(max(index - self._min_key, 0), self._bins - 1)
+            bin_offset = bins + index * _BIN.size
+            _BIN.pack_into(m, bin_offset, _BIN.unpack_from(m, bin_offset)[0] + 1)
+
+    def _read_slot(self, table, slot, kind, key_size):
+        m = self._map
+        key_offset = slot + table.slot_size - self._max_key_size
+        metric, host, tags = json.loads(m[key_offset:key_offset + key_size].decode('utf-8'))
+        offset = slot + _HEAD.size
+        if kind == _GAUGE:
+            context = Gauge(metric, tags, host)
+            context.value, context.updated = _SCALAR.unpack_from(m, offset)
+        elif kind == _COUNTER:
+            context = Counter(metric, tags, host)
+            context.count = _VALUE.unpack_from(m, offset)[0]
+        else:
+            context = SketchHistogram(metric, tags, host)
+            (count, context.sampled_out, context.sum, context.min, context.max,
+                zeros) = _HISTOGRAM_HEAD.unpack_from(m, offset)
+            context.count = int(count)
+            sketch = context.sketch = DDSketch(self._relative_accuracy)
+            offset += _HISTOGRAM_HEAD.size
+            for bins, offset in ((sketch.positive_bins, offset),
+                                 (sketch.negative_bins, offset + self._bins_struct.size)):
+                for i, n in enumerate(self._bins_struct.unpack_from(m, offset)):
+                    if n:
+                        bins[self._min_key + i] = n
+            sketch.zero_count = int(zeros)
+            sketch.count = context.count
+        return context
+
+    def _count(self, table, stripe, recorded, dropped):
+        # Called with the stripe's lock held.
+        offset = ((table is self._histograms) * self._stripes + stripe) * _STRIPE_COUNTS.size
+        total_recorded, total_dropped = _STRIPE_COUNTS.unpack_from(self._map, offset)
+        _STRIPE_COUNTS.pack_into(self._map, offset, total_recorded + recorded,
+            total_dropped + dropped)
+
+    def _total_counts(self):
+        recorded = dropped = 0
+        for i in range(2 * self._stripes):
+            stripe_recorded, stripe_dropped = _STRIPE_COUNTS.unpack_from(self._map,
+                i * _STRIPE_COUNTS.size)
+            recorded += stripe_recorded
+            dropped += stripe_dropped
+        return recorded, dropped
+
+
+def _slot_size(body_size):
+    # Keep slots 8 byte aligned.
+    size = _HEAD.size + body_size
+    return size + -size % 8
+
+
+def _encode_key(metric, host, tags):
+    return json.dumps([metric, host, list(tags) if tags else None]).encode('utf-8')
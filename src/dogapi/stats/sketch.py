@@ -0,0 +1,90 @@
+"""
+A mergeable quantile sketch with relative error guarantees, modelled on
+DDSketch (http://www.vldb.org/pvldb/vol12/p2195-masson.pdf).
+
+Values are mapped to logarithmically sized buckets, so every quantile the
+sketch returns is within `relative_accuracy` of the true value, memory is
+bounded by `max_bins` and two sketches with the same accuracy can be merged
+by adding their bucket counts.
+"""
+
+
+from math import ceil, log
+
+
+class DDSketch(object):
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048, min_value=1e-9):
+        assert 0 < relative_accuracy < 1
+        assert max_bins > 0
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._multiplier = 1 / log(self.gamma)
+        self.positive_bins = {}
+        self.negative_bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        """ Add a value to the sketch. """
+        if value > self.min_value:
+            bins = self.positive_bins
+            key = int(ceil(log(value) * self._multiplier))
+        elif value < -self.min_value:
+            bins = self.negative_bins
+            key = int(ceil(log(-value) * self._multiplier))
+        else:
+            self.zero_count += 1
+            self.count += 1
+            return
+        bins[key] = bins.get(key, 0) + 1
+        self.count += 1
+        if len(bins) > self.max_bins:
+            self._collapse(bins)
+
+    def merge(self, other):
+        """ Fold the counts of another sketch into this one. """
+        if other.gamma != self.gamma:
+            raise ValueError("Can't merge sketches with different accuracies")
+        for bins, other_bins in ((self.positive_bins, other.positive_bins),
+                                 (self.negative_bins, other.negative_bins)):
+            for key, count in other_bins.items():
+                bins[key] = bins.get(key, 0) + count
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, q):
+        """ Return an estimate of the value at quantile *q* (between 0 and 1). """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative_bins, reverse=True):
+            seen += self.negative_bins[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zero_count
+        if seen > rank:
+            return 0
+        for key in sorted(self.positive_bins):
+            seen += self.positive_bins[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive_bins))
+
+    def _value(self, key):
+        # The bucket midpoint that minimizes the relative error.
+        return 2 * self.gamma ** key / (1 + self.gamma)
+
+    def _collapse(self, bins):
+        # Fold the buckets closest to zero into each other. Those hold the
+        # smallest absolute values, which matter least for latencies and sizes.
+        keys = sorted(bins)
+        excess = len(keys) - self.max_bins
+        target = keys[excess]
+        for key in keys[:excess]:
+            bins[target] += bins.pop(key)
@@ -0,0 +1,217 @@
+"""
+A size-capped, append-only spool of payloads on disk, which holds the series
+that couldn't be posted until the API can be reached again.
+
+Payloads are appended to segment files named after their sequence number, as
+records made of a 4 byte big-endian length and the payload itself, so a
+segment can be scanned (or mapped in memory) without any other index. Once
+the spool grows past `max_size`, its oldest segments are dropped. Payloads
+are replayed oldest first and a segment is deleted once all its payloads have
+been replayed.
+
+The replay position within the oldest segment is only kept in memory, so
+after a restart the payloads of a partly replayed segment are sent again.
+
+A spool belongs to a single process. The spool left behind by a process that
+has exited can be moved into another one with :meth:`Spool.adopt`.
+"""
+
+import logging
+import os
+import shutil
+import struct
+import threading
+
+
+log = logging.getLogger('dd.dogapi')
+
+
+_HEADER = struct.Struct('>I')
+_SUFFIX = '.spool'
+
+
+class Spool(object):
+
+    def __init__(self, path, max_size=64 * 1024 * 1024, segment_size=1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self.spooled_payloads = 0
+        self.replayed_payloads = 0
+        self.dropped_payloads = 0
+        self._lock = threading.Lock()
+        self._writer = None
+        # The position of the next payload to replay in the oldest segment.
+        self._read_offset = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._segments = sorted(int(name[:-len(_SUFFIX)]) for name in os.listdir(path)
+                                if name.endswith(_SUFFIX) and name[:-len(_SUFFIX)].isdigit())
+        self._sizes = {}
+        for seq in self._segments:
+            self._sizes[seq] = os.path.getsize(self._segment_path(seq))
+        if self._segments:
+            self._repair(self._segments[-1])
+
+    @property
+    def size(self):
+        """ The number of bytes on disk. """
+        return sum(self._sizes.values())
+
+    def __len__(self):
+        """ The number of payloads waiting to be replayed. """
+        with self._lock:
+            count = 0
+            for seq in self._segments:
+                offset = self._read_offset if seq == self._segments[0] else 0
+                count += len(self._scan(seq, offset))
+            return count
+
+    def append(self, payload):
+        """ Add a payload (bytes or text) to the newest segment. """
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        record = _HEADER.pack(len(payload)) + payload
+        with self._lock:
+            if (not self._segments or
+                    0 < self._sizes[self._segments[-1]] and
+                    self.segment_size < self._sizes[self._segments[-1]] + len(record)):
+                self._new_segment()
+            seq = self._segments[-1]
+            if self._writer is None:
+                self._writer = open(self._segment_path(seq), 'ab')
+            self._writer.write(record)
+            self._writer.flush()
+            self._sizes[seq] += len(record)
+            self.spooled_payloads += 1
+            while len(self._segments) > 1 and self.size > self.max_size:
+                dropped = self._segments[0]
+                self.dropped_payloads += len(self._scan(dropped, self._read_offset))
+                log.warning("Metrics spool is full, dropping segment %s" % dropped)
+                self._remove_oldest()
+
+    def replay(self, send):
+        """
+        Call *send* with each payload, oldest first, until it returns false.
+        Payloads are removed once sent. Returns the number of payloads sent.
+        """
+        sent = 0
+        while True:
+            payload = self.peek()
+            if payload is None or not send(payload):
+                return sent
+            self.remove(payload)
+            sent += 1
+
+    def peek(self):
+        """ Return the oldest payload, or None if there's none. """
+        with self._lock:
+            return self._peek()
+
+    def remove(self, payload):
+        """ Remove the oldest payload, returned by :meth:`peek`, once it's
+        been sent. """
+        with self._lock:
+            self._read_offset += _HEADER.size + len(payload)
+            self.replayed_payloads += 1
+
+    def adopt(self, path):
+        """
+        Move the payloads of the spool at *path*, left by a process that has
+        exited, into this one, oldest first, and remove it. The directory is
+        renamed after this process first, so a spool is only ever adopted
+        once. Returns the number of payloads moved, or None if the spool was
+        gone.
+        """
+        claimed = '%s.%s' % (path, os.getpid())
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            # Adopted by another process in the meantime.
+            return None
+        orphan = Spool(claimed, segment_size=self.segment_size)
+        moved = orphan.replay(lambda payload: self.append(payload) or True)
+        shutil.rmtree(claimed, ignore_errors=True)
+        log.info("Adopted %s payloads from spool %s" % (moved, path))
+        return moved
+
+    def telemetry(self):
+        return {
+            'spooled_payloads': self.spooled_payloads,
+            'replayed_payloads': self.replayed_payloads,
+            'spool_dropped_payloads': self.dropped_payloads,
+        }
+
+    def _peek(self):
+        # Return the oldest payload, removing the segments that have been
+        # replayed entirely along the way.
+        while self._segments:
+            seq = self._segments[0]
+            with open(self._segment_path(seq), 'rb') as f:
+                f.seek(self._read_offset)
+                header = f.read(_HEADER.size)
+                if len(header) == _HEADER.size:
+                    length, = _HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) == length:
+                        return payload
+            if len(self._segments) == 1 and self._read_offset < self._sizes[seq]:
+                # Part of a record the writer hasn't finished.
+                return None
+            self._remove_oldest()
+        return None
+
+    def _scan(self, seq, offset=0):
+        # The offsets of the complete records of a segment.
+        offsets = []
+        with open(self._segment_path(seq), 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    return offsets
+                length, = _HEADER.unpack(header)
+                if len(f.read(length)) < length:
+                    return offsets
+                offsets.append(offset)
+                offset += _HEADER.size + length
+
+    def _repair(self, seq):
+        # Cut off a record torn by a crash in the middle of a write, which
+        # would throw off every record appended after it.
+        offsets = self._scan(seq)
+        end = 0
+        if offsets:
+            with open(self._segment_path(seq), 'rb') as f:
+                f.seek(offsets[-1])
+                length, = _HEADER.unpack(f.read(_HEADER.size))
+            end = offsets[-1] + _HEADER.size + length
+        if end < self._sizes[seq]:
+            log.warning("Truncating torn record at the end of spool segment %s" % seq)
+            with open(self._segment_path(seq), 'r+b') as f:
+                f.truncate(end)
+            self._sizes[seq] = end
+
+    def _new_segment(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        seq = self._segments[-1] + 1 if self._segments else 0
+        open(self._segment_path(seq), 'wb').close()
+        self._segments.append(seq)
+        self._sizes[seq] = 0
+
+    def _remove_oldest(self):
+        seq = self._segments.pop(0)
+        del self._sizes[seq]
+        self._read_offset = 0
+        if not self._segments and self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        try:
+            os.remove(self._segment_path(seq))
+        except OSError:
+            log.exception("Couldn't remove spool segment %s" % seq)
+
+    def _segment_path(self, seq):
+        return os.path.join(self.path, '%016d%s' % (seq, _SUFFIX))
@@ -1,35 +1,379 @@
-
-
 import logging
 import socket
+import threading
 from random import random
+from time import time
+
+from dogapi.constants import CheckStatus
+from dogapi.exceptions import ApiError
+from dogapi.stats.metrics import BoundMetric, Counter, Gauge, MetricsAggregator
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
 
 
 logger = logging.getLogger('dd.dogapi')
 
 
+# Queued to make the sender thread flush its buffer.
+_FLUSH = object()
+
+
+class _Drain(object):
+    """ Queued to make the sender thread flush its buffer and report back. """
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
 class StatsdAggregator(object):
+    """
+    Forwards points to a statsd server over UDP or, when a *socket_path* is
+    given, over a Unix domain datagram socket. The latter skips the IP stack
+    entirely and, since the kernel can tell a local reader is slow, blocks the
+    sender instead of silently dropping datagrams.
+
+    By default every point is sent in its own datagram. Set *max_buffer_size*
+    to pack newline separated points into datagrams of up to that many bytes
+    (1432 fits the typical Ethernet MTU, Unix sockets handle 8192 comfortably).
+    A buffer is sent when the next point wouldn't fit, when it's older than
+    *max_buffer_delay* seconds or when :meth:`flush` is called.
+
+    Set *sender_queue_size* to hand points over to a background thread through
+    a queue of that size; formatting and sending then happen on that thread and
+    recording a point only costs enqueuing it. When the queue is full, points
+    are dropped and counted in `dropped_points`.
+
+    The encoded prefix (name) and suffix (type, sample rate and tags) of each
+    context are cached, so formatting a point only has to encode its value.
+    """
 
+    # The number of contexts whose encoded prefix and suffix are cached.
+    max_format_cache_size = 4096
 
-    def __init__(self, host='localhost', port=8125):
+    def __init__(self, host='localhost', port=8125, max_buffer_size=None, max_buffer_delay=1,
+                 socket_path=None, sender_queue_size=None):
         self.host = host
         self.port = int(port)
-        self.address = (self.host, self.port)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket_path = socket_path
+        if socket_path is not None:
+            self.address = socket_path
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        else:
+            self.address = (self.host, self.port)
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket_sendto = self.socket.sendto
+        self.max_buffer_size = max_buffer_size
+        self.max_buffer_delay = max_buffer_delay
+        self._buffer = []
+        self._buffer_size = 0
+        self._buffer_deadline = None
+        self._buffer_lock = threading.Lock()
+        self.dropped_points = 0
+        self.points_recorded = 0
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.send_errors = 0
+        self._format_cache = {}
+        self._queue = None
+        if sender_queue_size is not None:
+            self._start_sender(sender_queue_size)
 
     def add_point(self, metric, tags, timestamp, value, metric_class, sample_rate=1, host=None):
         if sample_rate == 1 or random() < sample_rate:
-            payload = '%s:%s|%s' % (metric, value, metric_class.stats_tag)
-            if host is not None:
-                if not tags:
-                    tags = []
-                tags.append('host:%s' % host)
-            if sample_rate != 1:
-                payload += '|@%s' % sample_rate
-            if tags:
-                payload += '|#' + ','.join(tags)
+            self.points_recorded += 1
+            if self._queue is not None:
+                try:
+                    self._queue.put_nowait((metric, tags, value, metric_class, sample_rate, host))
+                except Full:
+                    self.dropped_points += 1
+            else:
+                self._submit(self._format(metric, tags, value, metric_class, sample_rate, host))
+
+    def bind(self, metric, tags, metric_class, host=None, sample_rate=1):
+        return BoundMetric(self, metric, tags, metric_class, host, sample_rate)
+
+    def event(self, title, text, alert_type=None, aggregation_key=None, source_type_name=None,
+              date_happened=None, priority=None, tags=None, host=None):
+        """
+        Send an event to the agent, which posts it to Datadog. Takes the same
+        arguments as :meth:`~dogapi.http.events.EventApi.event`, along with
+        *alert_type* ("error", "warning", "info" or "success").
+        """
+        title = _encode(title)
+        text = _encode(text).replace(b'\n', b'\\n')
+        payload = '_e{%d,%d}:' % (len(title), len(text))
+        payload = _encode(payload) + title + b'|' + text
+        fields = [('d', date_happened and int(date_happened)), ('h', host),
+                  ('k', aggregation_key), ('p', priority), ('s', source_type_name),
+                  ('t', alert_type)]
+        for name, value in fields:
+            if value is not None:
+                payload += _encode('|%s:%s' % (name, value))
+        if tags:
+            payload += _encode('|#' + ','.join(tags))
+        self._submit_raw(payload)
+
+    def service_check(self, check, host, status, timestamp=None, message=None, tags=None):
+        """
+        Send a service check run to the agent. Takes the same arguments as
+        :meth:`~dogapi.http.service_check.ServiceCheckApi.service_check`.
+        """
+        if status not in CheckStatus.ALL:
+            raise ApiError('Invalid status, expected one of: %s'
+                % ', '.join(map(str, CheckStatus.ALL)))
+        payload = '_sc|%s|%s' % (check, status)
+        if timestamp is not None:
+            payload += '|d:%s' % int(timestamp)
+        if host is not None:
+            payload += '|h:%s' % host
+        if tags:
+            payload += '|#' + ','.join(tags)
+        payload = _encode(payload)
+        if message:
+            # The message comes last and can't contain raw newlines or what
+            # would look like another field.
+            message = _encode(message).replace(b'\n', b'\\n').replace(b'm:', b'm\\:')
+            payload += b'|m:' + message
+        self._submit_raw(payload)
+
+    def telemetry(self):
+        """ Return counters describing the aggregator's own work. """
+        return {
+            'points_recorded': self.points_recorded,
+            'packets_sent': self.packets_sent,
+            'bytes_sent': self.bytes_sent,
+            'send_errors': self.send_errors,
+            'queue_dropped_points': self.dropped_points,
+        }
+
+    def reset(self):
+        """ Drop the buffered and queued points and restart the sender thread,
+        if any, e.g. in a forked child, where the thread doesn't survive. The
+        socket is kept. """
+        self._buffer = []
+        self._buffer_size = 0
+        self._buffer_deadline = None
+        self._buffer_lock = threading.Lock()
+        self.dropped_points = 0
+        self.points_recorded = 0
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.send_errors = 0
+        if self._queue is not None:
+            self._start_sender(self._queue.maxsize)
+
+    def flush(self, timestamp=None, force=False):
+        """ Send any buffered points. With a sender thread, this only asks the
+        thread to flush once it gets through the points queued so far. """
+        if self._queue is not None:
+            try:
+                self._queue.put_nowait(_FLUSH)
+            except Full:
+                pass
+        else:
+            with self._buffer_lock:
+                self._flush_buffer()
+
+    def drain(self, timeout=None):
+        """
+        Send all the points recorded so far, waiting up to *timeout* seconds
+        for the sender thread, if any, to get through its queue. Returns false
+        if it didn't.
+        """
+        if self._queue is None:
+            self.flush()
+            return True
+        start = time()
+        drain = _Drain()
+        try:
+            self._queue.put(drain, timeout=timeout)
+        except Full:
+            return False
+        if timeout is not None:
+            timeout = max(start + timeout - time(), 0)
+        drain.done.wait(timeout)
+        return drain.done.is_set()
+
+    def _format(self, metric, tags, value, metric_class, sample_rate, host):
+        key = (metric, metric_class.stats_tag, sample_rate, tuple(tags) if tags else None, host)
+        try:
+            prefix, suffix = self._format_cache[key]
+        except KeyError:
+            prefix, suffix = self._format_context(metric, tags, metric_class, sample_rate, host)
+            if len(self._format_cache) >= self.max_format_cache_size:
+                self._format_cache.clear()
+            self._format_cache[key] = (prefix, suffix)
+        value = str(value)
+        if not isinstance(value, bytes):
+            value = value.encode('ascii')
+        return prefix + value + suffix
+
+    def _format_context(self, metric, tags, metric_class, sample_rate, host):
+        """ Return the encoded parts of a payload before and after the value. """
+        suffix = '|%s' % metric_class.stats_tag
+        if host is not None:
+            tags = list(tags or []) + ['host:%s' % host]
+        if sample_rate != 1:
+            suffix += '|@%s' % sample_rate
+        if tags:
+            suffix += '|#' + ','.join(tags)
+        return _encode('%s:' % metric), _encode(suffix)
+
+    def _submit_raw(self, payload):
+        """ Submit an already formatted payload, through the sender thread if any. """
+        if self._queue is not None:
             try:
-                self.socket_sendto(payload, self.address)
+                self._queue.put_nowait(payload)
+            except Full:
+                self.dropped_points += 1
+        else:
+            self._submit(payload)
+
+    def _submit(self, payload):
+        if self.max_buffer_size is None:
+            self._send(payload)
+        else:
+            self._buffer_payload(payload)
+
+    def _start_sender(self, queue_size):
+        self._queue = Queue(queue_size)
+        self._sender = threading.Thread(target=self._run_sender, args=(self._queue,))
+        self._sender.daemon = True
+        self._sender.start()
+
+    def _run_sender(self, queue):
+        while True:
+            try:
+                item = queue.get(timeout=self.max_buffer_delay)
+            except Empty:
+                # Idle: don't hold on to buffered points.
+                item = _FLUSH
+            try:
+                if item is _FLUSH:
+                    with self._buffer_lock:
+                        self._flush_buffer()
+                elif isinstance(item, _Drain):
+                    try:
+                        with self._buffer_lock:
+                            self._flush_buffer()
+                    finally:
+                        item.done.set()
+                elif isinstance(item, bytes):
+                    self._submit(item)
+                else:
+                    self._submit(self._format(*item))
             except Exception:
                 logger.exception('couldnt submit statsd point')
+
+    def _buffer_payload(self, payload):
+        payload = _encode(payload)
+        now = time()
+        with self._buffer_lock:
+            # Account for the newline separating it from the previous point.
+            size = len(payload) + 1
+            if self._buffer and self._buffer_size + size > self.max_buffer_size:
+                self._flush_buffer()
+            if not self._buffer:
+                self._buffer_deadline = now + self.max_buffer_delay
+                size -= 1
+            self._buffer.append(payload)
+            self._buffer_size += size
+            if self._buffer_size >= self.max_buffer_size or now >= self._buffer_deadline:
+                self._flush_buffer()
+
+    def _flush_buffer(self):
+        if self._buffer:
+            payload = b'\n'.join(self._buffer)
+            self._buffer = []
+            self._buffer_size = 0
+            self._send(payload)
+
+    def _send(self, payload):
+        payload = _encode(payload)
+        try:
+            self.socket_sendto(payload, self.address)
+            self.packets_sent += 1
+            self.bytes_sent += len(payload)
+        except Exception:
+            self.send_errors += 1
+            logger.exception('couldnt submit statsd point')
+
+
+class AggregatingStatsdAggregator(MetricsAggregator):
+    """
+    Aggregates counters and gauges in process for `roll_up_interval` seconds
+    and forwards a single statsd point per context and interval through a
+    :class:`StatsdAggregator`, so a counter incremented thousands of times a
+    second costs one datagram line per interval.
+
+    Histograms are forwarded point by point so the agent still computes their
+    distribution, unless *aggregate_histograms* is set: their roll-ups (min,
+    max, avg and percentiles) are then computed in process and forwarded as
+    gauges, and their count as a counter, so the agent sums the counts of
+    every process on the host.
+    """
+
+    def __init__(self, statsd, roll_up_interval=10, aggregate_histograms=False, **limits):
+        MetricsAggregator.__init__(self, roll_up_interval, **limits)
+        self.statsd = statsd
+        self.aggregate_histograms = aggregate_histograms
+
+    def add_point(self, metric, tags, timestamp, value, metric_class, sample_rate=1, host=None):
+        if self.aggregate_histograms or metric_class in (Counter, Gauge):
+            MetricsAggregator.add_point(self, metric, tags, timestamp, value, metric_class,
+                sample_rate, host)
+        else:
+            self.points_recorded += 1
+            self.statsd.add_point(metric, tags, timestamp, value, metric_class, sample_rate, host)
+
+    def bind(self, metric, tags, metric_class, host=None, sample_rate=1):
+        if self.aggregate_histograms or metric_class in (Counter, Gauge):
+            return MetricsAggregator.bind(self, metric, tags, metric_class, host, sample_rate)
+        return self.statsd.bind(metric, tags, metric_class, host, sample_rate)
+
+    def event(self, *args, **kwargs):
+        self.statsd.event(*args, **kwargs)
+
+    def telemetry(self):
+        telemetry = self.statsd.telemetry()
+        telemetry.update(MetricsAggregator.telemetry(self))
+        return telemetry
+
+    def reset(self):
+        MetricsAggregator.reset(self)
+        self.statsd.reset()
+
+    def service_check(self, *args, **kwargs):
+        self.statsd.service_check(*args, **kwargs)
+
+    def drain(self, timeout=None):
+        """ Forward all the intervals, open ones included, and send them,
+        waiting up to *timeout* seconds for the sender thread. """
+        self.flush(force=True)
+        return self.statsd.drain(timeout)
+
+    def flush(self, timestamp=None, force=False):
+        """ Forward the intervals completed before the given timestamp, or all
+        of them if *force* is true. """
+        add_point = self.statsd.add_point
+        for i, contexts in self.detach(None if force else timestamp or time()):
+            for context in list(contexts.values()):
+                metric_class = type(context)
+                if metric_class in (Counter, Gauge):
+                    for _, value, name, tags, host in context.flush(i):
+                        add_point(name, tags, i, value, metric_class, host=host)
+                    continue
+                count_name = '%s.count' % context.name
+                for _, value, name, tags, host in context.flush(i):
+                    add_point(name, tags, i, value, Counter if name == count_name else Gauge,
+                        host=host)
+        self.statsd.flush()
+
+
+def _encode(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
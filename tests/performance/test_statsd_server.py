@@ -0,0 +1,132 @@
+"""
+Throughput of the embedded statsd server.
+
+Measures how many datagrams per second the parser and aggregator get
+through when handed packets directly, then how many the server sustains
+over a loopback UDP socket while another process sends as fast as it can,
+and finally how that scales with a worker per core, each fed by its own
+sender.
+"""
+
+import multiprocessing
+import socket
+import threading
+import time
+
+from dogapi.stats import ShardedStatsdServer, StatsdServer
+
+
+LINES_PER_PACKET = 20
+CONTEXTS = 1000
+DURATION = 5
+
+
+class NullReporter(object):
+
+    def flush(self, metrics):
+        pass
+
+
+def packets(count):
+    """ Datagrams of a typical mix of counters, gauges and timers. """
+    kinds = ['c', 'g', 'ms']
+    result = []
+    for i in range(count):
+        lines = []
+        for j in range(LINES_PER_PACKET):
+            context = (i * LINES_PER_PACKET + j) % CONTEXTS
+            lines.append('app.metric.%s:%s|%s|#env:prod,shard:%s'
+                % (context, j, kinds[context % 3], context % 10))
+        result.append('\n'.join(lines).encode('ascii'))
+    return result
+
+
+def start_server():
+    server = StatsdServer(port=0, flush_interval=10, roll_up_interval=10, drain_on_exit=False)
+    server.dog.reporter = NullReporter()
+    return server
+
+
+def measure_parsing():
+    server = start_server()
+    batch = packets(1000)
+    start = time.time()
+    sent = 0
+    while time.time() - start < DURATION:
+        now = time.time()
+        for packet in batch:
+            server.handle_packet(packet, now)
+        sent += len(batch)
+    elapsed = time.time() - start
+    print('parse + aggregate: %d packets/s, %d lines/s'
+        % (sent / elapsed, sent * LINES_PER_PACKET / elapsed))
+    server.socket.close()
+    server.dog.stop(flush=False)
+
+
+def blast(address, stop):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    batch = packets(1000)
+    while not stop.is_set():
+        for packet in batch:
+            try:
+                sock.sendto(packet, address)
+            except socket.error:
+                pass
+
+
+def measure_udp():
+    server = start_server()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    stop = multiprocessing.Event()
+    sender = multiprocessing.Process(target=blast, args=(server.address, stop))
+    sender.start()
+    time.sleep(1)
+    received = server.packets_received
+    start = time.time()
+    time.sleep(DURATION)
+    received = server.packets_received - received
+    elapsed = time.time() - start
+    stop.set()
+    sender.join()
+    server.shutdown()
+    thread.join()
+    print('udp: %d packets/s, %d lines/s sustained'
+        % (received / elapsed, received * LINES_PER_PACKET / elapsed))
+
+
+def measure_sharded_udp(workers):
+    server = ShardedStatsdServer(port=0, workers=workers, flush_in_thread=False,
+        roll_up_interval=10, drain_on_exit=False)
+    server.dog.reporter = NullReporter()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    stop = multiprocessing.Event()
+    senders = [multiprocessing.Process(target=blast, args=(server.address, stop))
+               for _ in range(workers)]
+    for sender in senders:
+        sender.start()
+    time.sleep(1)
+    server.dog.flush(time.time())
+    received = server.telemetry()['packets_received']
+    start = time.time()
+    time.sleep(DURATION)
+    server.dog.flush(time.time())
+    received = server.telemetry()['packets_received'] - received
+    elapsed = time.time() - start
+    stop.set()
+    for sender in senders:
+        sender.join()
+    server.shutdown()
+    thread.join()
+    print('udp, %d workers: %d packets/s, %d lines/s sustained'
+        % (workers, received / elapsed, received * LINES_PER_PACKET / elapsed))
+
+
+if __name__ == '__main__':
+    measure_parsing()
+    measure_udp()
+    workers = max(multiprocessing.cpu_count() // 2, 1)
+    for n in sorted(set([1, 2, workers])):
+        measure_sharded_udp(n)
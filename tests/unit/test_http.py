@@ -0,0 +1,157 @@
+"""
+Tests for the HTTP transport of the API client.
+"""
+
+import os
+import threading
+
+import nose.tools as nt
+from nose.plugins.skip import SkipTest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from dogapi.http import DogHttpApi
+
+
+#
+# Test fixtures.
+#
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """ Answers every request with an empty JSON object, keeping the
+    connection open unless the server says otherwise. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        # Counted before answering, which lets the client carry on.
+        self.server.requests += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+        # Drop the connection without telling the client, as a server
+        # closing an idle connection would.
+        self.close_connection = self.server.drop_connections
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    server.connections = 0
+    server.requests = 0
+    server.drop_connections = False
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def client(server, **kwargs):
+    return DogHttpApi(api_key='key', api_host='http://127.0.0.1:%s' % server.server_address[1],
+        swallow=False, **kwargs)
+
+
+#
+# Unit tests.
+#
+
+class TestUnitConnectionPool(object):
+
+    def test_keep_alive(self):
+        server = start_server()
+        try:
+            dog = client(server)
+            for i in range(5):
+                nt.assert_equal(dog.http_request('POST', '/series', {'series': []}), {})
+            nt.assert_equal(server.requests, 5)
+            nt.assert_equal(server.connections, 1)
+
+            # Without a pool, every request gets its own connection.
+            dog = client(server, pool_size=0)
+            for i in range(3):
+                dog.http_request('POST', '/series', {'series': []})
+            nt.assert_equal(server.connections, 4)
+        finally:
+            server.shutdown()
+
+    def test_stale_connection(self):
+        server = start_server()
+        try:
+            dog = client(server)
+            server.drop_connections = True
+            for i in range(3):
+                nt.assert_equal(dog.http_request('POST', '/series', {'series': []}), {})
+            # Each request after the first found its connection closed and
+            # retried on a new one.
+            nt.assert_equal(server.requests, 3)
+            nt.assert_equal(server.connections, 3)
+        finally:
+            server.shutdown()
+
+    def test_idle_timeout_and_fork(self):
+        server = start_server()
+        try:
+            dog = client(server, pool_idle_timeout=0)
+            for i in range(2):
+                dog.http_request('POST', '/series', {'series': []})
+            nt.assert_equal(server.connections, 2)
+
+            if not hasattr(os, 'fork'):
+                raise SkipTest("fork isn't available")
+            dog = client(server)
+            dog.http_request('POST', '/series', {'series': []})
+            read_end, write_end = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.close(read_end)
+                    # The child doesn't share the parent's connection.
+                    conn, reused = dog.connection_pool.acquire(dog.http_conn_cls, dog.api_host,
+                        dog.timeout)
+                    os.write(write_end, b'1' if reused else b'0')
+                finally:
+                    os._exit(0)
+            os.close(write_end)
+            nt.assert_equal(os.read(read_end, 1), b'0')
+            os.close(read_end)
+            os.waitpid(pid, 0)
+            dog.http_request('POST', '/series', {'series': []})
+            nt.assert_equal(server.connections, 3)
+        finally:
+            server.shutdown()
+
+    def test_body_errors(self):
+        server = start_server()
+        try:
+            dog = client(server)
+            opened = []
+            base = dog.http_conn_cls
+            class Connection(base):
+                def __init__(self, *args, **kwargs):
+                    opened.append(self)
+                    base.__init__(self, *args, **kwargs)
+            dog.http_conn_cls = Connection
+            # A body that can't be serialized doesn't take a connection.
+            nt.assert_raises(TypeError, dog.http_request, 'POST', '/series', {'x': object()})
+            nt.assert_equal(opened, [])
+        finally:
+            server.shutdown()
@@ -0,0 +1,189 @@
+"""
+Tests for the embedded statsd server.
+"""
+
+import socket
+import threading
+import time
+
+import nose.tools as nt
+from nose.plugins.skip import SkipTest
+
+from dogapi.stats import ShardedStatsdServer, StatsdServer
+from tests.util.stats_test_utils import MemoryReporter
+
+
+#
+# Test fixtures.
+#
+
+def start(**kwargs):
+    server = StatsdServer(port=0, roll_up_interval=10, flush_in_thread=False,
+        drain_on_exit=False, host='host', **kwargs)
+    server.dog.reporter = MemoryReporter()
+    return server
+
+
+def series(server):
+    return dict(((m['metric'], tuple(m['tags'] or ())), m['points'][0][1])
+                for m in server.dog.reporter.metrics)
+
+
+#
+# Unit tests.
+#
+
+class TestUnitStatsdServer(object):
+
+    def test_parse(self):
+        server = start()
+        packet = b'\n'.join([
+            b'counter:1|c',
+            b'counter:2|c|#a:b,c',
+            b'counter:1|c|@0.5',
+            b'gauge:3|g',
+            b'gauge:4.5|g',
+            b'histogram:1:2:3|h',
+            b'timer:10|ms|#a:b',
+            b'set:a|s',
+            b'set:b|s',
+            b'set:a|s',
+            b'_e{5,4}:title|text',
+            b'_sc|check|0',
+            b'bad',
+            b'bad:1|x',
+            b'bad:x|c',
+            b'bad:1|c|@0',
+            b'',
+        ])
+        server.handle_packet(packet, 100.0)
+        server.handle_packet(b'counter:1|c', 100.0)
+        server.dog.flush(120.0)
+
+        metrics = series(server)
+        nt.assert_equal(metrics[('counter', ())], 4)
+        nt.assert_equal(metrics[('counter', ('a:b', 'c'))], 2)
+        nt.assert_equal(metrics[('gauge', ())], 4.5)
+        nt.assert_equal(metrics[('histogram.count', ())], 3)
+        nt.assert_equal(metrics[('histogram.max', ())], 3)
+        nt.assert_equal(metrics[('timer.avg', ('a:b',))], 10)
+        nt.assert_equal(metrics[('set', ())], 2)
+        nt.assert_equal(server.packets_received, 2)
+        nt.assert_equal(server.parse_errors, 4)
+        nt.assert_equal(server.unsupported_lines, 2)
+        nt.assert_equal(server.telemetry()['points_recorded'], 13)
+
+    def test_serve(self):
+        server = start()
+        thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+        thread.start()
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            for i in range(10):
+                sock.sendto(('counter:1|c\ngauge:%d|g' % i).encode('ascii'), server.address)
+            sock.close()
+            deadline = time.time() + 5
+            while server.packets_received < 10 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            server.shutdown()
+            thread.join()
+        # Pending metrics are flushed on shutdown.
+        metrics = series(server)
+        nt.assert_equal(metrics[('counter', ())], 10)
+        nt.assert_equal(metrics[('gauge', ())], 9)
+
+    def test_detach_waits_for_batch(self):
+        server = start()
+        # A batch being recorded, stamped before the interval it falls in ends.
+        server.lock.acquire()
+        thread = threading.Thread(target=server.dog.flush, args=(120.0,))
+        thread.start()
+        time.sleep(0.05)
+        nt.assert_true(thread.is_alive())
+        server.handle_packet(b'counter:1|c', 100.0)
+        server.lock.release()
+        thread.join()
+        nt.assert_equal(series(server)[('counter', ())], 1)
+
+    def test_unsupported_modes(self):
+        nt.assert_raises(ValueError, StatsdServer, port=0, statsd=True)
+
+    def test_sharded(self):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise SkipTest("The sharded server needs SO_REUSEPORT")
+        server = ShardedStatsdServer(port=0, workers=2, roll_up_interval=10,
+            flush_in_thread=False, drain_on_exit=False, host='host')
+        server.dog.reporter = MemoryReporter()
+        thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+        thread.start()
+        try:
+            # Senders on different ports spread across the workers.
+            for i in range(10):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                for j in range(2):
+                    sock.sendto(('counter:1|c\nhistogram:%d|h' % (i * 2 + j)).encode('ascii'),
+                        server.address)
+                sock.close()
+            deadline = time.time() + 5
+            while server.telemetry()['packets_received'] < 20 and time.time() < deadline:
+                time.sleep(0.01)
+                server.dog.flush(time.time() + 20)
+        finally:
+            server.shutdown()
+            thread.join()
+        for process in server.processes:
+            nt.assert_false(process.is_alive())
+
+        # Each interval is posted once, merged across the workers.
+        totals = {}
+        for m in server.dog.reporter.metrics:
+            for _, value in m['points']:
+                totals[m['metric']] = totals.get(m['metric'], 0) + value
+        nt.assert_equal(totals['counter'], 20)
+        nt.assert_equal(totals['histogram.count'], 20)
+        telemetry = server.telemetry()
+        nt.assert_equal(telemetry['packets_received'], 20)
+        nt.assert_equal(telemetry['points_recorded'], 40)
+
+    def test_sharded_type_mismatch(self):
+        from dogapi.stats.metrics import Counter, Gauge
+        from dogapi.stats.server import _WorkerPoolAggregator
+        aggregator = _WorkerPoolAggregator(10, [], 5)
+        # Two workers received the same name as different types.
+        counter = Counter('mixed', None, None)
+        counter.add_point(1)
+        gauge = Gauge('mixed', None, None)
+        gauge.add_point(5)
+        other = Counter('other', None, None)
+        other.add_point(1)
+        key = ('mixed', None, None)
+        aggregator._replies = [[(100.0, {key: counter, ('other', None, None): other})],
+                               [(100.0, {key: gauge})]]
+        metrics = aggregator.rollup(aggregator.detach(None))
+        nt.assert_equal(sorted((m[2], m[1]) for m in metrics),
+            [('mixed', 1), ('mixed', 5), ('other', 1)])
+
+    def test_sharded_shutdown_while_flushing(self):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise SkipTest("The sharded server needs SO_REUSEPORT")
+        server = ShardedStatsdServer(port=0, workers=2, roll_up_interval=0.05,
+            flush_interval=0.05, flush_jitter=0, drain_on_exit=False, host='host')
+        server.dog.reporter = MemoryReporter()
+        thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+        thread.start()
+        try:
+            for i in range(10):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                for j in range(10):
+                    sock.sendto(b'counter:1|c', server.address)
+                    time.sleep(0.001)
+                sock.close()
+        finally:
+            server.shutdown()
+            thread.join()
+        # Every point comes out exactly once, whether the flush thread or the
+        # final flush sent it.
+        total = sum(value for m in server.dog.reporter.metrics if m['metric'] == 'counter'
+                    for _, value in m['points'])
+        nt.assert_equal(total, 100)
@@ -0,0 +1,154 @@
+"""
+Tests for aggregation in memory shared across processes.
+"""
+
+import os
+import signal
+import threading
+
+import nose.tools as nt
+from nose.plugins.skip import SkipTest
+
+from dogapi import DogStatsApi
+from dogapi.stats.metrics import Counter, Gauge, Histogram
+from tests.util.stats_test_utils import MemoryReporter
+
+
+#
+# Test fixtures.
+#
+
+def start():
+    if not hasattr(os, 'fork'):
+        raise SkipTest("Shared memory aggregation needs fork")
+    dog = DogStatsApi()
+    dog.start(roll_up_interval=10, flush_in_thread=False, shared=True)
+    dog.reporter = MemoryReporter()
+    return dog
+
+
+def values(reporter):
+    """ The first value of each untagged metric. """
+    return dict((m['metric'], m['points'][0][1]) for m in reporter.metrics if not m['tags'])
+
+
+#
+# Unit tests.
+#
+
+class TestUnitSharedAggregator(object):
+
+    def test_roll_ups(self):
+        dog = start()
+        for i in range(1, 101):
+            dog.increment('counter', timestamp=100.0)
+            dog.increment('sampled', timestamp=100.0, sample_rate=0.5)
+            dog.gauge('gauge', i, timestamp=100.0)
+            dog.histogram('histogram', i, timestamp=100.0)
+            dog.histogram('histogram', -i, timestamp=100.0, tags=['negative'])
+        dog.increment('counter', timestamp=110.0)
+        dog.flush(120.0)
+
+        metrics = values(dog.reporter)
+        nt.assert_equal(metrics['counter'], 100)
+        nt.assert_equal(metrics['gauge'], 100)
+        assert 50 < metrics['sampled'] < 150
+        nt.assert_equal(metrics['histogram.count'], 100)
+        nt.assert_equal(metrics['histogram.min'], 1)
+        nt.assert_equal(metrics['histogram.max'], 100)
+        nt.assert_almost_equal(metrics['histogram.avg'], 50.5)
+        nt.assert_almost_equal(metrics['histogram.95percentile'], 95, delta=95 * 0.02)
+        negative = [m for m in dog.reporter.metrics
+                    if m['metric'] == 'histogram.95percentile' and m['tags'] == ['negative']]
+        nt.assert_almost_equal(negative[0]['points'][0][1], -6, delta=6 * 0.02)
+        counters = [m for m in dog.reporter.metrics if m['metric'] == 'counter']
+        nt.assert_equal(counters[0]['points'], [[100.0, 100], [110.0, 1]])
+
+        # Flushed slots are freed.
+        dog.reporter.metrics = []
+        dog.flush(200.0)
+        nt.assert_equal(dog.reporter.metrics, [])
+
+    def test_mixed_types(self):
+        dog = start()
+        dog.increment('other', timestamp=100.0)
+        dog.increment('mixed', timestamp=100.0)
+        dog.gauge('mixed', 5, timestamp=100.0)
+        dog.histogram('mixed', 2, timestamp=100.0)
+        dog.flush(200.0)
+
+        # Each kind is rolled up on its own, and nothing else is lost.
+        metrics = dict((m['metric'], sorted(m['points'])) for m in dog.reporter.metrics)
+        nt.assert_equal(metrics['mixed'], [[100.0, 1], [100.0, 5]])
+        nt.assert_equal(metrics['mixed.count'], [[100.0, 1]])
+        nt.assert_equal(metrics['other'], [[100.0, 1]])
+
+    def test_forked_workers(self):
+        dog = start()
+        children = []
+        for worker in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    if not hasattr(os, 'register_at_fork'):
+                        dog.after_fork()
+                    for i in range(100):
+                        dog.increment('requests', timestamp=100.0)
+                        dog.histogram('latency', worker * 100 + i, timestamp=100.0)
+                    dog.gauge('worker', worker, timestamp=100.0, tags=['worker:%s' % worker])
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        for pid in children:
+            os.waitpid(pid, 0)
+
+        dog.flush(120.0)
+        metrics = values(dog.reporter)
+        nt.assert_equal(metrics['requests'], 400)
+        nt.assert_equal(metrics['latency.count'], 400)
+        nt.assert_equal(metrics['latency.max'], 399)
+        nt.assert_equal(len([m for m in dog.reporter.metrics if m['metric'] == 'worker']), 4)
+        nt.assert_equal(dog.get_telemetry()['points_recorded'], 804)
+
+    def test_full(self):
+        if not hasattr(os, 'fork'):
+            raise SkipTest("Shared memory aggregation needs fork")
+        from dogapi.stats.shared import SharedMetricsAggregator
+        aggregator = SharedMetricsAggregator(10, max_contexts=4, max_histogram_contexts=1,
+            stripes=1, max_key_size=64)
+        for i in range(5):
+            aggregator.add_point('counter', ['tag:%s' % i], 100.0, 1, Counter)
+        aggregator.add_point('gauge', ['x' * 100], 100.0, 1, Gauge)
+        aggregator.add_point('histogram', None, 100.0, 1, Histogram)
+        aggregator.add_point('other_histogram', None, 100.0, 1, Histogram)
+        nt.assert_equal(aggregator.telemetry()['dropped_points'], 3)
+        detached = aggregator.detach(120.0)
+        nt.assert_equal(len(detached[0][1]), 5)
+        nt.assert_equal(aggregator.telemetry()['points_recorded'], 5)
+
+    def test_killed_while_holding_a_lock(self):
+        if not hasattr(os, 'fork'):
+            raise SkipTest("Shared memory aggregation needs fork")
+        from dogapi.stats.shared import SharedMetricsAggregator
+        aggregator = SharedMetricsAggregator(10, stripes=1)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # Killed in the middle of recording, as a timed out worker is.
+                aggregator._scalars.locks.acquire(0)
+                os.kill(os.getpid(), signal.SIGKILL)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        # The stripe's lock went with its holder.
+        def record():
+            aggregator.add_point('counter', None, 100.0, 1, Counter)
+            record.detached = aggregator.detach(120.0)
+        thread = threading.Thread(target=record)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive()
+        counter, = record.detached[0][1].values()
+        nt.assert_equal(counter.count, 1)
@@ -0,0 +1,169 @@
+"""
+Tests for the on-disk spool of unsent payloads.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import nose.tools as nt
+from nose.plugins.skip import SkipTest
+
+from dogapi import DogStatsApi
+from dogapi.exceptions import ClientError
+from dogapi.stats.reporters import HttpReporter
+from dogapi.stats.spool import Spool
+
+
+#
+# Test fixtures.
+#
+
+@contextmanager
+def temporary_directory():
+    path = tempfile.mkdtemp()
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path)
+
+
+def payloads(count):
+    return [('payload %s' % i).encode('ascii') for i in range(count)]
+
+
+def exited_pid():
+    """ The pid of a process that has exited. """
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+#
+# Unit tests.
+#
+
+class TestUnitSpool(object):
+
+    def test_replay_oldest_first(self):
+        with temporary_directory() as path:
+            spool = Spool(path, segment_size=50)
+            for payload in payloads(10):
+                spool.append(payload)
+            nt.assert_equal(len(spool), 10)
+            assert len(os.listdir(path)) > 1
+
+            # Replay stops at the first payload that can't be sent.
+            sent = []
+            def send(payload):
+                if len(sent) == 4:
+                    return False
+                sent.append(payload)
+                return True
+            nt.assert_equal(spool.replay(send), 4)
+            nt.assert_equal(sent, payloads(4))
+            nt.assert_equal(len(spool), 6)
+
+            sent = []
+            nt.assert_equal(spool.replay(lambda p: sent.append(p) or True), 6)
+            nt.assert_equal(sent, payloads(10)[4:])
+            nt.assert_equal(os.listdir(path), [])
+            nt.assert_equal(spool.replayed_payloads, 10)
+
+            # The spool carries on after being emptied.
+            spool.append(b'again')
+            nt.assert_equal(spool.replay(lambda p: sent.append(p) or True), 1)
+            nt.assert_equal(sent[-1], b'again')
+
+    def test_max_size(self):
+        with temporary_directory() as path:
+            spool = Spool(path, max_size=100, segment_size=50)
+            for payload in payloads(20):
+                spool.append(payload)
+            assert spool.size <= 100
+            assert spool.dropped_payloads > 0
+            nt.assert_equal(len(spool) + spool.dropped_payloads, 20)
+            sent = []
+            spool.replay(lambda p: sent.append(p) or True)
+            nt.assert_equal(sent, payloads(20)[spool.dropped_payloads:])
+
+    def test_reopen(self):
+        with temporary_directory() as path:
+            spool = Spool(path, segment_size=50)
+            for payload in payloads(5):
+                spool.append(payload)
+            # Tear the last record, as a crash in the middle of a write would.
+            last = os.path.join(path, sorted(os.listdir(path))[-1])
+            with open(last, 'ab') as f:
+                f.write(b'\x00\x00\x00\x10torn')
+
+            spool = Spool(path, segment_size=50)
+            spool.append(b'after')
+            sent = []
+            spool.replay(lambda p: sent.append(p) or True)
+            nt.assert_equal(sent, payloads(5) + [b'after'])
+
+    def test_http_reporter_spools(self):
+        with temporary_directory() as path:
+            reporter = HttpReporter(retry_delay=0, spool=Spool(path))
+            bodies = []
+            def unreachable(method, path, body=None, **kwargs):
+                raise ClientError('Could not request')
+            def reachable(method, path, body=None, **kwargs):
+                bodies.append(body)
+                return {'status': 'ok'}
+            metrics = [{'metric': 'metric', 'points': [[100.0 + i, 1]], 'tags': None,
+                        'host': 'host', 'device': None} for i in range(3)]
+
+            reporter.dog.http_request = unreachable
+            reporter.flush(metrics[:1])
+            reporter.flush(metrics[1:2])
+            nt.assert_equal(reporter.http_errors, 2)
+            nt.assert_equal(len(reporter.spool), 2)
+
+            # Once the API can be reached, spooled series go out oldest first.
+            reporter.dog.http_request = reachable
+            reporter.flush(metrics[2:])
+            nt.assert_equal(len(bodies), 3)
+            points = [json.loads(body)['series'][0]['points'] for body in bodies]
+            nt.assert_equal(points, [[[102.0, 1]], [[100.0, 1]], [[101.0, 1]]])
+            nt.assert_equal(len(reporter.spool), 0)
+            telemetry = reporter.telemetry()
+            nt.assert_equal(telemetry['spooled_payloads'], 2)
+            nt.assert_equal(telemetry['replayed_payloads'], 2)
+
+    def test_adopt(self):
+        with temporary_directory() as path:
+            spool = Spool(os.path.join(path, 'live'))
+            spool.append(b'own')
+            orphan_path = os.path.join(path, 'orphan')
+            orphan = Spool(orphan_path, segment_size=50)
+            for payload in payloads(5):
+                orphan.append(payload)
+            nt.assert_equal(spool.adopt(orphan_path), 5)
+            assert not os.path.exists(orphan_path)
+            # Only one process gets to adopt a spool.
+            nt.assert_equal(spool.adopt(orphan_path), None)
+            sent = []
+            spool.replay(lambda p: sent.append(p) or True)
+            nt.assert_equal(sent, [b'own'] + payloads(5))
+
+    def test_adopt_exited_children(self):
+        if not hasattr(os, 'fork'):
+            raise SkipTest("Only forked children spool in subdirectories")
+        with temporary_directory() as path:
+            # Left by a child that exited, and by one that died adopting it.
+            pid = exited_pid()
+            Spool(os.path.join(path, str(pid))).append(b'child')
+            Spool(os.path.join(path, '%s.%s' % (os.getpid(), pid))).append(b'adopting')
+            Spool(os.path.join(path, str(os.getpid()))).append(b'alive')
+            dog = DogStatsApi()
+            dog.start(flush_in_thread=False, drain_on_exit=False, spool_path=path)
+            sent = []
+            dog.reporter.spool.replay(lambda p: sent.append(p) or True)
+            nt.assert_equal(sorted(sent), [b'adopting', b'child'])
+            nt.assert_equal(sorted(os.listdir(path)), [str(os.getpid())])
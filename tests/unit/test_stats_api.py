@@ -2,6 +2,7 @@
 Tests for the DogStatsAPI class.
 """
 
+import json
 import logging
 import os
 import random
@@ -12,6 +13,8 @@ import nose.tools as nt
 from nose.plugins.skip import SkipTest
 
 from dogapi import DogStatsApi
+from dogapi.constants import MetricType
+from tests.util.stats_test_utils import MemoryReporter
 
 
 # Silence the logger.
@@ -19,20 +22,6 @@ logger = logging.getLogger('dd.dogapi.stats')
 logger.setLevel(logging.ERROR)
 
 
-#
-# Test fixtures.
-#
-
-class MemoryReporter(object):
-    """ A reporting class that reports to memory for testing. """
-
-    def __init__(self):
-        self.metrics = []
-
-    def flush(self, metrics):
-        self.metrics += metrics
-
-
 #
 # Unit tests.
 #
@@ -93,52 +82,33 @@ class TestUnitDogStatsAPI(object):
 
         dog.histogram('histogram.3', 50, 134.0)
 
-        # Flush and ensure they roll up properly.
+        # Flush and ensure they roll up properly. Both intervals of
+        # histogram.1 are sent as points of the same series.
         dog.flush(120.0)
         metrics = self.sort_metrics(reporter.metrics)
-        nt.assert_equal(len(metrics), 24)
+        nt.assert_equal(len(metrics), 16)
 
         # Test histograms elsewhere.
-        (h1751, h1851, h1951, h1991, h1avg1, h1cnt1, h1max1, h1min1,
-         _, _, _, _, h2avg1, h2cnt1, h2max1, h2min1,
-         h1752, _, _, h1992, h1avg2, h1cnt2, h1max2, h1min2) = metrics
-
-        nt.assert_equal(h1avg1['metric'], 'histogram.1.avg')
-        nt.assert_equal(h1avg1['points'][0][0], 100.0)
-        nt.assert_equal(h1avg1['points'][0][1], 35)
-        nt.assert_equal(h1cnt1['metric'], 'histogram.1.count')
-        nt.assert_equal(h1cnt1['points'][0][0], 100.0)
-        nt.assert_equal(h1cnt1['points'][0][1], 4)
-        nt.assert_equal(h1min1['metric'], 'histogram.1.min')
-        nt.assert_equal(h1min1['points'][0][1], 20)
-        nt.assert_equal(h1max1['metric'], 'histogram.1.max')
-        nt.assert_equal(h1max1['points'][0][1], 50)
-        nt.assert_equal(h1751['metric'], 'histogram.1.75percentile')
-        nt.assert_equal(h1751['points'][0][1], 40)
-        nt.assert_equal(h1991['metric'], 'histogram.1.99percentile')
-        nt.assert_equal(h1991['points'][0][1], 50)
-
-
-        nt.assert_equal(h1avg2['metric'], 'histogram.1.avg')
-        nt.assert_equal(h1avg2['points'][0][0], 110.0)
-        nt.assert_equal(h1avg2['points'][0][1], 40)
-        nt.assert_equal(h1cnt2['metric'], 'histogram.1.count')
-        nt.assert_equal(h1cnt2['points'][0][0], 110.0)
-        nt.assert_equal(h1cnt2['points'][0][1], 3)
-        nt.assert_equal(h1752['metric'], 'histogram.1.75percentile')
-        nt.assert_equal(h1752['points'][0][0], 110.0)
-        nt.assert_equal(h1752['points'][0][1], 40.0)
-        nt.assert_equal(h1992['metric'], 'histogram.1.99percentile')
-        nt.assert_equal(h1992['points'][0][0], 110.0)
-        nt.assert_equal(h1992['points'][0][1], 50.0)
-
-
-        nt.assert_equal(h2avg1['metric'], 'histogram.2.avg')
-        nt.assert_equal(h2avg1['points'][0][0], 100.0)
-        nt.assert_equal(h2avg1['points'][0][1], 40)
-        nt.assert_equal(h2cnt1['metric'], 'histogram.2.count')
-        nt.assert_equal(h2cnt1['points'][0][0], 100.0)
-        nt.assert_equal(h2cnt1['points'][0][1], 1)
+        (h175, h185, h195, h199, h1avg, h1cnt, h1max, h1min,
+         _, _, _, _, h2avg, h2cnt, h2max, h2min) = metrics
+
+        nt.assert_equal(h1avg['metric'], 'histogram.1.avg')
+        nt.assert_equal(h1avg['points'], [[100.0, 35], [110.0, 40]])
+        nt.assert_equal(h1cnt['metric'], 'histogram.1.count')
+        nt.assert_equal(h1cnt['points'], [[100.0, 4], [110.0, 3]])
+        nt.assert_equal(h1min['metric'], 'histogram.1.min')
+        nt.assert_equal(h1min['points'][0][1], 20)
+        nt.assert_equal(h1max['metric'], 'histogram.1.max')
+        nt.assert_equal(h1max['points'][0][1], 50)
+        nt.assert_equal(h175['metric'], 'histogram.1.75percentile')
+        nt.assert_equal(h175['points'], [[100.0, 40], [110.0, 40]])
+        nt.assert_equal(h199['metric'], 'histogram.1.99percentile')
+        nt.assert_equal(h199['points'], [[100.0, 50], [110.0, 50]])
+
+        nt.assert_equal(h2avg['metric'], 'histogram.2.avg')
+        nt.assert_equal(h2avg['points'], [[100.0, 40]])
+        nt.assert_equal(h2cnt['metric'], 'histogram.2.count')
+        nt.assert_equal(h2cnt['points'], [[100.0, 1]])
 
         # Flush again ensure they're gone.
         dog.reporter.metrics = []
@@ -442,3 +412,702 @@ class TestUnitDogStatsAPI(object):
         actual_count = (sum((m['points'][0][1] for m in metrics if
                                     m['metric'] == 'metric.count')))
         nt.assert_equal(actual_count, expected_count)
+
+    def test_sharded_aggregator(self):
+        dog = DogStatsApi()
+        dog.start(roll_up_interval=10, flush_in_thread=False, sharded=True)
+        reporter = dog.reporter = MemoryReporter()
+
+        def record():
+            for i in range(1000):
+                dog.increment('sharded.counter', timestamp=100.0)
+                dog.gauge('sharded.gauge', 5, timestamp=100.0)
+                dog.histogram('sharded.histogram', i, timestamp=100.0)
+
+        threads = [threading.Thread(target=record) for i in range(8)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        dog.flush(200.0)
+        metrics = dict((m['metric'], m) for m in reporter.metrics)
+        nt.assert_equal(metrics['sharded.counter']['points'][0][1], 8000)
+        nt.assert_equal(metrics['sharded.gauge']['points'][0][1], 5)
+        nt.assert_equal(metrics['sharded.histogram.count']['points'][0][1], 8000)
+        nt.assert_equal(metrics['sharded.histogram.min']['points'][0][1], 0)
+        nt.assert_equal(metrics['sharded.histogram.max']['points'][0][1], 999)
+        nt.assert_equal(metrics['sharded.histogram.avg']['points'][0][1], 499.5)
+
+        # Shards of finished threads are forgotten once drained.
+        nt.assert_equal(dog._aggregator._shards, [])
+
+    def test_sharded_gauge(self):
+        dog = DogStatsApi()
+        dog.start(roll_up_interval=10, flush_in_thread=False, sharded=True)
+        reporter = dog.reporter = MemoryReporter()
+        dog.gauge('sharded.gauge', 1, timestamp=100.0)
+        time.sleep(0.01)
+        thread = threading.Thread(target=dog.gauge, args=('sharded.gauge', 2, 100.0))
+        thread.start()
+        thread.join()
+        time.sleep(0.01)
+        dog.gauge('sharded.gauge', 3, timestamp=100.0)
+
+        # The most recent value wins, whichever shard holds it.
+        dog.flush(200.0)
+        nt.assert_equal(reporter.metrics[0]['points'], [[100.0, 3]])
+
+    def test_sharded_type_mismatch(self):
+        dog = DogStatsApi()
+        dog.start(roll_up_interval=10, flush_in_thread=False, sharded=True)
+        reporter = dog.reporter = MemoryReporter()
+        dog.increment('other', timestamp=100.0)
+        dog.increment('mixed', timestamp=100.0)
+        thread = threading.Thread(target=dog.gauge, args=('mixed', 5, 100.0))
+        thread.start()
+        thread.join()
+
+        # Shards holding different types under one name don't spoil the flush.
+        dog.flush(200.0)
+        metrics = dict((m['metric'], m['points']) for m in reporter.metrics)
+        nt.assert_equal(metrics, {'mixed': [[100.0, 1], [100.0, 5]], 'other': [[100.0, 1]]})
+
+    def test_sketch_histogram(self):
+        dog = DogStatsApi()
+        dog.start(roll_up_interval=10, flush_in_thread=False, histogram_engine='sketch')
+        reporter = dog.reporter = MemoryReporter()
+        values = list(range(1, 10001))
+        random.shuffle(values)
+        for v in values:
+            dog.histogram('sketch', v, 1000.0)
+        dog.flush(2000.0)
+        metrics = dict((m['metric'], m['points'][0][1]) for m in reporter.metrics)
+        nt.assert_equal(metrics['sketch.count'], 10000)
+        nt.assert_equal(metrics['sketch.min'], 1)
+        nt.assert_equal(metrics['sketch.max'], 10000)
+        for p in [75, 85, 95, 99]:
+            expected = p * 100
+            actual = metrics['sketch.%spercentile' % p]
+            assert abs(actual - expected) <= 0.01 * expected, (p, actual)
+
+    def test_sketch_merge(self):
+        from dogapi.stats.sketch import DDSketch
+        left, right, both = DDSketch(), DDSketch(), DDSketch()
+        for i in range(-500, 1000):
+            (left if i % 2 else right).add(i)
+            both.add(i)
+        left.merge(right)
+        nt.assert_equal(left.count, both.count)
+        for q in [0, 0.1, 0.5, 0.9, 1]:
+            nt.assert_equal(left.quantile(q), both.quantile(q))
+
+        # Memory stays bounded no matter how spread out the values are.
+        small = DDSketch(max_bins=64)
+        for i in range(10000):
+            small.add(1.5 ** (i % 200))
+        assert len(small.positive_bins) <= 64
+        upper = small.quantile(0.99)
+        expected = 1.5 ** 197
+        assert abs(upper - expected) <= 0.01 * expected
+
+    def test_bound_metrics(self):
+        for sharded in (False, True):
+            dog = DogStatsApi()
+            dog.start(roll_up_interval=10, flush_in_thread=False, sharded=sharded)
+            reporter = dog.reporter = MemoryReporter()
+
+            counter = dog.counter('bound.counter', tags=['b', 'a'])
+            gauge = dog.bind('bound.gauge', MetricType.Gauge, host='test')
+            histogram = dog.bind('bound.histogram', MetricType.Histogram)
+
+            counter.increment(timestamp=100.0)
+            counter.increment(2, timestamp=105.0)
+            dog.increment('bound.counter', tags=['a', 'b'], timestamp=105.0)
+            counter.increment(timestamp=110.0)
+            gauge.record(1, timestamp=100.0)
+            gauge.record(2, timestamp=101.0)
+            for i in range(10):
+                histogram.record(i, timestamp=100.0)
+
+            dog.flush(110.0)
+            metrics = dict((m['metric'], m) for m in reporter.metrics)
+            nt.assert_equal(metrics['bound.counter']['points'], [[100.0, 4]])
+            nt.assert_equal(metrics['bound.counter']['tags'], ['b', 'a'])
+            nt.assert_equal(metrics['bound.gauge']['points'], [[100.0, 2]])
+            nt.assert_equal(metrics['bound.gauge']['host'], 'test')
+            nt.assert_equal(metrics['bound.histogram.count']['points'], [[100.0, 10]])
+
+            # The handle moves on to new intervals, including after a flush.
+            counter.increment(timestamp=112.0)
+            reporter.metrics = []
+            dog.flush(130.0)
+            nt.assert_equal(reporter.metrics[0]['points'], [[110.0, 2]])
+
+            # Late points of a flushed interval go out with the next flush.
+            counter.increment(timestamp=135.0)
+            dog.flush(145.0)
+            counter.increment(timestamp=138.0)
+            reporter.metrics = []
+            dog.flush(145.0)
+            nt.assert_equal(reporter.metrics[0]['points'], [[130.0, 1]])
+
+        dog = DogStatsApi()
+        dog.start(disabled=True)
+        dog.counter('bound.counter').increment()
+
+    def test_sample_rate(self):
+        random.seed(1)
+        dog = DogStatsApi()
+        dog.start(roll_up_interval=10, flush_in_thread=False)
+        reporter = dog.reporter = MemoryReporter()
+        bound = dog.counter('sampled.bound', sample_rate=0.25)
+        for i in range(10000):
+            dog.increment('sampled.counter', timestamp=100.0, sample_rate=0.1)
+            dog.histogram('sampled.histogram', 1, timestamp=100.0, sample_rate=0.5)
+            bound.increment(timestamp=100.0)
+        dog.increment('unsampled.counter', timestamp=100.0)
+        dog.flush(200.0)
+
+        metrics = dict((m['metric'], m['points'][0][1]) for m in reporter.metrics)
+        def assert_almost_equal(i, j, e):
+            assert abs(i - j) <= e, "%s %s %s" % (i, j, e)
+        assert_almost_equal(metrics['sampled.counter'], 10000, 1000)
+        assert_almost_equal(metrics['sampled.bound'], 10000, 1000)
+        assert_almost_equal(metrics['sampled.histogram.count'], 10000, 1000)
+        nt.assert_equal(metrics['sampled.histogram.avg'], 1)
+        nt.assert_equal(metrics['unsampled.counter'], 1)
+
+    def test_detach_and_rollup(self):
+        for sharded in (False, True):
+            dog = DogStatsApi()
+            dog.start(roll_up_interval=10, flush_in_thread=False, sharded=sharded)
+            reporter = dog.reporter = MemoryReporter()
+            dog.increment('detach.counter', timestamp=100.0)
+            dog.increment('detach.counter', timestamp=115.0)
+
+            # Detaching only takes the completed intervals.
+            aggregator = dog._aggregator
+            detached = aggregator.detach(115.0)
+            dog.increment('detach.counter', timestamp=116.0)
+            nt.assert_equal(aggregator.rollup(detached),
+                [(100.0, 1, 'detach.counter', None, None)])
+
+            dog.flush(120.0)
+            nt.assert_equal(reporter.metrics[0]['points'], [[110.0, 2]])
+            assert 0 <= dog.last_detach_duration <= dog.max_detach_duration
+
+    def test_context_limits(self):
+        def run(**limits):
+            dog = DogStatsApi()
+            dog.start(roll_up_interval=10, flush_in_thread=False, **limits)
+            reporter = dog.reporter = MemoryReporter()
+            for i in range(10):
+                dog.increment('users', tags=['user:%s' % i], timestamp=100.0)
+            dog.increment('users', tags=['user:0'], timestamp=101.0)
+            dog.increment('other', timestamp=100.0)
+            dog.increment('other', timestamp=100.0)
+            dog.flush(200.0)
+            metrics = dict(((m['metric'], tuple(m['tags'] or [])), m['points'][0][1])
+                for m in reporter.metrics)
+            return metrics, dog._aggregator.overflow_counts()
+
+        metrics, counts = run(max_contexts_per_metric=3)
+        nt.assert_equal(len(metrics), 4)
+        nt.assert_equal(metrics[('users', ('user:0',))], 2)
+        nt.assert_equal(metrics[('other', ())], 2)
+        nt.assert_equal(counts['dropped_points'], 7)
+
+        metrics, counts = run(max_contexts=3, overflow_policy='fold')
+        nt.assert_equal(len(metrics), 5)
+        nt.assert_equal(metrics[('users', ('overflow',))], 7)
+        nt.assert_equal(metrics[('other', ('overflow',))], 2)
+        nt.assert_equal(counts['folded_points'], 9)
+
+        metrics, counts = run(max_contexts_per_metric=3, overflow_policy='lru')
+        nt.assert_equal(len(metrics), 5)
+        nt.assert_equal(metrics[('users', ('user:9',))], 1)
+        nt.assert_equal(metrics[('users', ('user:0',))], 1)
+        nt.assert_equal(metrics[('users', ('overflow',))], 8)
+        nt.assert_equal(counts['evicted_contexts'], 8)
+
+        metrics, counts = run(sharded=True, max_contexts_per_metric=3, overflow_policy='fold')
+        nt.assert_equal(metrics[('users', ('overflow',))], 7)
+        nt.assert_equal(counts['folded_points'], 7)
+
+        nt.assert_raises(ValueError, run, overflow_policy='panic')
+
+        def run_hot(sharded, bound):
+            dog = DogStatsApi()
+            dog.start(roll_up_interval=10, flush_in_thread=False, sharded=sharded,
+                max_contexts_per_metric=2, overflow_policy='lru')
+            reporter = dog.reporter = MemoryReporter()
+            hot = dog.counter('users', tags=['hot'])
+            for i in range(6):
+                if bound:
+                    hot.increment(timestamp=100.0)
+                else:
+                    dog.increment('users', tags=['hot'], timestamp=100.0)
+                if i < 5:
+                    dog.increment('users', tags=['user:%s' % i], timestamp=100.0)
+            dog.flush(200.0)
+            return dict((tuple(m['tags']), m['points'][0][1]) for m in reporter.metrics)
+
+        # However it's recorded, the hot context is never the least recently
+        # used one, so it's never evicted.
+        for sharded in (False, True):
+            for bound in (False, True):
+                metrics = run_hot(sharded, bound)
+                nt.assert_equal(metrics[('hot',)], 6)
+                nt.assert_equal(metrics[('overflow',)], 4)
+                nt.assert_equal(metrics[('user:4',)], 1)
+
+    def test_failed_start(self):
+        from dogapi.stats import dog_stats_api
+        dog = DogStatsApi()
+        nt.assert_raises(ValueError, dog.start, flush_in_thread=False, overflow_policy='panic')
+        # The client stays as if it was never started.
+        dog.increment('counter')
+        dog.after_fork()
+        nt.assert_false(any(ref() is dog for ref in dog_stats_api._clients))
+
+    def test_context_limits_with_bound_metrics(self):
+        for sharded in (False, True):
+            dog = DogStatsApi()
+            dog.start(roll_up_interval=10, flush_in_thread=False, sharded=sharded,
+                max_contexts_per_metric=2, overflow_policy='lru')
+            reporter = dog.reporter = MemoryReporter()
+            bound = dog.counter('users', tags=['user:0'])
+            bound.increment(timestamp=100.0)
+            dog.increment('users', tags=['user:1'], timestamp=100.0)
+            # Evicts the bound context, which the handle then brings back.
+            dog.increment('users', tags=['user:2'], timestamp=100.0)
+            for i in range(5):
+                bound.increment(timestamp=100.0)
+            dog.flush(200.0)
+            metrics = dict((tuple(m['tags']), m['points'][0][1]) for m in reporter.metrics)
+            nt.assert_equal(sum(metrics.values()), 8)
+            nt.assert_equal(metrics[('user:0',)], 5)
+
+    def test_coalesce_intervals(self):
+        dog = DogStatsApi()
+        dog.start(roll_up_interval=10, flush_in_thread=False, host='default')
+        reporter = dog.reporter = MemoryReporter()
+        dog.increment('counter', timestamp=120.0, tags=['a', 'b'])
+        dog.increment('counter', timestamp=100.0, tags=['b', 'a'])
+        dog.increment('counter', timestamp=110.0, tags=['a', 'b'])
+        dog.increment('counter', timestamp=110.0, tags=['a', 'b'], host='other')
+        dog.increment('counter', timestamp=110.0)
+        dog.flush(200.0)
+
+        metrics = self.sort_metrics(reporter.metrics)
+        nt.assert_equal(len(metrics), 3)
+        tagged = [m for m in metrics if m['tags'] and m['host'] == 'default'][0]
+        nt.assert_equal(tagged['points'], [[100.0, 1], [110.0, 1], [120.0, 1]])
+
+    def test_telemetry(self):
+        from dogapi.stats.reporters import HttpReporter
+        def start(**kwargs):
+            dog = DogStatsApi()
+            dog.start(roll_up_interval=10, flush_in_thread=False, **kwargs)
+            reporter = dog.reporter = HttpReporter(retry_delay=0)
+            bodies = []
+            def http_request(method, path, body=None, **kwargs):
+                bodies.append(body)
+                if len(bodies) > 1:
+                    return {'errors': ['Boom']}
+                return {'status': 'ok'}
+            reporter.dog.http_request = http_request
+            dog.increment('counter', timestamp=100.0, tags=['a'])
+            dog.increment('counter', timestamp=100.0, tags=['b'])
+            dog.gauge('gauge', 1, timestamp=110.0)
+            dog.flush(120.0)
+            return dog, bodies
+
+        dog, bodies = start()
+        telemetry = dog.get_telemetry()
+        nt.assert_equal(telemetry['points_recorded'], 3)
+        nt.assert_equal(telemetry['contexts'], 3)
+        nt.assert_equal(telemetry['intervals'], 2)
+        nt.assert_equal(telemetry['series_sent'], 3)
+        nt.assert_equal(telemetry['bytes_sent'], len(bodies[0]))
+        nt.assert_equal(telemetry['http_errors'], 0)
+        assert telemetry['flush_duration'] > 0
+
+        # Emitted telemetry goes out with the next flush.
+        dog, bodies = start(emit_telemetry=True)
+        dog.flush(time.time() + 20)
+        nt.assert_equal(dog.get_telemetry()['http_errors'], 1)
+        # Payloads the API rejects aren't retried.
+        nt.assert_equal(dog.get_telemetry()['http_retries'], 0)
+        assert '"dogapi.client.points_recorded"' in bodies[1]
+        assert '"dogapi.client.flush_duration"' in bodies[1]
+
+    def test_flush_in_asyncio(self):
+        try:
+            import asyncio
+        except ImportError:
+            raise SkipTest("asyncio isn't available")
+        # There is no loop to schedule flushes on outside of one.
+        nt.assert_raises(RuntimeError, DogStatsApi().start, flush_in_asyncio=True)
+
+        # Flushes go on the loop start() is called from, as with asyncio.run,
+        # whether or not it's the thread's current event loop.
+        loop = asyncio.new_event_loop()
+        try:
+            dog = DogStatsApi()
+            reporter = MemoryReporter()
+            flushing_threads = []
+            def flush_in_loop(metrics, loop):
+                flushing_threads.append(threading.current_thread())
+                reporter.metrics += metrics
+                future = loop.create_future()
+                future.set_result(None)
+                return future
+            def start():
+                dog.start(flush_interval=0.1, roll_up_interval=0.1, flush_in_asyncio=True)
+                dog.reporter = reporter
+                reporter.flush_in_loop = flush_in_loop
+                dog.gauge('gauge', 10, timestamp=100.0)
+                dog.increment('counter', timestamp=100.0)
+            loop.call_soon(start)
+            loop.run_until_complete(asyncio.sleep(0.5))
+            metrics = self.sort_metrics(reporter.metrics)
+            nt.assert_equal([m['metric'] for m in metrics], ['counter', 'gauge'])
+            # Reporters that can post from the loop do so on its thread.
+            nt.assert_equal(set(flushing_threads), set([threading.current_thread()]))
+            nt.assert_false(dog._is_flush_in_progress)
+
+            # Others are run in its executor.
+            del reporter.flush_in_loop
+            flushed = []
+            reporter.flush = lambda metrics: flushed.append(threading.current_thread())
+            dog.gauge('gauge', 10, timestamp=time.time())
+            loop.run_until_complete(asyncio.sleep(0.3))
+            assert flushed
+            assert threading.current_thread() not in flushed
+
+            assert dog.stop()
+            flush_count = dog.flush_count
+            dog.gauge('gauge', 10, timestamp=200.0)
+            loop.run_until_complete(asyncio.sleep(0.3))
+            nt.assert_equal(dog.flush_count, flush_count)
+        finally:
+            loop.close()
+
+    def test_http_reporter_in_asyncio(self):
+        try:
+            import asyncio
+        except ImportError:
+            raise SkipTest("asyncio isn't available")
+        import gzip
+        import io
+        import re
+        import shutil
+        import socket
+        import tempfile
+        from dogapi.exceptions import ClientError, HttpTimeout
+        from dogapi.stats.reporters import HttpReporter
+        from dogapi.stats.spool import Spool
+        requests = []
+        class Server(asyncio.Protocol):
+            answer = True
+            def connection_made(self, transport):
+                self.transport = transport
+                self.data = b''
+            def data_received(self, data):
+                self.data += data
+                head, _, body = self.data.partition(b'\r\n\r\n')
+                length = re.search(br'Content-Length: (\d+)', head)
+                if not length or len(body) < int(length.group(1)) or not self.answer:
+                    return
+                requests.append((head, body))
+                self.transport.write(b'HTTP/1.1 202 Accepted\r\n'
+                    b'Content-Type: application/json\r\n')
+                if len(requests) % 2:
+                    self.transport.write(b'Content-Length: 16\r\n\r\n{"status": "ok"}')
+                else:
+                    self.transport.write(b'Transfer-Encoding: chunked\r\n\r\n'
+                        b'a\r\n{"status":\r\n6\r\n "ok"}\r\n0\r\n\r\n')
+                self.transport.close()
+        class SilentServer(Server):
+            answer = False
+
+        def reporter(server, **kwargs):
+            port = server.sockets[0].getsockname()[1]
+            return HttpReporter(api_key='key', api_host='http://127.0.0.1:%s' % port,
+                retry_delay=0, **kwargs)
+
+        loop = asyncio.new_event_loop()
+        servers = []
+        try:
+            for protocol in (Server, SilentServer):
+                servers.append(loop.run_until_complete(
+                    loop.create_server(protocol, '127.0.0.1', 0)))
+            def run_in_executor(*args):
+                raise AssertionError("Posting from the loop takes no thread")
+            loop.run_in_executor = run_in_executor
+            metrics = [{'metric': 'metric', 'points': [[100.0, i]], 'tags': ['a:b'],
+                        'host': 'host', 'device': None} for i in range(5)]
+
+            threads = threading.active_count()
+            http_reporter = reporter(servers[0], max_chunk_size=300, compression='gzip',
+                compression_threshold=0)
+            responses = loop.run_until_complete(http_reporter.flush_in_loop(metrics, loop))
+            nt.assert_equal(threading.active_count(), threads)
+            assert len(requests) > 1
+            nt.assert_equal(responses, [{'status': 'ok'}] * len(requests))
+            series = []
+            for head, body in requests:
+                assert head.startswith(b'POST /api/v1/series?api_key=key HTTP/1.1')
+                assert b'Content-Encoding: gzip' in head
+                body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+                series += json.loads(body.decode('utf-8'))['series']
+            nt.assert_equal(sorted(series, key=lambda m: m['points']), metrics)
+            telemetry = http_reporter.telemetry()
+            nt.assert_equal(telemetry['series_sent'], 5)
+            nt.assert_equal(telemetry['bytes_sent'], sum(len(body) for _, body in requests))
+
+            # Failures are retried, then raised.
+            http_reporter = reporter(servers[1])
+            http_reporter.dog.timeout = 0.05
+            nt.assert_raises(HttpTimeout, loop.run_until_complete,
+                http_reporter.flush_in_loop(metrics, loop))
+            nt.assert_equal(http_reporter.telemetry()['http_retries'], 2)
+            nt.assert_equal(http_reporter.telemetry()['http_errors'], 1)
+
+            closed = socket.socket()
+            closed.bind(('127.0.0.1', 0))
+            port = closed.getsockname()[1]
+            closed.close()
+            http_reporter = HttpReporter(api_key='key', api_host='http://127.0.0.1:%s' % port,
+                max_retries=0)
+            nt.assert_raises(ClientError, loop.run_until_complete,
+                http_reporter.flush_in_loop(metrics, loop))
+
+            # With a spool, what can't be sent is replayed once the API is back.
+            path = tempfile.mkdtemp()
+            try:
+                http_reporter.spool = Spool(path)
+                loop.run_until_complete(http_reporter.flush_in_loop(metrics[:1], loop))
+                nt.assert_equal(len(http_reporter.spool), 1)
+                http_reporter.dog.api_host = 'http://127.0.0.1:%s' % (
+                    servers[0].sockets[0].getsockname()[1])
+                del requests[:]
+                loop.run_until_complete(http_reporter.flush_in_loop(metrics[1:2], loop))
+                nt.assert_equal(len(requests), 2)
+                nt.assert_equal(len(http_reporter.spool), 0)
+            finally:
+                shutil.rmtree(path)
+        finally:
+            for server in servers:
+                server.close()
+            loop.close()
+
+    def test_flush_schedule(self):
+        from dogapi.stats import periodic_timer
+        from dogapi.stats.periodic_timer import Schedule
+        clock = {'wall': 1003.0, 'monotonic': 50.0}
+        def advance(seconds):
+            clock['wall'] += seconds
+            clock['monotonic'] += seconds
+        original = periodic_timer.time, periodic_timer.monotonic
+        periodic_timer.time = lambda: clock['wall']
+        periodic_timer.monotonic = lambda: clock['monotonic']
+        try:
+            # The first run is aligned on the wall clock.
+            schedule = Schedule(10, align=10)
+            nt.assert_equal(schedule.wait_time(), 7)
+            advance(7)
+            # The time a run takes doesn't delay the next one.
+            advance(2)
+            nt.assert_equal(schedule.wait_time(), 8)
+            advance(8)
+            # Nor do wall clock adjustments.
+            clock['wall'] += 3
+            nt.assert_equal(schedule.wait_time(), 10)
+            advance(10)
+            # Missed runs are collapsed into one that happens right away.
+            advance(25)
+            nt.assert_equal(schedule.wait_time(), 0)
+            nt.assert_equal(schedule.missed_runs, 1)
+            nt.assert_equal(schedule.wait_time(), 5)
+
+            schedule = Schedule(10, align=10, jitter=3)
+            assert 0 <= schedule.offset <= 3
+            nt.assert_almost_equal(schedule.wait_time(),
+                10 - (clock['wall'] - schedule.offset) % 10)
+        finally:
+            periodic_timer.time, periodic_timer.monotonic = original
+
+    def test_stop_drains_open_intervals(self):
+        dog = DogStatsApi()
+        dog.start(roll_up_interval=10, flush_in_thread=False)
+        reporter = dog.reporter = MemoryReporter()
+        dog.gauge('gauge', 1)
+        dog.increment('counter')
+        assert dog.stop(flush=True)
+        metrics = self.sort_metrics(reporter.metrics)
+        nt.assert_equal([m['metric'] for m in metrics], ['counter', 'gauge'])
+
+        dog = DogStatsApi()
+        dog.start(roll_up_interval=10, flush_in_thread=False)
+        reporter = dog.reporter = MemoryReporter()
+        dog.gauge('gauge', 1)
+        assert dog.stop()
+        nt.assert_equal(reporter.metrics, [])
+
+        # A slow intake doesn't hold up stopping past the timeout.
+        dog = DogStatsApi()
+        dog.start(roll_up_interval=10, flush_in_thread=False)
+        dog.reporter = MemoryReporter()
+        dog.reporter.flush = lambda metrics: time.sleep(1)
+        dog.gauge('gauge', 1)
+        start = time.time()
+        assert not dog.stop(flush=True, timeout=0.1)
+        assert time.time() - start < 0.5
+
+        # Python 3.12 can't start threads at interpreter shutdown, when the
+        # exit hook drains.
+        def start_thread(thread):
+            raise RuntimeError("can't create new thread at interpreter shutdown")
+        dog = DogStatsApi()
+        dog.start(roll_up_interval=10, flush_in_thread=False)
+        reporter = dog.reporter = MemoryReporter()
+        dog.increment('counter')
+        original_start = threading.Thread.start
+        threading.Thread.start = start_thread
+        try:
+            assert dog.stop(flush=True)
+        finally:
+            threading.Thread.start = original_start
+        nt.assert_equal([m['metric'] for m in reporter.metrics], ['counter'])
+
+    def test_http_reporter_chunks(self):
+        from dogapi.exceptions import HttpTimeout
+        from dogapi.stats.reporters import HttpReporter
+        reporter = HttpReporter(max_chunk_size=1000, upload_workers=3, retry_delay=0)
+        lock = threading.Lock()
+        bodies = []
+        attempts = {}
+        def http_request(method, path, body=None, **kwargs):
+            with lock:
+                attempts[body] = attempts.get(body, 0) + 1
+                # Fail every chunk's first attempt.
+                if attempts[body] == 1:
+                    raise HttpTimeout('Timed out')
+                bodies.append(body)
+            return {'status': 'ok'}
+        reporter.dog.http_request = http_request
+        metrics = [{'metric': 'metric.%s' % i, 'points': [[100.0, i]], 'tags': None,
+                    'host': 'host', 'device': None} for i in range(100)]
+        responses = reporter.flush(metrics)
+
+        assert len(bodies) > 1
+        nt.assert_equal(responses, [{'status': 'ok'}] * len(bodies))
+        for body in bodies:
+            assert len(body) <= 1000
+        series = [s for body in bodies for s in json.loads(body)['series']]
+        nt.assert_equal(sorted(series, key=lambda s: s['points'][0][1]), metrics)
+        nt.assert_equal(reporter.series_sent, 100)
+        nt.assert_equal(reporter.bytes_sent, sum(len(body) for body in bodies))
+        nt.assert_equal(reporter.http_retries, len(bodies))
+        nt.assert_equal(reporter.http_errors, 0)
+
+        # Chunks that keep failing are given up on.
+        reporter.dog.http_request = lambda *args, **kwargs: {'errors': ['Boom']}
+        responses = reporter.flush(metrics)
+        nt.assert_equal(reporter.http_errors, len(responses))
+        nt.assert_equal(reporter.series_sent, 100)
+
+    def test_http_reporter_compression(self):
+        import gzip
+        import io
+        import zlib
+        from dogapi.stats.reporters import HttpReporter
+        requests = []
+        class FakeResponse(object):
+            status = 202
+            def read(self):
+                return b'{"status": "ok"}'
+        class FakeConnection(object):
+            def __init__(self, host, timeout=None):
+                pass
+            def request(self, method, url, body, headers):
+                requests.append((body, headers))
+            def getresponse(self):
+                return FakeResponse()
+            def close(self):
+                pass
+
+        metrics = [{'metric': 'metric', 'points': [[100.0, i]], 'tags': ['a:b'],
+                    'host': 'host', 'device': None} for i in range(100)]
+        def flush(**kwargs):
+            reporter = HttpReporter(**kwargs)
+            reporter.dog.http_conn_cls = FakeConnection
+            nt.assert_equal(reporter.flush(metrics), [{'status': 'ok'}])
+            body, headers = requests.pop()
+            # Telemetry counts the bytes sent, not those serialized.
+            nt.assert_equal(reporter.telemetry()['bytes_sent'], len(body))
+            return body, headers
+
+        body, headers = flush(compression='gzip')
+        nt.assert_equal(headers['Content-Encoding'], 'gzip')
+        body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+        nt.assert_equal(json.loads(body.decode('utf-8'))['series'], metrics)
+
+        body, headers = flush(compression='deflate')
+        nt.assert_equal(headers['Content-Encoding'], 'deflate')
+        nt.assert_equal(json.loads(zlib.decompress(body).decode('utf-8'))['series'], metrics)
+
+        # Small bodies aren't worth compressing.
+        body, headers = flush(compression='gzip', compression_threshold=10 ** 6)
+        assert 'Content-Encoding' not in headers
+        nt.assert_equal(json.loads(body)['series'], metrics)
+
+        body, headers = flush()
+        assert 'Content-Encoding' not in headers
+
+        nt.assert_raises(ValueError, HttpReporter, compression='brotli')
+
+    def test_after_fork(self):
+        if not hasattr(os, 'fork'):
+            raise SkipTest("fork isn't available")
+        for sharded in (False, True):
+            dog = DogStatsApi()
+            dog.start(roll_up_interval=10, flush_interval=60, sharded=sharded)
+            reporter = dog.reporter = MemoryReporter()
+            # Handles are usually bound once, before the server forks.
+            bound = dog.counter('bound')
+            bound.increment(timestamp=100.0)
+            dog.gauge('parent', 1, timestamp=100.0)
+            parent_thread = dog._flush_thread
+            read_end, write_end = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.close(read_end)
+                    if not hasattr(os, 'register_at_fork'):
+                        dog.after_fork()
+                    dog.reporter = MemoryReporter()
+                    dog.gauge('child', 1, timestamp=100.0)
+                    bound.increment(2, timestamp=100.0)
+                    dog.flush(200.0)
+                    result = {
+                        'metrics': sorted((m['metric'], m['points'][0][1])
+                                          for m in dog.reporter.metrics),
+                        'flushing': dog._flush_thread.is_alive(),
+                    }
+                    os.write(write_end, json.dumps(result).encode('utf-8'))
+                finally:
+                    os._exit(0)
+            os.close(write_end)
+            try:
+                result = json.loads(os.read(read_end, 4096).decode('utf-8'))
+            finally:
+                os.close(read_end)
+                os.waitpid(pid, 0)
+            # The child only flushes its own points, with its own flush thread.
+            nt.assert_equal(result, {'metrics': [['bound', 2], ['child', 1]], 'flushing': True})
+            assert dog._flush_thread is parent_thread
+            dog.flush(200.0)
+            nt.assert_equal(sorted(m['metric'] for m in reporter.metrics), ['bound', 'parent'])
+            dog.stop()
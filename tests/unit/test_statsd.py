@@ -0,0 +1,239 @@
+"""
+Tests for the statsd aggregator.
+"""
+
+import os
+import random
+import shutil
+import socket
+import tempfile
+import time
+
+import nose.tools as nt
+from nose.plugins.skip import SkipTest
+
+from dogapi import DogStatsApi
+from dogapi.stats.metrics import Counter, Gauge
+from dogapi.stats.statsd import StatsdAggregator
+
+
+#
+# Test fixtures.
+#
+
+class FakeSocket(object):
+    """ A socket that records the datagrams sent to it. """
+
+    def __init__(self):
+        self.payloads = []
+
+    def sendto(self, payload, address):
+        self.payloads.append(payload)
+
+    def lines(self):
+        return [l for p in self.payloads for l in p.decode('utf-8').split('\n')]
+
+
+def fake_socket(aggregator):
+    fake = FakeSocket()
+    aggregator.socket_sendto = fake.sendto
+    return fake
+
+
+#
+# Unit tests.
+#
+
+class TestUnitStatsd(object):
+
+    def test_unbuffered(self):
+        aggregator = StatsdAggregator()
+        sock = fake_socket(aggregator)
+        aggregator.add_point('counter', None, time.time(), 1, Counter)
+        aggregator.add_point('gauge', ['a:b'], time.time(), 2, Gauge, host='h')
+        nt.assert_equal(sock.payloads, [b'counter:1|c', b'gauge:2|g|#a:b,host:h'])
+
+    def test_buffered(self):
+        aggregator = StatsdAggregator(max_buffer_size=50, max_buffer_delay=60)
+        sock = fake_socket(aggregator)
+        for i in range(10):
+            aggregator.add_point('counter.%s' % i, None, time.time(), 1, Counter)
+        aggregator.flush()
+
+        # 'counter.N:1|c' is 13 bytes, so three fit in a datagram with the
+        # newlines separating them.
+        nt.assert_equal(len(sock.payloads), 4)
+        assert all(len(p) <= 50 for p in sock.payloads)
+        nt.assert_equal(sock.lines(), ['counter.%s:1|c' % i for i in range(10)])
+
+    def test_buffer_delay(self):
+        aggregator = StatsdAggregator(max_buffer_size=1000, max_buffer_delay=0.1)
+        sock = fake_socket(aggregator)
+        aggregator.add_point('counter', None, time.time(), 1, Counter)
+        nt.assert_equal(sock.payloads, [])
+        time.sleep(0.2)
+        aggregator.add_point('counter', None, time.time(), 1, Counter)
+        nt.assert_equal(sock.payloads, [b'counter:1|c\ncounter:1|c'])
+
+    def test_dog_stats_api_flushes_buffer(self):
+        dog = DogStatsApi()
+        dog.start(statsd=True, statsd_max_buffer_size=1000, flush_in_thread=False)
+        sock = fake_socket(dog._aggregator)
+        dog.increment('counter')
+        dog.gauge('gauge', 1)
+        nt.assert_equal(sock.payloads, [])
+        dog.flush()
+        nt.assert_equal(sock.payloads, [b'counter:1|c\ngauge:1|g'])
+
+    def test_unix_socket(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise SkipTest("Unix sockets aren't available")
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'dsd.socket')
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            server.bind(path)
+            server.settimeout(1)
+
+            dog = DogStatsApi()
+            dog.start(statsd=True, statsd_socket_path=path, statsd_max_buffer_size=8192,
+                flush_in_thread=False)
+            dog.increment('counter', tags=['a:b'])
+            dog.histogram('histogram', 2)
+            dog.flush()
+            nt.assert_equal(server.recv(8192), b'counter:1|c|#a:b\nhistogram:2|h')
+            server.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_sender_thread(self):
+        aggregator = StatsdAggregator(sender_queue_size=10, max_buffer_size=1000,
+            max_buffer_delay=60)
+        sock = fake_socket(aggregator)
+        tags = ['a:b']
+        for i in range(5):
+            aggregator.add_point('counter', tags, time.time(), i, Counter, host='h')
+        aggregator.flush()
+        deadline = time.time() + 5
+        while not sock.payloads and time.time() < deadline:
+            time.sleep(0.01)
+        nt.assert_equal(sock.lines(), ['counter:%s|c|#a:b,host:h' % i for i in range(5)])
+        nt.assert_equal(tags, ['a:b'])
+        nt.assert_equal(aggregator.dropped_points, 0)
+
+    def test_sender_queue_full(self):
+        aggregator = StatsdAggregator(sender_queue_size=10, max_buffer_size=1000,
+            max_buffer_delay=60)
+        fake_socket(aggregator)
+        # Stall the sender thread so the queue fills up.
+        aggregator._buffer_lock.acquire()
+        try:
+            for i in range(100):
+                aggregator.add_point('counter', None, time.time(), 1, Counter)
+        finally:
+            aggregator._buffer_lock.release()
+        assert aggregator.dropped_points in (89, 90), aggregator.dropped_points
+
+    def test_drain(self):
+        dog = DogStatsApi()
+        dog.start(statsd=True, statsd_aggregate=True, statsd_max_buffer_size=1000,
+            statsd_sender_queue_size=10, roll_up_interval=10, flush_in_thread=False)
+        sock = fake_socket(dog._aggregator.statsd)
+        dog.increment('counter')
+        dog.increment('counter')
+        dog.histogram('histogram', 1)
+        assert dog.stop(flush=True)
+        nt.assert_equal(sorted(sock.lines()), ['counter:2|c', 'histogram:1|h'])
+
+    def test_reset(self):
+        aggregator = StatsdAggregator(max_buffer_size=1000, max_buffer_delay=60,
+            sender_queue_size=10)
+        sock = fake_socket(aggregator)
+        bound = aggregator.bind('counter', None, Counter)
+        bound.increment()
+        assert aggregator.drain(5)
+        # A forked child drops what it copied and gets its own sender thread.
+        aggregator._buffer.append(b'copied:1|c')
+        aggregator.reset()
+        nt.assert_equal(aggregator.telemetry()['points_recorded'], 0)
+        bound.increment(2)
+        assert aggregator.drain(5)
+        nt.assert_equal(sock.lines(), ['counter:1|c', 'counter:2|c'])
+
+    def test_format_cache(self):
+        random.seed(1)
+        aggregator = StatsdAggregator()
+        sock = fake_socket(aggregator)
+        tags = ['a:b']
+        for value in (1, 2.5):
+            aggregator.add_point('gauge', tags, time.time(), value, Gauge, sample_rate=0.99999,
+                host='h')
+        aggregator.add_point('gauge', tags, time.time(), 3, Gauge, host='h')
+        nt.assert_equal(sock.payloads, [
+            b'gauge:1|g|@0.99999|#a:b,host:h',
+            b'gauge:2.5|g|@0.99999|#a:b,host:h',
+            b'gauge:3|g|#a:b,host:h',
+        ])
+        # The caller's tags are left alone.
+        nt.assert_equal(tags, ['a:b'])
+        nt.assert_equal(len(aggregator._format_cache), 2)
+
+    def test_aggregate(self):
+        dog = DogStatsApi()
+        dog.start(statsd=True, statsd_aggregate=True, roll_up_interval=10,
+            flush_in_thread=False)
+        sock = fake_socket(dog._aggregator.statsd)
+        for i in range(1000):
+            dog.increment('counter', timestamp=100.0, tags=['a:b'])
+            dog.gauge('gauge', i, timestamp=100.0, host='h')
+        dog.histogram('histogram', 1, timestamp=100.0)
+        dog.increment('counter', timestamp=110.0, tags=['a:b'])
+
+        # Histograms are still forwarded as they come.
+        nt.assert_equal(sock.lines(), ['histogram:1|h'])
+        dog.flush(110.0)
+        nt.assert_equal(sorted(sock.lines()[1:]), ['counter:1000|c|#a:b', 'gauge:999|g|#host:h'])
+        dog.flush(120.0)
+        nt.assert_equal(sock.lines()[3:], ['counter:1|c|#a:b'])
+
+    def test_aggregate_histograms(self):
+        dog = DogStatsApi()
+        dog.start(statsd=True, statsd_aggregate=True, statsd_aggregate_histograms=True,
+            roll_up_interval=10, flush_in_thread=False)
+        sock = fake_socket(dog._aggregator.statsd)
+        for i in range(1, 101):
+            dog.histogram('histogram', i, timestamp=100.0)
+        dog.flush(110.0)
+        lines = sorted(sock.lines())
+        nt.assert_equal(len(lines), 8)
+        # Counts add up across processes, the rest are gauges.
+        assert 'histogram.count:100|c' in lines
+        assert 'histogram.max:100|g' in lines
+        assert 'histogram.avg:50.5|g' in lines
+
+    def test_event(self):
+        dog = DogStatsApi()
+        dog.start(statsd=True, flush_in_thread=False)
+        sock = fake_socket(dog._aggregator)
+        dog.event('Title', 'Line 1\nline 2', alert_type='error', aggregation_key='k',
+            date_happened=1000.5, tags=['a:b', 'c'], host='h')
+        dog.event('T', 'text')
+        nt.assert_equal(sock.payloads, [
+            b'_e{5,14}:Title|Line 1\\nline 2|d:1000|h:h|k:k|t:error|#a:b,c',
+            b'_e{1,4}:T|text',
+        ])
+
+    def test_service_check(self):
+        from dogapi.constants import CheckStatus
+        from dogapi.exceptions import ApiError
+        dog = DogStatsApi()
+        dog.start(statsd=True, flush_in_thread=False)
+        sock = fake_socket(dog._aggregator)
+        dog.service_check('check.name', CheckStatus.WARNING, host='h', timestamp=1000,
+            message='disk:\nm: full', tags=['a:b'])
+        dog.service_check('check.name', CheckStatus.OK)
+        nt.assert_equal(sock.payloads, [
+            b'_sc|check.name|1|d:1000|h:h|#a:b|m:disk:\\nm\\: full',
+            b'_sc|check.name|0',
+        ])
+        nt.assert_raises(ApiError, dog.service_check, 'check.name', 42)
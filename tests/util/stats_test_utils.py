@@ -0,0 +1,8 @@
+class MemoryReporter(object):
+    """ A reporting class that reports to memory for testing. """
+
+    def __init__(self):
+        self.metrics = []
+
+    def flush(self, metrics):
+        self.metrics += metrics